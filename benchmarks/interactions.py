@@ -0,0 +1,68 @@
+""" Timings of SHAP interaction values from the internal C++ kernel against XGBoost's own
+pred_interactions, on models of equal size.
+
+    python benchmarks/interactions.py
+"""
+
+import time
+import numpy as np
+import shap
+
+
+def interaction_timings(num_trees=100, max_depth=6, nrows=200, n_jobs=-1):
+    """ Times interaction values for XGBoost (native and internal), LightGBM with categorical
+    features and CatBoost models that all have num_trees trees of depth max_depth.
+    """
+    X, y = shap.datasets.adult()
+    X = X.values.astype(np.float64)
+    y = y.astype(np.float64)
+    X_explain = X[:nrows]
+    categorical = [1, 3, 5, 6, 7, 8, 9, 13] # the integer coded categorical columns of the adult dataset
+
+    print("%32s %12s" % ("model", "interactions"))
+
+    try:
+        import xgboost
+        model = xgboost.train(
+            {"max_depth": max_depth, "eta": 0.1, "objective": "binary:logistic"}, xgboost.DMatrix(X, y), num_trees
+        )
+        dmatrix = xgboost.DMatrix(X_explain)
+        start = time.time()
+        model.predict(dmatrix, pred_interactions=True)
+        print("%32s %11.4fs" % ("xgboost pred_interactions", time.time() - start))
+
+        explainer = shap.TreeExplainer(model)
+        explainer.model.model_type = "internal" # skip the shortcut to XGBoost's own implementation
+        start = time.time()
+        explainer.shap_interaction_values(X_explain, n_jobs=n_jobs)
+        print("%32s %11.4fs" % ("xgboost internal", time.time() - start))
+    except ImportError:
+        print("%32s %12s" % ("xgboost", "not installed"))
+
+    try:
+        import lightgbm
+        model = lightgbm.train(
+            {"num_leaves": 2**max_depth, "max_depth": max_depth, "objective": "binary", "verbose": -1},
+            lightgbm.Dataset(X, y, categorical_feature=categorical), num_trees
+        )
+        explainer = shap.TreeExplainer(model)
+        start = time.time()
+        explainer.shap_interaction_values(X_explain, n_jobs=n_jobs)
+        print("%32s %11.4fs" % ("lightgbm categorical internal", time.time() - start))
+    except ImportError:
+        print("%32s %12s" % ("lightgbm", "not installed"))
+
+    try:
+        import catboost
+        model = catboost.CatBoostClassifier(iterations=num_trees, depth=max_depth, verbose=False)
+        model.fit(X, y)
+        explainer = shap.TreeExplainer(model)
+        start = time.time()
+        explainer.shap_interaction_values(X_explain, n_jobs=n_jobs)
+        print("%32s %11.4fs" % ("catboost internal", time.time() - start))
+    except ImportError:
+        print("%32s %12s" % ("catboost", "not installed"))
+
+
+if __name__ == "__main__":
+    interaction_timings()
@@ -0,0 +1,42 @@
+""" Timings of converting trained models into the TreeEnsemble used by TreeExplainer.
+
+    python benchmarks/model_loading.py
+"""
+
+import time
+import numpy as np
+import lightgbm
+import shap
+from shap.explainers.tree import Tree, get_lightgbm_trees
+
+
+def lightgbm_load_timings(tree_counts=(100, 1000, 3000), num_leaves=255):
+    """ Times parsing LightGBM models with an increasing number of trees, both from the
+    `model_to_string()` text (what TreeExplainer uses) and from the `dump_model()` JSON.
+    """
+    X, y = shap.datasets.adult()
+    dataset = lightgbm.Dataset(X.values, y.astype(np.float64))
+
+    print("%8s %14s %14s %14s" % ("trees", "text parse", "json parse", "TreeExplainer"))
+    for num_trees in tree_counts:
+        model = lightgbm.train({
+            "num_leaves": num_leaves, "min_data_in_leaf": 1, "learning_rate": 0.01, "verbose": -1
+        }, dataset, num_trees)
+
+        start = time.time()
+        trees = [Tree(e) for e in get_lightgbm_trees(model.model_to_string())]
+        text_time = time.time() - start
+
+        start = time.time()
+        trees = [Tree(e) for e in model.dump_model()["tree_info"]]
+        json_time = time.time() - start
+
+        start = time.time()
+        shap.TreeExplainer(model)
+        explainer_time = time.time() - start
+
+        print("%8d %13.3fs %13.3fs %13.3fs" % (len(trees), text_time, json_time, explainer_time))
+
+
+if __name__ == "__main__":
+    lightgbm_load_timings()
@@ -0,0 +1,105 @@
+""" Timings of the Tree SHAP C++ kernels on deep random forests.
+
+Run this script against two builds of shap (for example before and after a change to
+shap/tree_shap.h) to compare the speed of the tree traversals:
+
+    python benchmarks/tree_traversal.py
+"""
+
+import time
+import numpy as np
+import sklearn.ensemble
+import shap
+
+
+def best_time(f, repeats=3):
+    """ The fastest of several runs of f (in seconds).
+    """
+    times = []
+    for _ in range(repeats):
+        start = time.time()
+        f()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def deep_forest(X, y, n_estimators=100, max_depth=None):
+    model = sklearn.ensemble.RandomForestRegressor(
+        n_estimators=n_estimators, max_depth=max_depth, random_state=0, n_jobs=-1
+    )
+    return model.fit(X, y)
+
+
+def node_layout_timings(n_estimators=50, max_depths=(10, 20, None), nrows=200):
+    """ Times prediction, path dependent Tree SHAP, Saabas and interaction values
+    on random forests of increasing depth.
+    """
+    X, y = shap.datasets.adult()
+    X = X.values.astype(np.float32)
+    y = y.astype(np.float64)
+    X_explain = X[:nrows]
+
+    print("%10s %10s %12s %12s %12s %12s" % (
+        "max_depth", "max_nodes", "predict", "shap_values", "saabas", "interactions"
+    ))
+    for max_depth in max_depths:
+        model = deep_forest(X, y, n_estimators, max_depth)
+        explainer = shap.TreeExplainer(model)
+        print("%10s %10d %11.4fs %11.4fs %11.4fs %11.4fs" % (
+            max_depth, explainer.model.num_nodes.max(),
+            best_time(lambda: explainer.model.predict(X_explain)),
+            best_time(lambda: explainer.shap_values(X_explain)),
+            best_time(lambda: explainer.shap_values(X_explain, approximate=True)),
+            best_time(lambda: explainer.shap_interaction_values(X_explain[:10]), 1)
+        ))
+
+
+def independent_output_timings(class_counts=(2, 10, 50), n_estimators=20, nrows=20, nrefs=20):
+    """ Times independent Tree SHAP on random forest classifiers with an increasing number of classes.
+    """
+    X, y = shap.datasets.adult()
+    X = X.values.astype(np.float32)
+    rs = np.random.RandomState(0)
+
+    print("%10s %12s" % ("classes", "independent"))
+    for num_classes in class_counts:
+        yc = rs.randint(num_classes, size=X.shape[0])
+        model = sklearn.ensemble.RandomForestClassifier(
+            n_estimators=n_estimators, max_depth=10, random_state=0, n_jobs=-1
+        ).fit(X, yc)
+        explainer = shap.TreeExplainer(model, X[:nrefs], feature_dependence="independent")
+        print("%10d %11.4fs" % (num_classes, best_time(lambda: explainer.shap_values(X[:nrows]))))
+
+
+def predict_timings(tree_counts=(10, 100, 500), max_depths=(4, 8), nrows=100000):
+    """ Times TreeEnsemble.predict against the native xgboost.Booster.predict on the same models.
+    """
+    try:
+        import xgboost
+    except ImportError:
+        print("xgboost is not installed, skipping the predict timings")
+        return
+    X, y = shap.datasets.adult()
+    X = X.values.astype(np.float32)
+    y = y.astype(np.float64)
+    X_predict = np.tile(X, (nrows // X.shape[0] + 1, 1))[:nrows]
+    dmatrix = xgboost.DMatrix(X_predict)
+
+    print("%8s %10s %14s %14s" % ("trees", "max_depth", "internal", "xgboost"))
+    for max_depth in max_depths:
+        for num_trees in tree_counts:
+            model = xgboost.train(
+                {"max_depth": max_depth, "eta": 0.1, "nthread": 1}, xgboost.DMatrix(X, y), num_trees
+            )
+            explainer = shap.TreeExplainer(model)
+            print("%8d %10d %13.4fs %13.4fs" % (
+                num_trees, max_depth,
+                best_time(lambda: explainer.model.predict(X_predict)),
+                best_time(lambda: model.predict(dmatrix, output_margin=True))
+            ))
+
+
+if __name__ == "__main__":
+    node_layout_timings()
+    independent_output_timings()
+    predict_timings()
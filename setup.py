@@ -56,8 +56,13 @@ class build_ext(_build_ext):
 def run_setup(with_binary=True, test_xgboost=True, test_lightgbm=True):
     ext_modules = []
     if with_binary:
+        # the C extension uses std::thread, so we need C++11 and pthreads outside of MSVC
+        if sys.platform == 'win32':
+            compile_args, link_args = [], []
+        else:
+            compile_args, link_args = ['-std=c++11', '-pthread'], ['-pthread']
         ext_modules.append(
-            Extension('shap._cext', sources=['shap/_cext.cc'])
+            Extension('shap._cext', sources=['shap/_cext.cc'], extra_compile_args=compile_args, extra_link_args=link_args)
         )
 
     if test_xgboost and test_lightgbm:
@@ -8,6 +8,7 @@
 static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args);
 static PyObject *_cext_dense_tree_predict(PyObject *self, PyObject *args);
 static PyObject *_cext_dense_tree_update_weights(PyObject *self, PyObject *args);
+static PyObject *_cext_dense_ensemble_update_weights(PyObject *self, PyObject *args);
 static PyObject *_cext_dense_tree_saabas(PyObject *self, PyObject *args);
 static PyObject *_cext_compute_expectations(PyObject *self, PyObject *args);
 
@@ -15,11 +16,834 @@ static PyMethodDef module_methods[] = {
     {"dense_tree_shap", _cext_dense_tree_shap, METH_VARARGS, "C implementation of Tree SHAP for dense."},
     {"dense_tree_predict", _cext_dense_tree_predict, METH_VARARGS, "C implementation of tree predictions."},
     {"dense_tree_update_weights", _cext_dense_tree_update_weights, METH_VARARGS, "C implementation of tree node weight compuatations."},
+    {"dense_ensemble_update_weights", _cext_dense_ensemble_update_weights, METH_VARARGS, "Add the weight of a dataset to the nodes of all the trees and update their expectations."},
     {"dense_tree_saabas", _cext_dense_tree_saabas, METH_VARARGS, "C implementation of Saabas (rough fast approximation to Tree SHAP)."},
     {"compute_expectations", _cext_compute_expectations, METH_VARARGS, "Compute expectations of internal nodes."},
     {NULL, NULL, 0, NULL}
 };
 
+/* The float32 kernels are used when X and the model arrays are already stored as float32. */
+static bool float32_inputs(PyObject *obj1, PyObject *obj2, PyObject *obj3)
+{
+    PyObject *objs[3] = {obj1, obj2, obj3};
+    for (unsigned i = 0; i < 3; ++i) {
+        if (!PyArray_Check(objs[i]) || PyArray_TYPE((PyArrayObject*)objs[i]) != NPY_FLOAT) return false;
+    }
+    return true;
+}
+
+
+/**
+ * Reads the number of trees, the size of the largest tree and the number of outputs from the shape
+ * of values, which is (# trees, max nodes, # outputs) for padded tree arrays and (# nodes, # outputs)
+ * for ragged tree arrays, whose trees are delimited by tree_offsets (of length # trees + 1).
+ */
+static bool read_tree_layout(PyArrayObject *values_array, PyArrayObject *tree_offsets_array,
+                             unsigned &num_trees, unsigned &max_nodes, unsigned &num_outputs)
+{
+    if (tree_offsets_array == NULL) {
+        if (PyArray_NDIM(values_array) != 3) {
+            PyErr_SetString(PyExc_ValueError, "values must have shape (# trees, # nodes, # outputs)!");
+            return false;
+        }
+        num_trees = PyArray_DIM(values_array, 0);
+        max_nodes = PyArray_DIM(values_array, 1);
+        num_outputs = PyArray_DIM(values_array, 2);
+        return true;
+    }
+
+    const int *tree_offsets = (int*)PyArray_DATA(tree_offsets_array);
+    if (PyArray_NDIM(values_array) != 2 || PyArray_NDIM(tree_offsets_array) != 1 ||
+        PyArray_DIM(tree_offsets_array, 0) < 1 || tree_offsets[0] != 0 ||
+        tree_offsets[PyArray_DIM(tree_offsets_array, 0) - 1] != PyArray_DIM(values_array, 0)) {
+        PyErr_SetString(PyExc_ValueError, "ragged tree arrays need values with shape (# nodes, # outputs) "
+                        "and tree_offsets with shape (# trees + 1,) running from 0 to # nodes!");
+        return false;
+    }
+    num_trees = PyArray_DIM(tree_offsets_array, 0) - 1;
+    num_outputs = PyArray_DIM(values_array, 1);
+    max_nodes = 0;
+    for (unsigned i = 0; i < num_trees; ++i) {
+        if (tree_offsets[i + 1] < tree_offsets[i]) {
+            PyErr_SetString(PyExc_ValueError, "tree_offsets must be non-decreasing!");
+            return false;
+        }
+        max_nodes = std::max(max_nodes, (unsigned)(tree_offsets[i + 1] - tree_offsets[i]));
+    }
+    return true;
+}
+
+
+/**
+ * A tree ensemble whose arrays have been validated, converted and packed into TreeNode
+ * structs once, so that repeated calls (such as explaining one row per request) only pay
+ * for the tree traversals.
+ */
+typedef struct {
+    PyObject_HEAD
+    PyArrayObject *children_left;
+    PyArrayObject *children_right;
+    PyArrayObject *children_default;
+    PyArrayObject *features;
+    PyArrayObject *thresholds;
+    PyArrayObject *values;
+    PyArrayObject *node_sample_weights;
+    PyArrayObject *tree_offsets; // NULL when the trees are padded to max_nodes
+    void *nodes; // TreeNode<float> or TreeNode<tfloat> depending on use_float32
+    int *unique_features; // built by the first interactions call
+    PathTables *path_tables; // built by build_path_tables
+    long long path_tables_too_large; // the largest max_entries build_path_tables has failed for
+    bool use_float32;
+    int max_depth;
+    double base_offset;
+    unsigned num_trees;
+    unsigned max_nodes;
+    unsigned num_outputs;
+} CompiledEnsembleObject;
+
+/**
+ * The trees [tree_start, tree_limit) of the compiled ensemble, as a view of its arrays. The base offset
+ * only belongs to ranges that start at the first tree, so the outputs of consecutive ranges add up.
+ */
+template <typename T>
+static TreeEnsemble<T> compiled_trees(const CompiledEnsembleObject *self, int tree_limit, int tree_start = 0)
+{
+    if (tree_limit < 0 || tree_limit > (int)self->num_trees) tree_limit = self->num_trees;
+    TreeEnsemble<T> trees(
+        (int*)PyArray_DATA(self->children_left), (int*)PyArray_DATA(self->children_right),
+        (int*)PyArray_DATA(self->children_default), (int*)PyArray_DATA(self->features),
+        (T*)PyArray_DATA(self->thresholds), (T*)PyArray_DATA(self->values),
+        (T*)PyArray_DATA(self->node_sample_weights), self->max_depth, tree_limit,
+        self->base_offset, self->max_nodes, self->num_outputs,
+        self->tree_offsets == NULL ? NULL : (int*)PyArray_DATA(self->tree_offsets)
+    );
+    trees.nodes = (TreeNode<T>*)self->nodes;
+    trees.unique_features = self->unique_features;
+    if (tree_start > 0) {
+        trees.get_tree_range(trees, tree_start, tree_limit - tree_start);
+        trees.base_offset = 0;
+    }
+    return trees;
+}
+
+template <typename T>
+static void compiled_pack_nodes(CompiledEnsembleObject *self)
+{
+    const TreeEnsemble<T> trees = compiled_trees<T>(self, -1);
+    TreeNode<T> *nodes = new TreeNode<T>[trees.tree_offset(self->num_trees)];
+    trees.fill_nodes(nodes);
+    self->nodes = nodes;
+}
+
+static void compiled_free_nodes(CompiledEnsembleObject *self)
+{
+    if (self->use_float32) delete[] (TreeNode<float>*)self->nodes;
+    else delete[] (TreeNode<tfloat>*)self->nodes;
+    self->nodes = NULL;
+    delete[] self->unique_features;
+    self->unique_features = NULL;
+    delete self->path_tables;
+    self->path_tables = NULL;
+    self->path_tables_too_large = 0;
+}
+
+template <typename T>
+static void compiled_fill_unique_features(CompiledEnsembleObject *self)
+{
+    const TreeEnsemble<T> trees = compiled_trees<T>(self, -1);
+    self->unique_features = new int[trees.tree_offset(self->num_trees)];
+    trees.fill_unique_features(self->unique_features);
+}
+
+// the number of entries of X converted to the model's float type at a time when X is stored as the other type
+const size_t CONVERT_BLOCK_ENTRIES = 1 << 20;
+
+/* X as a C ordered float32 or float64 array (other types, such as integers, are converted as a whole). */
+static PyArrayObject *float_x_array(PyObject *X_obj, int float_type)
+{
+    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OF(X_obj, NPY_ARRAY_IN_ARRAY);
+    if (X_array == NULL || PyArray_TYPE(X_array) == NPY_FLOAT || PyArray_TYPE(X_array) == NPY_DOUBLE) return X_array;
+    PyArrayObject *converted = (PyArrayObject*)PyArray_FROM_OTF((PyObject*)X_array, float_type, NPY_ARRAY_IN_ARRAY);
+    Py_DECREF(X_array);
+    return converted;
+}
+
+/**
+ * Runs func(slice, start) on the rows of X as the model's float type T, where slice is the view of data
+ * for the rows [start, start + slice.num_X). X is used in place when it is already stored as T, otherwise
+ * blocks of at least min_block_rows rows are converted one at a time, so X is never copied as a whole.
+ */
+template <typename T, typename Func>
+static void for_x_blocks(PyArrayObject *X_array, ExplanationDataset<T> data, unsigned min_block_rows, Func func)
+{
+    const int x_type = sizeof(T) == sizeof(float) ? NPY_FLOAT : NPY_DOUBLE;
+    if (PyArray_TYPE(X_array) == x_type) {
+        data.X = (T*)PyArray_DATA(X_array);
+        func(data, 0);
+        return;
+    }
+
+    const unsigned M = data.M;
+    const unsigned block_rows = std::max(
+        std::max(min_block_rows, 1u), (unsigned)(CONVERT_BLOCK_ENTRIES / std::max(M, 1u))
+    );
+    std::vector<T> block((size_t)std::min(block_rows, data.num_X) * M);
+    data.X = block.data();
+    for (unsigned start = 0; start < data.num_X; start += block_rows) {
+        const unsigned end = std::min(start + block_rows, data.num_X);
+        if (PyArray_TYPE(X_array) == NPY_FLOAT) {
+            const float *X = (float*)PyArray_DATA(X_array);
+            std::copy(X + (size_t)start * M, X + (size_t)end * M, block.begin());
+        } else {
+            const double *X = (double*)PyArray_DATA(X_array);
+            std::copy(X + (size_t)start * M, X + (size_t)end * M, block.begin());
+        }
+        ExplanationDataset<T> slice;
+        data.get_x_slice(slice, start, end);
+        slice.X = data.X;
+        func(slice, start);
+    }
+}
+
+/* The dataset of a call, where X is set by for_x_blocks and the missing masks are optional. */
+template <typename T>
+static ExplanationDataset<T> compiled_dataset(PyArrayObject *X_array, PyArrayObject *X_missing_array,
+                                              PyArrayObject *y_array, PyArrayObject *R_array,
+                                              PyArrayObject *R_missing_array)
+{
+    return ExplanationDataset<T>(
+        NULL, X_missing_array == NULL ? NULL : (bool*)PyArray_DATA(X_missing_array),
+        y_array == NULL ? NULL : (tfloat*)PyArray_DATA(y_array),
+        R_array == NULL ? NULL : (T*)PyArray_DATA(R_array),
+        R_missing_array == NULL ? NULL : (bool*)PyArray_DATA(R_missing_array),
+        PyArray_DIM(X_array, 0), PyArray_DIM(X_array, 1), R_array == NULL ? 0 : PyArray_DIM(R_array, 0)
+    );
+}
+
+/**
+ * The int32 leaves of the rows of X (see CompiledEnsemble.apply) for the trees [tree_start, tree_limit) as an
+ * array, or NULL with an exception set when they are not a (# rows x # trees) matrix of leaf indexes of those
+ * trees. Py_None gives NULL without an exception.
+ */
+static PyArrayObject *leaves_array(const CompiledEnsembleObject *self, PyObject *leaves_obj, npy_intp num_rows,
+                                   int tree_start, int tree_limit)
+{
+    if (leaves_obj == Py_None) return NULL;
+    PyArrayObject *leaves = (PyArrayObject*)PyArray_FROM_OTF(leaves_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    if (leaves == NULL) return NULL;
+    const npy_intp num_trees = tree_limit - tree_start;
+    if (PyArray_NDIM(leaves) != 2 || PyArray_DIM(leaves, 0) != num_rows || PyArray_DIM(leaves, 1) != num_trees) {
+        PyErr_SetString(PyExc_ValueError, "The leaves must be a (# samples x # trees) matrix from apply with the same tree_limit!");
+        Py_DECREF(leaves);
+        return NULL;
+    }
+
+    // the kernels index the tree arrays with these directly, so every entry must be a leaf of its tree
+    const int *leaf_data = (int*)PyArray_DATA(leaves);
+    const int *children_left = (int*)PyArray_DATA(self->children_left);
+    const int *tree_offsets = self->tree_offsets == NULL ? NULL : (int*)PyArray_DATA(self->tree_offsets);
+    for (npy_intp j = 0; j < num_trees; ++j) {
+        const int tree = tree_start + j;
+        const int offset = tree_offsets == NULL ? tree * self->max_nodes : tree_offsets[tree];
+        const int num_nodes = tree_offsets == NULL ? self->max_nodes : tree_offsets[tree + 1] - tree_offsets[tree];
+        for (npy_intp i = 0; i < num_rows; ++i) {
+            const int leaf = leaf_data[i * num_trees + j];
+            if (leaf < 0 || leaf >= num_nodes || children_left[offset + leaf] >= 0) {
+                PyErr_Format(PyExc_ValueError, "leaves[%ld, %ld] = %d is not a leaf of tree %d!", (long)i, (long)j, leaf, tree);
+                Py_DECREF(leaves);
+                return NULL;
+            }
+        }
+    }
+    return leaves;
+}
+
+static void CompiledEnsemble_dealloc(CompiledEnsembleObject *self)
+{
+    Py_XDECREF(self->children_left);
+    Py_XDECREF(self->children_right);
+    Py_XDECREF(self->children_default);
+    Py_XDECREF(self->features);
+    Py_XDECREF(self->thresholds);
+    Py_XDECREF(self->values);
+    Py_XDECREF(self->node_sample_weights);
+    Py_XDECREF(self->tree_offsets);
+    compiled_free_nodes(self);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int CompiledEnsemble_init(CompiledEnsembleObject *self, PyObject *args, PyObject *kwds)
+{
+    PyObject *children_left_obj;
+    PyObject *children_right_obj;
+    PyObject *children_default_obj;
+    PyObject *features_obj;
+    PyObject *thresholds_obj;
+    PyObject *values_obj;
+    PyObject *node_sample_weights_obj;
+    int max_depth;
+    double base_offset;
+    PyObject *tree_offsets_obj = Py_None;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(
+        args, "OOOOOOOid|O", &children_left_obj, &children_right_obj, &children_default_obj,
+        &features_obj, &thresholds_obj, &values_obj, &node_sample_weights_obj, &max_depth, &base_offset,
+        &tree_offsets_obj
+    )) return -1;
+
+    /* Release any arrays from a previous call to __init__. */
+    Py_CLEAR(self->children_left);
+    Py_CLEAR(self->children_right);
+    Py_CLEAR(self->children_default);
+    Py_CLEAR(self->features);
+    Py_CLEAR(self->thresholds);
+    Py_CLEAR(self->values);
+    Py_CLEAR(self->node_sample_weights);
+    Py_CLEAR(self->tree_offsets);
+    compiled_free_nodes(self);
+
+    /* Interpret the input objects as numpy arrays, keeping float32 models in float32. */
+    self->use_float32 = float32_inputs(thresholds_obj, values_obj, node_sample_weights_obj);
+    const int float_type = self->use_float32 ? NPY_FLOAT : NPY_DOUBLE;
+    self->children_left = (PyArrayObject*)PyArray_FROM_OTF(children_left_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    self->children_right = (PyArrayObject*)PyArray_FROM_OTF(children_right_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    self->children_default = (PyArrayObject*)PyArray_FROM_OTF(children_default_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    self->features = (PyArrayObject*)PyArray_FROM_OTF(features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    self->thresholds = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    self->values = (PyArrayObject*)PyArray_FROM_OTF(values_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    self->node_sample_weights = (PyArrayObject*)PyArray_FROM_OTF(node_sample_weights_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    if (tree_offsets_obj != Py_None) {
+        self->tree_offsets = (PyArrayObject*)PyArray_FROM_OTF(tree_offsets_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+        if (self->tree_offsets == NULL) return -1;
+    }
+
+    /* If that didn't work, throw an exception (the arrays are released by the destructor). */
+    if (self->children_left == NULL || self->children_right == NULL || self->children_default == NULL ||
+        self->features == NULL || self->thresholds == NULL || self->values == NULL ||
+        self->node_sample_weights == NULL) return -1;
+    if (!read_tree_layout(self->values, self->tree_offsets, self->num_trees, self->max_nodes, self->num_outputs)) {
+        return -1;
+    }
+
+    self->max_depth = max_depth;
+    self->base_offset = base_offset;
+
+    /* Pack the nodes for the traversal kernels. */
+    if (self->use_float32) compiled_pack_nodes<float>(self);
+    else compiled_pack_nodes<tfloat>(self);
+    return 0;
+}
+
+static PyObject *CompiledEnsemble_shap_values(CompiledEnsembleObject *self, PyObject *args)
+{
+    PyObject *X_obj;
+    PyObject *X_missing_obj;
+    PyObject *y_obj;
+    PyObject *R_obj;
+    PyObject *R_missing_obj;
+    int tree_limit;
+    PyObject *out_contribs_obj;
+    int feature_dependence;
+    int model_output;
+    bool interactions;
+    int num_threads;
+    int chunk_size = 0;
+    int reduce = 0;
+    PyObject *R_margins_obj = Py_None;
+    int tree_start = 0;
+    PyObject *X_leaves_obj = Py_None;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(
+        args, "OOOOOiOiibi|iiOiO", &X_obj, &X_missing_obj, &y_obj, &R_obj, &R_missing_obj, &tree_limit,
+        &out_contribs_obj, &feature_dependence, &model_output, &interactions, &num_threads, &chunk_size, &reduce,
+        &R_margins_obj, &tree_start, &X_leaves_obj
+    )) return NULL;
+    if (tree_limit < 0 || tree_limit > (int)self->num_trees) tree_limit = self->num_trees;
+    if (tree_start < 0 || tree_start > tree_limit) {
+        PyErr_SetString(PyExc_ValueError, "tree_start must be between 0 and tree_limit!");
+        return NULL;
+    }
+
+    /* Interpret the input objects as numpy arrays. X_missing is optional (NaNs are missing without it). */
+    const int float_type = self->use_float32 ? NPY_FLOAT : NPY_DOUBLE;
+    PyArrayObject *X_array = float_x_array(X_obj, float_type);
+    PyArrayObject *X_missing_array = NULL;
+    if (X_missing_obj != Py_None) X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *y_array = NULL;
+    if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *R_array = NULL;
+    if (R_obj != Py_None) R_array = (PyArrayObject*)PyArray_FROM_OTF(R_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *R_missing_array = NULL;
+    if (R_missing_obj != Py_None) R_missing_array = (PyArrayObject*)PyArray_FROM_OTF(R_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *R_margins_array = NULL;
+    if (R_margins_obj != Py_None) R_margins_array = (PyArrayObject*)PyArray_FROM_OTF(R_margins_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *out_contribs_array = (PyArrayObject*)PyArray_FROM_OTF(out_contribs_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
+    PyArrayObject *X_leaves_array = X_array == NULL ? NULL : leaves_array(
+        self, X_leaves_obj, PyArray_DIM(X_array, 0), tree_start, tree_limit
+    );
+
+    /* If that didn't work, throw an exception. Note that X_missing, R, R_margins, X_leaves and y are optional. */
+    if (X_array == NULL || (X_missing_obj != Py_None && X_missing_array == NULL) || out_contribs_array == NULL ||
+        (y_obj != Py_None && y_array == NULL) || (R_obj != Py_None && R_array == NULL) ||
+        (R_missing_obj != Py_None && R_missing_array == NULL) || (R_margins_obj != Py_None && R_margins_array == NULL) ||
+        (X_leaves_obj != Py_None && X_leaves_array == NULL)) {
+        Py_XDECREF(X_array);
+        Py_XDECREF(X_missing_array);
+        Py_XDECREF(y_array);
+        Py_XDECREF(R_array);
+        Py_XDECREF(R_missing_array);
+        Py_XDECREF(R_margins_array);
+        Py_XDECREF(X_leaves_array);
+        Py_XDECREF(out_contribs_array);
+        return NULL;
+    }
+    if (R_margins_array != NULL && (R_array == NULL ||
+        PyArray_SIZE(R_margins_array) != PyArray_DIM(R_array, 0) * (npy_intp)self->num_outputs)) {
+        PyErr_SetString(PyExc_ValueError, "R_margins must hold one margin per background sample and model output!");
+        Py_XDECREF(X_array);
+        Py_XDECREF(X_missing_array);
+        Py_XDECREF(y_array);
+        Py_XDECREF(R_array);
+        Py_XDECREF(R_missing_array);
+        Py_XDECREF(R_margins_array);
+        Py_XDECREF(X_leaves_array);
+        Py_XDECREF(out_contribs_array);
+        return NULL;
+    }
+
+    /* The unique features of each tree are only needed for interactions, so build them on first use. */
+    if (interactions && self->unique_features == NULL) {
+        if (self->use_float32) compiled_fill_unique_features<float>(self);
+        else compiled_fill_unique_features<tfloat>(self);
+    }
+
+    // the rows of the output for each block of X, except for reductions (which all add to the same matrix)
+    tfloat *out_contribs = (tfloat*)PyArray_DATA(out_contribs_array);
+    const unsigned M = PyArray_DIM(X_array, 1);
+    const size_t row_size = (interactions && reduce != INTERACTION_REDUCE::none) ? 0 :
+        (size_t)(M + 1) * self->num_outputs * (interactions ? M + 1 : 1);
+
+    if (self->use_float32) {
+        TreeEnsemble<float> trees = compiled_trees<float>(self, tree_limit, tree_start);
+        ExplanationDataset<float> data = compiled_dataset<float>(X_array, X_missing_array, y_array, R_array, R_missing_array);
+        if (R_margins_array != NULL) data.R_margins = (tfloat*)PyArray_DATA(R_margins_array);
+        if (X_leaves_array != NULL) {
+            data.X_leaves = (int*)PyArray_DATA(X_leaves_array);
+            data.num_leaf_trees = tree_limit - tree_start;
+        }
+        Py_BEGIN_ALLOW_THREADS
+        for_x_blocks(X_array, data, num_threads, [&](const ExplanationDataset<float> &slice, unsigned start) {
+            dense_tree_shap(
+                trees, slice, out_contribs + start * row_size, feature_dependence, model_output, interactions,
+                num_threads, chunk_size, reduce, self->path_tables
+            );
+        });
+        Py_END_ALLOW_THREADS
+    } else {
+        TreeEnsemble<tfloat> trees = compiled_trees<tfloat>(self, tree_limit, tree_start);
+        ExplanationDataset<tfloat> data = compiled_dataset<tfloat>(X_array, X_missing_array, y_array, R_array, R_missing_array);
+        if (R_margins_array != NULL) data.R_margins = (tfloat*)PyArray_DATA(R_margins_array);
+        if (X_leaves_array != NULL) {
+            data.X_leaves = (int*)PyArray_DATA(X_leaves_array);
+            data.num_leaf_trees = tree_limit - tree_start;
+        }
+        Py_BEGIN_ALLOW_THREADS
+        for_x_blocks(X_array, data, num_threads, [&](const ExplanationDataset<tfloat> &slice, unsigned start) {
+            dense_tree_shap(
+                trees, slice, out_contribs + start * row_size, feature_dependence, model_output, interactions,
+                num_threads, chunk_size, reduce, self->path_tables
+            );
+        });
+        Py_END_ALLOW_THREADS
+    }
+
+    // clean up the created python objects
+    Py_XDECREF(X_array);
+    Py_XDECREF(X_missing_array);
+    Py_XDECREF(y_array);
+    Py_XDECREF(R_array);
+    Py_XDECREF(R_missing_array);
+    Py_XDECREF(R_margins_array);
+    Py_XDECREF(X_leaves_array);
+    Py_XDECREF(out_contribs_array);
+
+    Py_RETURN_NONE;
+}
+
+/* predict and saabas share the same arguments and only differ in the kernel they run. */
+static PyObject *compiled_ensemble_row_op(CompiledEnsembleObject *self, PyObject *args, bool saabas)
+{
+    PyObject *X_obj;
+    PyObject *X_missing_obj;
+    PyObject *y_obj;
+    int tree_limit;
+    int model_output;
+    PyObject *out_obj;
+    int num_threads = 1;
+    PyObject *X_leaves_obj = Py_None;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(
+        args, "OOOiiO|iO", &X_obj, &X_missing_obj, &y_obj, &tree_limit, &model_output, &out_obj, &num_threads,
+        &X_leaves_obj
+    )) return NULL;
+    if (tree_limit < 0 || tree_limit > (int)self->num_trees) tree_limit = self->num_trees;
+    if (saabas && X_leaves_obj != Py_None) {
+        PyErr_SetString(PyExc_ValueError, "Saabas values need the whole path of each sample, not just its leaves!");
+        return NULL;
+    }
+
+    /* Interpret the input objects as numpy arrays. X_missing is optional (NaNs are missing without it). */
+    const int float_type = self->use_float32 ? NPY_FLOAT : NPY_DOUBLE;
+    PyArrayObject *X_array = float_x_array(X_obj, float_type);
+    PyArrayObject *X_missing_array = NULL;
+    if (X_missing_obj != Py_None) X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *y_array = NULL;
+    if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *out_array = (PyArrayObject*)PyArray_FROM_OTF(out_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
+    PyArrayObject *X_leaves_array = X_array == NULL ? NULL : leaves_array(self, X_leaves_obj, PyArray_DIM(X_array, 0), 0, tree_limit);
+
+    /* If that didn't work, throw an exception. Note that X_missing, X_leaves and y are optional. */
+    if (X_array == NULL || (X_missing_obj != Py_None && X_missing_array == NULL) || out_array == NULL ||
+        (y_obj != Py_None && y_array == NULL) || (X_leaves_obj != Py_None && X_leaves_array == NULL)) {
+        Py_XDECREF(X_array);
+        Py_XDECREF(X_missing_array);
+        Py_XDECREF(y_array);
+        Py_XDECREF(X_leaves_array);
+        Py_XDECREF(out_array);
+        return NULL;
+    }
+
+    tfloat *out = (tfloat*)PyArray_DATA(out_array);
+    const size_t row_size = saabas ? (size_t)(PyArray_DIM(X_array, 1) + 1) * self->num_outputs : self->num_outputs;
+    if (self->use_float32) {
+        TreeEnsemble<float> trees = compiled_trees<float>(self, tree_limit);
+        ExplanationDataset<float> data = compiled_dataset<float>(X_array, X_missing_array, y_array, NULL, NULL);
+        if (X_leaves_array != NULL) {
+            data.X_leaves = (int*)PyArray_DATA(X_leaves_array);
+            data.num_leaf_trees = tree_limit;
+        }
+        Py_BEGIN_ALLOW_THREADS
+        for_x_blocks(X_array, data, num_threads, [&](const ExplanationDataset<float> &slice, unsigned start) {
+            if (saabas) dense_tree_saabas(out + start * row_size, trees, slice, num_threads);
+            else dense_tree_predict(out + start * row_size, trees, slice, model_output, num_threads);
+        });
+        Py_END_ALLOW_THREADS
+    } else {
+        TreeEnsemble<tfloat> trees = compiled_trees<tfloat>(self, tree_limit);
+        ExplanationDataset<tfloat> data = compiled_dataset<tfloat>(X_array, X_missing_array, y_array, NULL, NULL);
+        if (X_leaves_array != NULL) {
+            data.X_leaves = (int*)PyArray_DATA(X_leaves_array);
+            data.num_leaf_trees = tree_limit;
+        }
+        Py_BEGIN_ALLOW_THREADS
+        for_x_blocks(X_array, data, num_threads, [&](const ExplanationDataset<tfloat> &slice, unsigned start) {
+            if (saabas) dense_tree_saabas(out + start * row_size, trees, slice, num_threads);
+            else dense_tree_predict(out + start * row_size, trees, slice, model_output, num_threads);
+        });
+        Py_END_ALLOW_THREADS
+    }
+
+    // clean up the created python objects
+    Py_XDECREF(X_array);
+    Py_XDECREF(X_missing_array);
+    Py_XDECREF(y_array);
+    Py_XDECREF(X_leaves_array);
+    Py_XDECREF(out_array);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *CompiledEnsemble_apply(CompiledEnsembleObject *self, PyObject *args)
+{
+    PyObject *X_obj;
+    PyObject *X_missing_obj;
+    int tree_limit;
+    PyObject *out_obj;
+    int num_threads = 1;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(args, "OOiO|i", &X_obj, &X_missing_obj, &tree_limit, &out_obj, &num_threads)) return NULL;
+    if (tree_limit < 0 || tree_limit > (int)self->num_trees) tree_limit = self->num_trees;
+
+    /* Interpret the input objects as numpy arrays. X_missing is optional (NaNs are missing without it). */
+    const int float_type = self->use_float32 ? NPY_FLOAT : NPY_DOUBLE;
+    PyArrayObject *X_array = float_x_array(X_obj, float_type);
+    PyArrayObject *X_missing_array = NULL;
+    if (X_missing_obj != Py_None) X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *out_array = (PyArrayObject*)PyArray_FROM_OTF(out_obj, NPY_INT, NPY_ARRAY_INOUT_ARRAY);
+
+    /* If that didn't work, throw an exception. Note that X_missing is optional. */
+    if (X_array == NULL || (X_missing_obj != Py_None && X_missing_array == NULL) || out_array == NULL) {
+        Py_XDECREF(X_array);
+        Py_XDECREF(X_missing_array);
+        Py_XDECREF(out_array);
+        return NULL;
+    }
+    if (PyArray_SIZE(out_array) != PyArray_DIM(X_array, 0) * (npy_intp)tree_limit) {
+        PyErr_SetString(PyExc_ValueError, "out_leaves must have a (# samples x # trees) shape!");
+        Py_XDECREF(X_array);
+        Py_XDECREF(X_missing_array);
+        Py_XDECREF(out_array);
+        return NULL;
+    }
+
+    int *out = (int*)PyArray_DATA(out_array);
+    if (self->use_float32) {
+        TreeEnsemble<float> trees = compiled_trees<float>(self, tree_limit);
+        ExplanationDataset<float> data = compiled_dataset<float>(X_array, X_missing_array, NULL, NULL, NULL);
+        Py_BEGIN_ALLOW_THREADS
+        for_x_blocks(X_array, data, num_threads, [&](const ExplanationDataset<float> &slice, unsigned start) {
+            dense_tree_apply(out + (size_t)start * tree_limit, trees, slice, num_threads);
+        });
+        Py_END_ALLOW_THREADS
+    } else {
+        TreeEnsemble<tfloat> trees = compiled_trees<tfloat>(self, tree_limit);
+        ExplanationDataset<tfloat> data = compiled_dataset<tfloat>(X_array, X_missing_array, NULL, NULL, NULL);
+        Py_BEGIN_ALLOW_THREADS
+        for_x_blocks(X_array, data, num_threads, [&](const ExplanationDataset<tfloat> &slice, unsigned start) {
+            dense_tree_apply(out + (size_t)start * tree_limit, trees, slice, num_threads);
+        });
+        Py_END_ALLOW_THREADS
+    }
+
+    // clean up the created python objects
+    Py_XDECREF(X_array);
+    Py_XDECREF(X_missing_array);
+    Py_XDECREF(out_array);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *CompiledEnsemble_predict(CompiledEnsembleObject *self, PyObject *args)
+{
+    return compiled_ensemble_row_op(self, args, false);
+}
+
+static PyObject *CompiledEnsemble_saabas(CompiledEnsembleObject *self, PyObject *args)
+{
+    return compiled_ensemble_row_op(self, args, true);
+}
+
+static PyObject *CompiledEnsemble_per_tree_shap_values(CompiledEnsembleObject *self, PyObject *args)
+{
+    PyObject *X_obj;
+    PyObject *X_missing_obj;
+    int tree_limit;
+    PyObject *out_obj;
+    bool absolute;
+    int num_threads = 1;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(
+        args, "OOiOb|i", &X_obj, &X_missing_obj, &tree_limit, &out_obj, &absolute, &num_threads
+    )) return NULL;
+
+    /* Interpret the input objects as numpy arrays. X_missing is optional (NaNs are missing without it). */
+    const int float_type = self->use_float32 ? NPY_FLOAT : NPY_DOUBLE;
+    PyArrayObject *X_array = float_x_array(X_obj, float_type);
+    PyArrayObject *X_missing_array = NULL;
+    if (X_missing_obj != Py_None) X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *out_array = (PyArrayObject*)PyArray_FROM_OTF(out_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
+
+    /* If that didn't work, throw an exception. Note that X_missing is optional. */
+    if (X_array == NULL || (X_missing_obj != Py_None && X_missing_array == NULL) || out_array == NULL) {
+        Py_XDECREF(X_array);
+        Py_XDECREF(X_missing_array);
+        Py_XDECREF(out_array);
+        return NULL;
+    }
+
+    /* The sums are split up by the unique features of each tree, so build them on first use. */
+    if (self->unique_features == NULL) {
+        if (self->use_float32) compiled_fill_unique_features<float>(self);
+        else compiled_fill_unique_features<tfloat>(self);
+    }
+
+    // every block of X sums into the same (# trees x M x # outputs) matrix
+    tfloat *out = (tfloat*)PyArray_DATA(out_array);
+    if (self->use_float32) {
+        TreeEnsemble<float> trees = compiled_trees<float>(self, tree_limit);
+        ExplanationDataset<float> data = compiled_dataset<float>(X_array, X_missing_array, NULL, NULL, NULL);
+        Py_BEGIN_ALLOW_THREADS
+        for_x_blocks(X_array, data, num_threads, [&](const ExplanationDataset<float> &slice, unsigned start) {
+            dense_tree_shap_per_tree(trees, slice, out, absolute, num_threads, self->path_tables);
+        });
+        Py_END_ALLOW_THREADS
+    } else {
+        TreeEnsemble<tfloat> trees = compiled_trees<tfloat>(self, tree_limit);
+        ExplanationDataset<tfloat> data = compiled_dataset<tfloat>(X_array, X_missing_array, NULL, NULL, NULL);
+        Py_BEGIN_ALLOW_THREADS
+        for_x_blocks(X_array, data, num_threads, [&](const ExplanationDataset<tfloat> &slice, unsigned start) {
+            dense_tree_shap_per_tree(trees, slice, out, absolute, num_threads, self->path_tables);
+        });
+        Py_END_ALLOW_THREADS
+    }
+
+    // clean up the created python objects
+    Py_XDECREF(X_array);
+    Py_XDECREF(X_missing_array);
+    Py_XDECREF(out_array);
+
+    Py_RETURN_NONE;
+}
+
+static PyObject *CompiledEnsemble_build_path_tables(CompiledEnsembleObject *self, PyObject *args)
+{
+    long long max_entries;
+    if (!PyArg_ParseTuple(args, "L", &max_entries)) return NULL;
+
+    /* The tables only depend on the trees, so they are built at most once. */
+    if (self->path_tables == NULL && max_entries > self->path_tables_too_large) {
+        PathTables *tables = new PathTables();
+        bool built;
+        Py_BEGIN_ALLOW_THREADS
+        if (self->use_float32) built = build_path_tables(*tables, compiled_trees<float>(self, -1), max_entries);
+        else built = build_path_tables(*tables, compiled_trees<tfloat>(self, -1), max_entries);
+        Py_END_ALLOW_THREADS
+
+        // another thread may have built them while we held no GIL, in which case ours are a duplicate
+        if (built && self->path_tables == NULL) self->path_tables = tables;
+        else {
+            delete tables;
+            if (!built) self->path_tables_too_large = std::max(self->path_tables_too_large, max_entries);
+        }
+    }
+    return PyBool_FromLong(self->path_tables != NULL);
+}
+
+/* Copies a vector into a new 1D numpy array. */
+template <typename V>
+static PyObject *vector_to_array(const std::vector<V> &vec, int type_num)
+{
+    npy_intp dims[1] = {(npy_intp)vec.size()};
+    PyObject *array = PyArray_SimpleNew(1, dims, type_num);
+    if (array != NULL && !vec.empty()) {
+        std::copy(vec.begin(), vec.end(), (V*)PyArray_DATA((PyArrayObject*)array));
+    }
+    return array;
+}
+
+static PyObject *CompiledEnsemble_sparse_shap_values(CompiledEnsembleObject *self, PyObject *args)
+{
+    PyObject *data_obj;
+    PyObject *indices_obj;
+    PyObject *indptr_obj;
+    int num_cols;
+    int tree_limit;
+    bool approximate;
+    int top_k;
+    PyObject *out_bias_obj;
+    int num_threads = 1;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(
+        args, "OOOiibiO|i", &data_obj, &indices_obj, &indptr_obj, &num_cols, &tree_limit, &approximate,
+        &top_k, &out_bias_obj, &num_threads
+    )) return NULL;
+
+    /* Interpret the input objects as numpy arrays. */
+    const int float_type = self->use_float32 ? NPY_FLOAT : NPY_DOUBLE;
+    PyArrayObject *data_array = (PyArrayObject*)PyArray_FROM_OTF(data_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *indices_array = (PyArrayObject*)PyArray_FROM_OTF(indices_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *indptr_array = (PyArrayObject*)PyArray_FROM_OTF(indptr_obj, NPY_LONGLONG, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *out_bias_array = (PyArrayObject*)PyArray_FROM_OTF(out_bias_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
+
+    /* If that didn't work, throw an exception. */
+    if (data_array == NULL || indices_array == NULL || indptr_array == NULL || out_bias_array == NULL) {
+        Py_XDECREF(data_array);
+        Py_XDECREF(indices_array);
+        Py_XDECREF(indptr_array);
+        Py_XDECREF(out_bias_array);
+        return NULL;
+    }
+
+    const unsigned num_X = PyArray_DIM(indptr_array, 0) - 1;
+    const int *indices = (int*)PyArray_DATA(indices_array);
+    const long long *indptr = (long long*)PyArray_DATA(indptr_array);
+    tfloat *out_bias = (tfloat*)PyArray_DATA(out_bias_array);
+    SparseContribs contribs;
+    if (self->use_float32) {
+        TreeEnsemble<float> trees = compiled_trees<float>(self, tree_limit);
+        SparseDataset<float> data = SparseDataset<float>(
+            (float*)PyArray_DATA(data_array), indices, indptr, num_X, num_cols
+        );
+        Py_BEGIN_ALLOW_THREADS
+        sparse_tree_shap(trees, data, contribs, out_bias, approximate, top_k, num_threads, self->path_tables);
+        Py_END_ALLOW_THREADS
+    } else {
+        TreeEnsemble<tfloat> trees = compiled_trees<tfloat>(self, tree_limit);
+        SparseDataset<tfloat> data = SparseDataset<tfloat>(
+            (tfloat*)PyArray_DATA(data_array), indices, indptr, num_X, num_cols
+        );
+        Py_BEGIN_ALLOW_THREADS
+        sparse_tree_shap(trees, data, contribs, out_bias, approximate, top_k, num_threads, self->path_tables);
+        Py_END_ALLOW_THREADS
+    }
+
+    // clean up the created python objects
+    Py_XDECREF(data_array);
+    Py_XDECREF(indices_array);
+    Py_XDECREF(indptr_array);
+    Py_XDECREF(out_bias_array);
+
+    /* Build the output tuple of CSR arrays */
+    PyObject *out_indptr = vector_to_array(contribs.indptr, NPY_LONGLONG);
+    PyObject *out_indices = vector_to_array(contribs.indices, NPY_INT);
+    PyObject *out_values = vector_to_array(contribs.values, NPY_DOUBLE);
+    if (out_indptr == NULL || out_indices == NULL || out_values == NULL) {
+        Py_XDECREF(out_indptr);
+        Py_XDECREF(out_indices);
+        Py_XDECREF(out_values);
+        return NULL;
+    }
+    return Py_BuildValue("NNN", out_indptr, out_indices, out_values);
+}
+
+static PyMethodDef CompiledEnsemble_methods[] = {
+    {"shap_values", (PyCFunction)CompiledEnsemble_shap_values, METH_VARARGS,
+     "shap_values(X, X_missing, y, R, R_missing, tree_limit, out_contribs, feature_dependence, model_output, interactions, num_threads[, chunk_size, reduce, R_margins, tree_start, X_leaves])"},
+    {"predict", (PyCFunction)CompiledEnsemble_predict, METH_VARARGS,
+     "predict(X, X_missing, y, tree_limit, model_output, out_pred[, num_threads, X_leaves])"},
+    {"apply", (PyCFunction)CompiledEnsemble_apply, METH_VARARGS,
+     "apply(X, X_missing, tree_limit, out_leaves[, num_threads]), the leaf (node index within its tree) each row "
+     "of X reaches in each tree, as an int32 (# samples x # trees) matrix"},
+    {"saabas", (PyCFunction)CompiledEnsemble_saabas, METH_VARARGS,
+     "saabas(X, X_missing, y, tree_limit, model_output, out_contribs[, num_threads])"},
+    {"sparse_shap_values", (PyCFunction)CompiledEnsemble_sparse_shap_values, METH_VARARGS,
+     "sparse_shap_values(data, indices, indptr, num_cols, tree_limit, approximate, top_k, out_bias[, num_threads]) "
+     "-> (indptr, indices, values), path dependent Tree SHAP or Saabas values of the rows of a CSR matrix as a CSR matrix"},
+    {"per_tree_shap_values", (PyCFunction)CompiledEnsemble_per_tree_shap_values, METH_VARARGS,
+     "per_tree_shap_values(X, X_missing, tree_limit, out_contribs, absolute[, num_threads]), sum the (absolute) "
+     "path dependent Tree SHAP values of the rows of X separately for each tree into out_contribs (# trees x M x # outputs)"},
+    {"build_path_tables", (PyCFunction)CompiledEnsemble_build_path_tables, METH_VARARGS,
+     "build_path_tables(max_entries) -> bool, precompute the per leaf tables path dependent Tree SHAP then uses "
+     "(when they take at most max_entries doubles)"},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyTypeObject CompiledEnsembleType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+};
+
+static int init_compiled_ensemble_type(void)
+{
+    CompiledEnsembleType.tp_name = "shap._cext.CompiledEnsemble";
+    CompiledEnsembleType.tp_doc = "A tree ensemble prepared once for repeated Tree SHAP, Saabas and prediction calls.\n\n"
+        "CompiledEnsemble(children_left, children_right, children_default, features, thresholds, values, "
+        "node_sample_weights, max_depth, base_offset, tree_offsets=None)";
+    CompiledEnsembleType.tp_basicsize = sizeof(CompiledEnsembleObject);
+    CompiledEnsembleType.tp_flags = Py_TPFLAGS_DEFAULT;
+    CompiledEnsembleType.tp_new = PyType_GenericNew;
+    CompiledEnsembleType.tp_init = (initproc)CompiledEnsemble_init;
+    CompiledEnsembleType.tp_dealloc = (destructor)CompiledEnsemble_dealloc;
+    CompiledEnsembleType.tp_methods = CompiledEnsemble_methods;
+    return PyType_Ready(&CompiledEnsembleType);
+}
+
+
 #if PY_MAJOR_VERSION >= 3
 static struct PyModuleDef moduledef = {
     PyModuleDef_HEAD_INIT,
@@ -51,6 +875,12 @@ PyMODINIT_FUNC init_cext(void)
     /* Load `numpy` functionality. */
     import_array();
 
+    /* Register the CompiledEnsemble type. */
+    if (init_compiled_ensemble_type() >= 0) {
+        Py_INCREF(&CompiledEnsembleType);
+        PyModule_AddObject(module, "CompiledEnsemble", (PyObject*)&CompiledEnsembleType);
+    }
+
     #if PY_MAJOR_VERSION >= 3
         return module;
     #endif
@@ -85,7 +915,7 @@ static PyObject *_cext_compute_expectations(PyObject *self, PyObject *args)
         return NULL;
     }
 
-    TreeEnsemble tree;
+    TreeEnsemble<> tree;
 
     // number of outputs
     tree.num_outputs = PyArray_DIM(values_array, 1);
@@ -131,38 +961,48 @@ static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args)
     int model_output;
     double base_offset;
     bool interactions;
-  
+    int num_threads;
+    PyObject *tree_offsets_obj = Py_None;
+
     /* Parse the input tuple */
     if (!PyArg_ParseTuple(
-        args, "OOOOOOOiOOOOOidOiib", &children_left_obj, &children_right_obj, &children_default_obj,
+        args, "OOOOOOOiOOOOOidOiibi|O", &children_left_obj, &children_right_obj, &children_default_obj,
         &features_obj, &thresholds_obj, &values_obj, &node_sample_weights_obj,
         &max_depth, &X_obj, &X_missing_obj, &y_obj, &R_obj, &R_missing_obj, &tree_limit, &base_offset,
-        &out_contribs_obj, &feature_dependence, &model_output, &interactions
+        &out_contribs_obj, &feature_dependence, &model_output, &interactions, &num_threads, &tree_offsets_obj
     )) return NULL;
 
-    /* Interpret the input objects as numpy arrays. */
+    /* Interpret the input objects as numpy arrays (float32 inputs are not copied to float64). */
+    const bool use_float32 = float32_inputs(X_obj, thresholds_obj, values_obj);
+    const int float_type = use_float32 ? NPY_FLOAT : NPY_DOUBLE;
     PyArrayObject *children_left_array = (PyArrayObject*)PyArray_FROM_OTF(children_left_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *children_right_array = (PyArrayObject*)PyArray_FROM_OTF(children_right_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *children_default_array = (PyArrayObject*)PyArray_FROM_OTF(children_default_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *features_array = (PyArrayObject*)PyArray_FROM_OTF(features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *node_sample_weights_array = (PyArrayObject*)PyArray_FROM_OTF(node_sample_weights_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *node_sample_weights_array = (PyArrayObject*)PyArray_FROM_OTF(node_sample_weights_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, float_type, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *y_array = NULL;
     if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *R_array = NULL;
-    if (R_obj != Py_None) R_array = (PyArrayObject*)PyArray_FROM_OTF(R_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    if (R_obj != Py_None) R_array = (PyArrayObject*)PyArray_FROM_OTF(R_obj, float_type, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *R_missing_array = NULL;
     if (R_missing_obj != Py_None) R_missing_array = (PyArrayObject*)PyArray_FROM_OTF(R_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *out_contribs_array = (PyArrayObject*)PyArray_FROM_OTF(out_contribs_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
+    PyArrayObject *tree_offsets_array = NULL;
+    if (tree_offsets_obj != Py_None) tree_offsets_array = (PyArrayObject*)PyArray_FROM_OTF(tree_offsets_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+
+    unsigned num_trees, max_nodes, num_outputs;
 
     /* If that didn't work, throw an exception. Note that R and y are optional. */
     if (children_left_array == NULL || children_right_array == NULL ||
         children_default_array == NULL || features_array == NULL || thresholds_array == NULL ||
         values_array == NULL || node_sample_weights_array == NULL || X_array == NULL ||
-        X_missing_array == NULL || out_contribs_array == NULL) {
+        X_missing_array == NULL || out_contribs_array == NULL ||
+        (tree_offsets_obj != Py_None && tree_offsets_array == NULL) ||
+        !read_tree_layout(values_array, tree_offsets_array, num_trees, max_nodes, num_outputs)) {
         Py_XDECREF(children_left_array);
         Py_XDECREF(children_right_array);
         Py_XDECREF(children_default_array);
@@ -177,13 +1017,13 @@ static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args)
         if (R_missing_array != NULL) Py_XDECREF(R_missing_array);
         //PyArray_ResolveWritebackIfCopy(out_contribs_array);
         Py_XDECREF(out_contribs_array);
+        Py_XDECREF(tree_offsets_array);
         return NULL;
     }
 
     const unsigned num_X = PyArray_DIM(X_array, 0);
     const unsigned M = PyArray_DIM(X_array, 1);
-    const unsigned max_nodes = PyArray_DIM(values_array, 1);
-    const unsigned num_outputs = PyArray_DIM(values_array, 2);
+    if (tree_limit < 0 || tree_limit > (int)num_trees) tree_limit = num_trees;
     unsigned num_R = 0;
     if (R_array != NULL) num_R = PyArray_DIM(R_array, 0);
 
@@ -192,32 +1032,51 @@ static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args)
     int *children_right = (int*)PyArray_DATA(children_right_array);
     int *children_default = (int*)PyArray_DATA(children_default_array);
     int *features = (int*)PyArray_DATA(features_array);
-    tfloat *thresholds = (tfloat*)PyArray_DATA(thresholds_array);
-    tfloat *values = (tfloat*)PyArray_DATA(values_array);
-    tfloat *node_sample_weights = (tfloat*)PyArray_DATA(node_sample_weights_array);
-    tfloat *X = (tfloat*)PyArray_DATA(X_array);
+    int *tree_offsets = tree_offsets_array == NULL ? NULL : (int*)PyArray_DATA(tree_offsets_array);
     bool *X_missing = (bool*)PyArray_DATA(X_missing_array);
     tfloat *y = NULL;
     if (y_array != NULL) y = (tfloat*)PyArray_DATA(y_array);
-    tfloat *R = NULL;
-    if (R_array != NULL) R = (tfloat*)PyArray_DATA(R_array);
     bool *R_missing = NULL;
     if (R_missing_array != NULL) R_missing = (bool*)PyArray_DATA(R_missing_array);
     tfloat *out_contribs = (tfloat*)PyArray_DATA(out_contribs_array);
+    void *R = R_array == NULL ? NULL : PyArray_DATA(R_array);
 
     // these are just a wrapper objects for all the pointers and numbers associated with
-    // the ensemble tree model and the datset we are explaing
-    TreeEnsemble trees = TreeEnsemble(
-        children_left, children_right, children_default, features, thresholds, values,
-        node_sample_weights, max_depth, tree_limit, base_offset,
-        max_nodes, num_outputs
-    );
-    ExplanationDataset data = ExplanationDataset(X, X_missing, y, R, R_missing, num_X, M, num_R);
-
-    dense_tree_shap(trees, data, out_contribs, feature_dependence, model_output, interactions);
-
-    // retrieve return value before python cleanup of objects
-    tfloat ret_value = (double)values[0];
+    // the ensemble tree model and the datset we are explaing (we release the GIL while we compute)
+    tfloat ret_value;
+    if (use_float32) {
+        TreeEnsemble<float> trees = TreeEnsemble<float>(
+            children_left, children_right, children_default, features, (float*)PyArray_DATA(thresholds_array),
+            (float*)PyArray_DATA(values_array), (float*)PyArray_DATA(node_sample_weights_array),
+            max_depth, tree_limit, base_offset, max_nodes, num_outputs,
+            tree_offsets
+        );
+        ExplanationDataset<float> data = ExplanationDataset<float>(
+            (float*)PyArray_DATA(X_array), X_missing, y, (float*)R, R_missing, num_X, M, num_R
+        );
+        Py_BEGIN_ALLOW_THREADS
+        trees.pack_nodes();
+        dense_tree_shap(trees, data, out_contribs, feature_dependence, model_output, interactions, num_threads);
+        trees.free_nodes();
+        Py_END_ALLOW_THREADS
+        ret_value = trees.values[0];
+    } else {
+        TreeEnsemble<tfloat> trees = TreeEnsemble<tfloat>(
+            children_left, children_right, children_default, features, (tfloat*)PyArray_DATA(thresholds_array),
+            (tfloat*)PyArray_DATA(values_array), (tfloat*)PyArray_DATA(node_sample_weights_array),
+            max_depth, tree_limit, base_offset, max_nodes, num_outputs,
+            tree_offsets
+        );
+        ExplanationDataset<tfloat> data = ExplanationDataset<tfloat>(
+            (tfloat*)PyArray_DATA(X_array), X_missing, y, (tfloat*)R, R_missing, num_X, M, num_R
+        );
+        Py_BEGIN_ALLOW_THREADS
+        trees.pack_nodes();
+        dense_tree_shap(trees, data, out_contribs, feature_dependence, model_output, interactions, num_threads);
+        trees.free_nodes();
+        Py_END_ALLOW_THREADS
+        ret_value = trees.values[0];
+    }
 
     // clean up the created python objects 
     Py_XDECREF(children_left_array);
@@ -234,6 +1093,7 @@ static PyObject *_cext_dense_tree_shap(PyObject *self, PyObject *args)
     if (R_missing_array != NULL) Py_XDECREF(R_missing_array);
     //PyArray_ResolveWritebackIfCopy(out_contribs_array);
     Py_XDECREF(out_contribs_array);
+    Py_XDECREF(tree_offsets_array);
 
     /* Build the output tuple */
     PyObject *ret = Py_BuildValue("d", ret_value);
@@ -257,34 +1117,41 @@ static PyObject *_cext_dense_tree_predict(PyObject *self, PyObject *args)
     PyObject *X_missing_obj;
     PyObject *y_obj;
     PyObject *out_pred_obj;
-    
-    
-  
+    PyObject *tree_offsets_obj = Py_None;
+
     /* Parse the input tuple */
     if (!PyArg_ParseTuple(
-        args, "OOOOOOiidiOOOO", &children_left_obj, &children_right_obj, &children_default_obj,
+        args, "OOOOOOiidiOOOO|O", &children_left_obj, &children_right_obj, &children_default_obj,
         &features_obj, &thresholds_obj, &values_obj, &max_depth, &tree_limit, &base_offset, &model_output,
-        &X_obj, &X_missing_obj, &y_obj, &out_pred_obj
+        &X_obj, &X_missing_obj, &y_obj, &out_pred_obj, &tree_offsets_obj
     )) return NULL;
 
-    /* Interpret the input objects as numpy arrays. */
+    /* Interpret the input objects as numpy arrays (float32 inputs are not copied to float64). */
+    const bool use_float32 = float32_inputs(X_obj, thresholds_obj, values_obj);
+    const int float_type = use_float32 ? NPY_FLOAT : NPY_DOUBLE;
     PyArrayObject *children_left_array = (PyArrayObject*)PyArray_FROM_OTF(children_left_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *children_right_array = (PyArrayObject*)PyArray_FROM_OTF(children_right_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *children_default_array = (PyArrayObject*)PyArray_FROM_OTF(children_default_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *features_array = (PyArrayObject*)PyArray_FROM_OTF(features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, float_type, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *y_array = NULL;
     if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *out_pred_array = (PyArrayObject*)PyArray_FROM_OTF(out_pred_obj, NPY_DOUBLE, NPY_ARRAY_INOUT_ARRAY);
+    PyArrayObject *tree_offsets_array = NULL;
+    if (tree_offsets_obj != Py_None) tree_offsets_array = (PyArrayObject*)PyArray_FROM_OTF(tree_offsets_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+
+    unsigned num_trees, max_nodes, num_outputs;
 
     /* If that didn't work, throw an exception. Note that R and y are optional. */
     if (children_left_array == NULL || children_right_array == NULL ||
         children_default_array == NULL || features_array == NULL || thresholds_array == NULL ||
         values_array == NULL || X_array == NULL ||
-        X_missing_array == NULL || out_pred_array == NULL) {
+        X_missing_array == NULL || out_pred_array == NULL ||
+        (tree_offsets_obj != Py_None && tree_offsets_array == NULL) ||
+        !read_tree_layout(values_array, tree_offsets_array, num_trees, max_nodes, num_outputs)) {
         Py_XDECREF(children_left_array);
         Py_XDECREF(children_right_array);
         Py_XDECREF(children_default_array);
@@ -296,22 +1163,20 @@ static PyObject *_cext_dense_tree_predict(PyObject *self, PyObject *args)
         if (y_array != NULL) Py_XDECREF(y_array);
         //PyArray_ResolveWritebackIfCopy(out_pred_array);
         Py_XDECREF(out_pred_array);
+        Py_XDECREF(tree_offsets_array);
         return NULL;
     }
 
     const unsigned num_X = PyArray_DIM(X_array, 0);
     const unsigned M = PyArray_DIM(X_array, 1);
-    const unsigned max_nodes = PyArray_DIM(values_array, 1);
-    const unsigned num_outputs = PyArray_DIM(values_array, 2);
+    if (tree_limit < 0 || tree_limit > (int)num_trees) tree_limit = num_trees;
 
     // Get pointers to the data as C-types
     int *children_left = (int*)PyArray_DATA(children_left_array);
     int *children_right = (int*)PyArray_DATA(children_right_array);
     int *children_default = (int*)PyArray_DATA(children_default_array);
     int *features = (int*)PyArray_DATA(features_array);
-    tfloat *thresholds = (tfloat*)PyArray_DATA(thresholds_array);
-    tfloat *values = (tfloat*)PyArray_DATA(values_array);
-    tfloat *X = (tfloat*)PyArray_DATA(X_array);
+    int *tree_offsets = tree_offsets_array == NULL ? NULL : (int*)PyArray_DATA(tree_offsets_array);
     bool *X_missing = (bool*)PyArray_DATA(X_missing_array);
     tfloat *y = NULL;
     if (y_array != NULL) y = (tfloat*)PyArray_DATA(y_array);
@@ -319,14 +1184,34 @@ static PyObject *_cext_dense_tree_predict(PyObject *self, PyObject *args)
 
     // these are just wrapper objects for all the pointers and numbers associated with
     // the ensemble tree model and the datset we are explaing
-    TreeEnsemble trees = TreeEnsemble(
-        children_left, children_right, children_default, features, thresholds, values,
-        NULL, max_depth, tree_limit, base_offset,
-        max_nodes, num_outputs
-    );
-    ExplanationDataset data = ExplanationDataset(X, X_missing, y, NULL, NULL, num_X, M, 0);
-
-    dense_tree_predict(out_pred, trees, data, model_output);
+    tfloat ret_value;
+    if (use_float32) {
+        TreeEnsemble<float> trees = TreeEnsemble<float>(
+            children_left, children_right, children_default, features, (float*)PyArray_DATA(thresholds_array),
+            (float*)PyArray_DATA(values_array), NULL, max_depth, tree_limit, base_offset, max_nodes, num_outputs,
+            tree_offsets
+        );
+        ExplanationDataset<float> data = ExplanationDataset<float>(
+            (float*)PyArray_DATA(X_array), X_missing, y, NULL, NULL, num_X, M, 0
+        );
+        trees.pack_nodes();
+        dense_tree_predict(out_pred, trees, data, model_output);
+        trees.free_nodes();
+        ret_value = trees.values[0];
+    } else {
+        TreeEnsemble<tfloat> trees = TreeEnsemble<tfloat>(
+            children_left, children_right, children_default, features, (tfloat*)PyArray_DATA(thresholds_array),
+            (tfloat*)PyArray_DATA(values_array), NULL, max_depth, tree_limit, base_offset, max_nodes, num_outputs,
+            tree_offsets
+        );
+        ExplanationDataset<tfloat> data = ExplanationDataset<tfloat>(
+            (tfloat*)PyArray_DATA(X_array), X_missing, y, NULL, NULL, num_X, M, 0
+        );
+        trees.pack_nodes();
+        dense_tree_predict(out_pred, trees, data, model_output);
+        trees.free_nodes();
+        ret_value = trees.values[0];
+    }
 
     // clean up the created python objects 
     Py_XDECREF(children_left_array);
@@ -340,9 +1225,10 @@ static PyObject *_cext_dense_tree_predict(PyObject *self, PyObject *args)
     if (y_array != NULL) Py_XDECREF(y_array);
     //PyArray_ResolveWritebackIfCopy(out_pred_array);
     Py_XDECREF(out_pred_array);
+    Py_XDECREF(tree_offsets_array);
 
     /* Build the output tuple */
-    PyObject *ret = Py_BuildValue("d", (double)values[0]);
+    PyObject *ret = Py_BuildValue("d", ret_value);
     return ret;
 }
 
@@ -413,11 +1299,11 @@ static PyObject *_cext_dense_tree_update_weights(PyObject *self, PyObject *args)
 
     // these are just wrapper objects for all the pointers and numbers associated with
     // the ensemble tree model and the datset we are explaing
-    TreeEnsemble trees = TreeEnsemble(
+    TreeEnsemble<> trees = TreeEnsemble<>(
         children_left, children_right, children_default, features, thresholds, values,
         node_sample_weight, 0, tree_limit, 0, max_nodes, 0
     );
-    ExplanationDataset data = ExplanationDataset(X, X_missing, NULL, NULL, NULL, num_X, M, 0);
+    ExplanationDataset<> data = ExplanationDataset<>(X, X_missing, NULL, NULL, NULL, num_X, M, 0);
 
     dense_tree_update_weights(trees, data);
 
@@ -439,6 +1325,131 @@ static PyObject *_cext_dense_tree_update_weights(PyObject *self, PyObject *args)
 }
 
 
+template <typename T>
+static unsigned ensemble_update_weights(TreeEnsemble<T> &trees, const ExplanationDataset<T> &data,
+                                        const T weight, const unsigned num_threads)
+{
+    dense_tree_update_weights(trees, data, weight, num_threads);
+    return compute_ensemble_expectations(trees, num_threads);
+}
+
+static PyObject *_cext_dense_ensemble_update_weights(PyObject *self, PyObject *args)
+{
+    PyObject *children_left_obj;
+    PyObject *children_right_obj;
+    PyObject *children_default_obj;
+    PyObject *features_obj;
+    PyObject *thresholds_obj;
+    PyObject *values_obj;
+    PyObject *node_sample_weight_obj;
+    PyObject *tree_offsets_obj;
+    PyObject *X_obj;
+    PyObject *X_missing_obj;
+    double weight;
+    int num_threads = 1;
+
+    /* Parse the input tuple */
+    if (!PyArg_ParseTuple(
+        args, "OOOOOOOOOOd|i", &children_left_obj, &children_right_obj, &children_default_obj,
+        &features_obj, &thresholds_obj, &values_obj, &node_sample_weight_obj, &tree_offsets_obj,
+        &X_obj, &X_missing_obj, &weight, &num_threads
+    )) return NULL;
+
+    /* The values and node sample weights are updated in place, so they must already be of the model's type. */
+    const bool use_float32 = float32_inputs(thresholds_obj, values_obj, node_sample_weight_obj);
+    const int float_type = use_float32 ? NPY_FLOAT : NPY_DOUBLE;
+    PyArrayObject *children_left_array = (PyArrayObject*)PyArray_FROM_OTF(children_left_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *children_right_array = (PyArrayObject*)PyArray_FROM_OTF(children_right_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *children_default_array = (PyArrayObject*)PyArray_FROM_OTF(children_default_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *features_array = (PyArrayObject*)PyArray_FROM_OTF(features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, float_type, NPY_ARRAY_INOUT_ARRAY2);
+    PyArrayObject *node_sample_weight_array = (PyArrayObject*)PyArray_FROM_OTF(node_sample_weight_obj, float_type, NPY_ARRAY_INOUT_ARRAY2);
+    PyArrayObject *tree_offsets_array = (PyArrayObject*)PyArray_FROM_OTF(tree_offsets_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
+
+    unsigned num_trees, max_nodes, num_outputs;
+
+    /* If that didn't work, throw an exception. */
+    if (children_left_array == NULL || children_right_array == NULL ||
+        children_default_array == NULL || features_array == NULL || thresholds_array == NULL ||
+        values_array == NULL || node_sample_weight_array == NULL || tree_offsets_array == NULL ||
+        X_array == NULL || X_missing_array == NULL ||
+        !read_tree_layout(values_array, tree_offsets_array, num_trees, max_nodes, num_outputs)) {
+        Py_XDECREF(children_left_array);
+        Py_XDECREF(children_right_array);
+        Py_XDECREF(children_default_array);
+        Py_XDECREF(features_array);
+        Py_XDECREF(thresholds_array);
+        if (values_array != NULL) PyArray_DiscardWritebackIfCopy(values_array);
+        Py_XDECREF(values_array);
+        if (node_sample_weight_array != NULL) PyArray_DiscardWritebackIfCopy(node_sample_weight_array);
+        Py_XDECREF(node_sample_weight_array);
+        Py_XDECREF(tree_offsets_array);
+        Py_XDECREF(X_array);
+        Py_XDECREF(X_missing_array);
+        return NULL;
+    }
+
+    const unsigned num_X = PyArray_DIM(X_array, 0);
+    const unsigned M = PyArray_DIM(X_array, 1);
+
+    // Get pointers to the data as C-types
+    int *children_left = (int*)PyArray_DATA(children_left_array);
+    int *children_right = (int*)PyArray_DATA(children_right_array);
+    int *children_default = (int*)PyArray_DATA(children_default_array);
+    int *features = (int*)PyArray_DATA(features_array);
+    int *tree_offsets = (int*)PyArray_DATA(tree_offsets_array);
+    bool *X_missing = (bool*)PyArray_DATA(X_missing_array);
+
+    // every thread owns a disjoint set of trees, so the weights are updated without locking
+    unsigned max_depth;
+    if (use_float32) {
+        TreeEnsemble<float> trees = TreeEnsemble<float>(
+            children_left, children_right, children_default, features, (float*)PyArray_DATA(thresholds_array),
+            (float*)PyArray_DATA(values_array), (float*)PyArray_DATA(node_sample_weight_array), 0, num_trees,
+            0, max_nodes, num_outputs, tree_offsets
+        );
+        ExplanationDataset<float> data = ExplanationDataset<float>(
+            (float*)PyArray_DATA(X_array), X_missing, NULL, NULL, NULL, num_X, M, 0
+        );
+        Py_BEGIN_ALLOW_THREADS
+        max_depth = ensemble_update_weights(trees, data, (float)weight, num_threads);
+        Py_END_ALLOW_THREADS
+    } else {
+        TreeEnsemble<tfloat> trees = TreeEnsemble<tfloat>(
+            children_left, children_right, children_default, features, (tfloat*)PyArray_DATA(thresholds_array),
+            (tfloat*)PyArray_DATA(values_array), (tfloat*)PyArray_DATA(node_sample_weight_array), 0, num_trees,
+            0, max_nodes, num_outputs, tree_offsets
+        );
+        ExplanationDataset<tfloat> data = ExplanationDataset<tfloat>(
+            (tfloat*)PyArray_DATA(X_array), X_missing, NULL, NULL, NULL, num_X, M, 0
+        );
+        Py_BEGIN_ALLOW_THREADS
+        max_depth = ensemble_update_weights(trees, data, weight, num_threads);
+        Py_END_ALLOW_THREADS
+    }
+
+    // clean up the created python objects 
+    Py_XDECREF(children_left_array);
+    Py_XDECREF(children_right_array);
+    Py_XDECREF(children_default_array);
+    Py_XDECREF(features_array);
+    Py_XDECREF(thresholds_array);
+    PyArray_ResolveWritebackIfCopy(values_array);
+    Py_XDECREF(values_array);
+    PyArray_ResolveWritebackIfCopy(node_sample_weight_array);
+    Py_XDECREF(node_sample_weight_array);
+    Py_XDECREF(tree_offsets_array);
+    Py_XDECREF(X_array);
+    Py_XDECREF(X_missing_array);
+
+    /* Return the depth of the deepest tree */
+    PyObject *ret = Py_BuildValue("i", max_depth);
+    return ret;
+}
+
 static PyObject *_cext_dense_tree_saabas(PyObject *self, PyObject *args)
 {
     PyObject *children_left_obj;
@@ -455,33 +1466,41 @@ static PyObject *_cext_dense_tree_saabas(PyObject *self, PyObject *args)
     PyObject *X_missing_obj;
     PyObject *y_obj;
     PyObject *out_pred_obj;
-    
-  
+    PyObject *tree_offsets_obj = Py_None;
+
     /* Parse the input tuple */
     if (!PyArg_ParseTuple(
-        args, "OOOOOOiidiOOOO", &children_left_obj, &children_right_obj, &children_default_obj,
+        args, "OOOOOOiidiOOOO|O", &children_left_obj, &children_right_obj, &children_default_obj,
         &features_obj, &thresholds_obj, &values_obj, &max_depth, &tree_limit, &base_offset, &model_output,
-        &X_obj, &X_missing_obj, &y_obj, &out_pred_obj
+        &X_obj, &X_missing_obj, &y_obj, &out_pred_obj, &tree_offsets_obj
     )) return NULL;
 
-    /* Interpret the input objects as numpy arrays. */
+    /* Interpret the input objects as numpy arrays (float32 inputs are not copied to float64). */
+    const bool use_float32 = float32_inputs(X_obj, thresholds_obj, values_obj);
+    const int float_type = use_float32 ? NPY_FLOAT : NPY_DOUBLE;
     PyArrayObject *children_left_array = (PyArrayObject*)PyArray_FROM_OTF(children_left_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *children_right_array = (PyArrayObject*)PyArray_FROM_OTF(children_right_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *children_default_array = (PyArrayObject*)PyArray_FROM_OTF(children_default_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *features_array = (PyArrayObject*)PyArray_FROM_OTF(features_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
-    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *thresholds_array = (PyArrayObject*)PyArray_FROM_OTF(thresholds_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *values_array = (PyArrayObject*)PyArray_FROM_OTF(values_obj, float_type, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *X_array = (PyArrayObject*)PyArray_FROM_OTF(X_obj, float_type, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *X_missing_array = (PyArrayObject*)PyArray_FROM_OTF(X_missing_obj, NPY_BOOL, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *y_array = NULL;
     if (y_obj != Py_None) y_array = (PyArrayObject*)PyArray_FROM_OTF(y_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
     PyArrayObject *out_pred_array = (PyArrayObject*)PyArray_FROM_OTF(out_pred_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    PyArrayObject *tree_offsets_array = NULL;
+    if (tree_offsets_obj != Py_None) tree_offsets_array = (PyArrayObject*)PyArray_FROM_OTF(tree_offsets_obj, NPY_INT, NPY_ARRAY_IN_ARRAY);
+
+    unsigned num_trees, max_nodes, num_outputs;
 
     /* If that didn't work, throw an exception. Note that R and y are optional. */
     if (children_left_array == NULL || children_right_array == NULL ||
         children_default_array == NULL || features_array == NULL || thresholds_array == NULL ||
         values_array == NULL || X_array == NULL ||
-        X_missing_array == NULL || out_pred_array == NULL) {
+        X_missing_array == NULL || out_pred_array == NULL ||
+        (tree_offsets_obj != Py_None && tree_offsets_array == NULL) ||
+        !read_tree_layout(values_array, tree_offsets_array, num_trees, max_nodes, num_outputs)) {
         Py_XDECREF(children_left_array);
         Py_XDECREF(children_right_array);
         Py_XDECREF(children_default_array);
@@ -493,22 +1512,20 @@ static PyObject *_cext_dense_tree_saabas(PyObject *self, PyObject *args)
         if (y_array != NULL) Py_XDECREF(y_array);
         //PyArray_ResolveWritebackIfCopy(out_pred_array);
         Py_XDECREF(out_pred_array);
+        Py_XDECREF(tree_offsets_array);
         return NULL;
     }
 
     const unsigned num_X = PyArray_DIM(X_array, 0);
     const unsigned M = PyArray_DIM(X_array, 1);
-    const unsigned max_nodes = PyArray_DIM(values_array, 1);
-    const unsigned num_outputs = PyArray_DIM(values_array, 2);
+    if (tree_limit < 0 || tree_limit > (int)num_trees) tree_limit = num_trees;
 
     // Get pointers to the data as C-types
     int *children_left = (int*)PyArray_DATA(children_left_array);
     int *children_right = (int*)PyArray_DATA(children_right_array);
     int *children_default = (int*)PyArray_DATA(children_default_array);
     int *features = (int*)PyArray_DATA(features_array);
-    tfloat *thresholds = (tfloat*)PyArray_DATA(thresholds_array);
-    tfloat *values = (tfloat*)PyArray_DATA(values_array);
-    tfloat *X = (tfloat*)PyArray_DATA(X_array);
+    int *tree_offsets = tree_offsets_array == NULL ? NULL : (int*)PyArray_DATA(tree_offsets_array);
     bool *X_missing = (bool*)PyArray_DATA(X_missing_array);
     tfloat *y = NULL;
     if (y_array != NULL) y = (tfloat*)PyArray_DATA(y_array);
@@ -516,14 +1533,34 @@ static PyObject *_cext_dense_tree_saabas(PyObject *self, PyObject *args)
 
     // these are just wrapper objects for all the pointers and numbers associated with
     // the ensemble tree model and the datset we are explaing
-    TreeEnsemble trees = TreeEnsemble(
-        children_left, children_right, children_default, features, thresholds, values,
-        NULL, max_depth, tree_limit, base_offset,
-        max_nodes, num_outputs
-    );
-    ExplanationDataset data = ExplanationDataset(X, X_missing, y, NULL, NULL, num_X, M, 0);
-
-    dense_tree_saabas(out_pred, trees, data);
+    tfloat ret_value;
+    if (use_float32) {
+        TreeEnsemble<float> trees = TreeEnsemble<float>(
+            children_left, children_right, children_default, features, (float*)PyArray_DATA(thresholds_array),
+            (float*)PyArray_DATA(values_array), NULL, max_depth, tree_limit, base_offset, max_nodes, num_outputs,
+            tree_offsets
+        );
+        ExplanationDataset<float> data = ExplanationDataset<float>(
+            (float*)PyArray_DATA(X_array), X_missing, y, NULL, NULL, num_X, M, 0
+        );
+        trees.pack_nodes();
+        dense_tree_saabas(out_pred, trees, data);
+        trees.free_nodes();
+        ret_value = trees.values[0];
+    } else {
+        TreeEnsemble<tfloat> trees = TreeEnsemble<tfloat>(
+            children_left, children_right, children_default, features, (tfloat*)PyArray_DATA(thresholds_array),
+            (tfloat*)PyArray_DATA(values_array), NULL, max_depth, tree_limit, base_offset, max_nodes, num_outputs,
+            tree_offsets
+        );
+        ExplanationDataset<tfloat> data = ExplanationDataset<tfloat>(
+            (tfloat*)PyArray_DATA(X_array), X_missing, y, NULL, NULL, num_X, M, 0
+        );
+        trees.pack_nodes();
+        dense_tree_saabas(out_pred, trees, data);
+        trees.free_nodes();
+        ret_value = trees.values[0];
+    }
 
     // clean up the created python objects 
     Py_XDECREF(children_left_array);
@@ -537,8 +1574,9 @@ static PyObject *_cext_dense_tree_saabas(PyObject *self, PyObject *args)
     if (y_array != NULL) Py_XDECREF(y_array);
     //PyArray_ResolveWritebackIfCopy(out_pred_array);
     Py_XDECREF(out_pred_array);
+    Py_XDECREF(tree_offsets_array);
 
     /* Build the output tuple */
-    PyObject *ret = Py_BuildValue("d", (double)values[0]);
+    PyObject *ret = Py_BuildValue("d", ret_value);
     return ret;
-}
\ No newline at end of file
+}
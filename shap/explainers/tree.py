@@ -1,9 +1,15 @@
 import numpy as np
+import scipy as sp
+import scipy.sparse
 import multiprocessing
+import collections
 import sys
 import json
 import os
 import struct
+import pickle
+import hashlib
+import tempfile
 from distutils.version import LooseVersion
 from .explainer import Explainer
 from ..common import assert_import, record_import_error
@@ -35,12 +41,26 @@ output_transform_codes = {
     "squared_loss": 3
 }
 
+# numpy versions of the output transforms of the C extension, applied to margins given the labels y
+output_transforms = {
+    "identity": lambda margin, y: margin,
+    "logistic": lambda margin, y: 1 / (1 + np.exp(-margin)),
+    "logistic_nlogloss": lambda margin, y: np.log(1 + np.exp(margin)) - y * margin,
+    "squared_loss": lambda margin, y: (margin - y) ** 2
+}
+
 feature_dependence_codes = {
     "independent": 0,
     "tree_path_dependent": 1,
     "global_path_dependent": 2
 }
 
+interaction_reduce_codes = {
+    "none": 0,
+    "sum": 1,
+    "sum_abs": 2
+}
+
 class TreeExplainer(Explainer):
     """Uses Tree SHAP algorithms to explain the output of ensemble tree models.
 
@@ -59,7 +79,7 @@ class TreeExplainer(Explainer):
         feature_dependence="tree_path_dependent", since in that case we can use the number of training
         samples that went down each tree path as our background dataset (this is recorded in the model object).
 
-    feature_dependence : "tree_path_dependent" (default) or "independent"
+    feature_dependence : "tree_path_dependent" (default), "independent" or "global_path_dependent"
         Since SHAP values rely on conditional expectations we need to decide how to handle correlated
         (or otherwise dependent) input features. The default "tree_path_dependent" approach is to just
         follow the trees and use the number of training examples that went down each leaf to represent
@@ -69,7 +89,10 @@ class TreeExplainer(Explainer):
         approach that breaks the dependencies between features, but allows us to explain non-linear
         transforms of the model's output. Note that the "independent" option requires a background
         dataset and its runtime scales linearly with the size of the background dataset you use. Anywhere
-        from 100 to 1000 random background samples are good sizes to use.
+        from 100 to 1000 random background samples are good sizes to use. The "global_path_dependent"
+        approach merges the whole ensemble into a single tree over the background dataset, so it respects
+        the dependencies along paths across all the trees at once. It requires a background dataset and
+        only supports model_output="margin".
     
     model_output : "margin", "probability", or "log_loss"
         What output of the model should be explained. If "margin" then we explain the raw output of the
@@ -81,6 +104,14 @@ class TreeExplainer(Explainer):
         Currently the probability and log_loss options are only supported when feature_dependence="independent".
     """
 
+    # path dependent Tree SHAP uses precomputed per leaf tables (see build_path_tables in tree_shap.h) when
+    # they take at most this many doubles, which is the case for ensembles of shallow trees (0 disables them)
+    path_table_max_entries = 2**22
+
+    # global_path_dependent merges the samples being explained with the background dataset in chunks whose
+    # merged trees (of at most 2 * (# chunk samples + # background samples) nodes) fit in this many nodes
+    merged_tree_max_nodes = 2**22
+
     def __init__(self, model, data = None, model_output = "margin", feature_dependence = "tree_path_dependent"):
         if str(type(data)).endswith("pandas.core.frame.DataFrame'>"):
             self.data = data.values
@@ -91,12 +122,20 @@ class TreeExplainer(Explainer):
         self.feature_dependence = feature_dependence
         self.expected_value = None
         self.model = TreeEnsemble(model, self.data, self.data_missing)
+        self._background_margins_cache = {}
+
+        # keep the background data in the model's dtype so the C extension can use it without a copy
+        if self.data is not None and self.data.dtype != self.model.dtype:
+            self.data = self.data.astype(self.model.dtype)
 
         assert feature_dependence in feature_dependence_codes, "Invalid feature_dependence option!"
 
         # check for unsupported combinations of feature_dependence and model_outputs
         if feature_dependence == "tree_path_dependent":
             assert model_output == "margin", "Only margin model_output is supported for feature_dependence=\"tree_path_dependent\""
+        elif feature_dependence == "global_path_dependent":
+            assert data is not None, "A background dataset must be provided for feature_dependence=\"global_path_dependent\"!"
+            assert model_output == "margin", "Only margin model_output is supported for feature_dependence=\"global_path_dependent\""
         else:   
             assert data is not None, "A background dataset must be provided unless you are using feature_dependence=\"tree_path_dependent\"!"
 
@@ -116,28 +155,122 @@ class TreeExplainer(Explainer):
             assert LooseVersion(xgboost.__version__) >= LooseVersion('0.81'), \
                 "A bug in XGBoost fixed in v0.81 makes XGBClassifier fail to give margin outputs! Please upgrade to XGBoost >= v0.81!"
         
+        # the margins of the background samples are needed again by every call that explains a
+        # transformed output against them, so compute them once up front
+        if data is not None and feature_dependence == "independent" and model_output != "margin":
+            self._background_margins()
+
         # compute the expected value if we have a parsed tree for the cext
         if self.model_output == "logloss":
             self.expected_value = self.__dynamic_expected_value
         elif data is not None:
             self.expected_value = self.model.predict(self.data, output=model_output).mean(0)
         elif hasattr(self.model, "node_sample_weight"):
-            #proportions = self.model.node_sample_weight[:,0] / self.model.node_sample_weight[:,0].sum()
-            self.expected_value = self.model.values[:,0].sum(0) #(self.model.values[:,0].T * proportions).T.sum(0)
+            self.expected_value = self.model.values[self.model.tree_offsets[:-1]].sum(0) # the root value of every tree
 
     def __dynamic_expected_value(self, y):
         """ This computes the expected value conditioned on the given label value.
         """
 
-        return self.model.predict(self.data, np.ones(self.data.shape[0]) * y, output=self.model_output).mean(0)
+        transform = self.model.get_transform(self.model_output)
+        expected_value = output_transforms[transform](self._background_margins(), y).mean(0)
+        return expected_value[0] if self.model.n_outputs == 1 else expected_value
+
+    def _background_margins(self, tree_limit=None, n_jobs=1):
+        """ The margin outputs of the background samples (# samples x # outputs) using tree_limit trees.
+
+        They only depend on the background dataset and the trees, so they are cached per tree_limit until
+        `invalidate_background_cache` is called (update_background keeps them up to date).
+        """
+        if tree_limit is None:
+            tree_limit = -1 if self.model.tree_limit is None else self.model.tree_limit
+        if tree_limit < 0 or tree_limit > len(self.model.num_nodes):
+            tree_limit = len(self.model.num_nodes)
+        if tree_limit not in self._background_margins_cache:
+            margins = self.model.predict(self.data, tree_limit=tree_limit, n_jobs=n_jobs, X_missing=self.data_missing)
+            self._background_margins_cache[tree_limit] = margins.reshape(self.data.shape[0], self.model.n_outputs)
+        return self._background_margins_cache[tree_limit]
+
+    def invalidate_background_cache(self):
+        """ Drops the cached margins of the background samples.
+
+        Call this after changing the trees or the background dataset in place (update_background already
+        keeps the cache up to date), so the next call recomputes them.
+        """
+        self._background_margins_cache = {}
+
+    def update_background(self, add=None, remove=None, n_jobs=1):
+        """ Adds and/or removes background samples without rebuilding the explainer.
+
+        Only the nodes the changed samples pass through are reweighted, and the expected value is
+        shifted by the predictions of the changed samples instead of re-predicting the whole background.
+
+        Parameters
+        ----------
+        add : numpy.array or pandas.DataFrame
+            New background samples to append to the background dataset.
+
+        remove : numpy.array
+            Indexes (or a boolean mask) of the rows of the current background dataset to remove.
+
+        n_jobs : int
+            The number of native threads the trees are split across. -1 means use all the CPU cores.
+        """
+        assert self.data is not None, "update_background needs an explainer built with a background dataset!"
+        assert hasattr(self.model, "node_sample_weight"), "update_background is only supported for models parsed into trees!"
+
+        num_old = self.data.shape[0]
+        keep = np.ones(num_old, dtype=np.bool_)
+        if remove is not None:
+            keep[remove] = False
+        removed = self.data[~keep]
+        removed_missing = np.asarray(self.data_missing)[~keep]
+        if add is None:
+            add = np.zeros((0, self.data.shape[1]), dtype=self.model.dtype)
+        elif str(type(add)).endswith("pandas.core.frame.DataFrame'>"):
+            add = add.values
+        add = np.asarray(add, dtype=self.model.dtype)
+        add_missing = np.isnan(add)
+        num_new = num_old - removed.shape[0] + add.shape[0]
+        assert num_new > 0, "update_background can't remove every background sample!"
+
+        # shift the expected value by the predictions of the changed samples
+        if self.model_output != "logloss":
+            total = np.asarray(self.expected_value) * num_old
+            if add.shape[0] > 0:
+                total = total + self.model.predict(add, output=self.model_output, n_jobs=n_jobs).sum(0)
+            if removed.shape[0] > 0:
+                total = total - self.model.predict(removed, output=self.model_output, n_jobs=n_jobs).sum(0)
+            self.expected_value = total / num_new
+
+        if removed.shape[0] > 0:
+            self.model.update_weights(removed, removed_missing, -1.0, n_jobs=n_jobs)
+        if add.shape[0] > 0:
+            self.model.update_weights(add, add_missing, 1.0, n_jobs=n_jobs)
+
+        # only the added samples need their margins computed
+        for tree_limit, margins in self._background_margins_cache.items():
+            add_margins = self.model.predict(add, tree_limit=tree_limit, n_jobs=n_jobs, X_missing=add_missing)
+            self._background_margins_cache[tree_limit] = np.concatenate([
+                margins[keep], np.reshape(add_margins, (add.shape[0], self.model.n_outputs))
+            ])
+
+        self.data = np.concatenate([self.data[keep], add])
+        self.data_missing = np.concatenate([np.asarray(self.data_missing)[keep], add_missing])
+        self.model.data = self.data
+        self.model.data_missing = self.data_missing
         
-    def shap_values(self, X, y=None, tree_limit=None, approximate=False):
+    def shap_values(self, X, y=None, tree_limit=None, approximate=False, n_jobs=1, chunk_size=None, top_k=None,
+                    X_missing=None, leaves=None):
         """ Estimate the SHAP values for a set of samples.
 
         Parameters
         ----------
-        X : numpy.array, pandas.DataFrame or catboost.Pool (for catboost)
-            A matrix of samples (# samples x # features) on which to explain the model's output.
+        X : numpy.array, pandas.DataFrame, scipy.sparse matrix or catboost.Pool (for catboost)
+            A matrix of samples (# samples x # features) on which to explain the model's output. Sparse
+            matrices are explained row by row without densifying them (entries that are not stored are
+            zero, stored NaNs are missing), and are only supported with feature_dependence="tree_path_dependent"
+            or approximate=True.
 
         y : numpy.array
             An array of label values for each sample. Used when explaining loss functions.
@@ -150,7 +283,35 @@ class TreeExplainer(Explainer):
             Run fast, but only roughly approximate the Tree SHAP values. This runs a method
             previously proposed by Saabas which only considers a single feature ordering. Take care
             since this does not have the consistency guarantees of Shapley values and places too
-            much weight on lower splits in the tree.
+            much weight on lower splits in the tree. Except for XGBoost models (which have their own)
+            this runs on the internal trees, split across n_jobs threads.
+
+        n_jobs : int
+            The number of native threads the rows of X are split across when running the internal
+            C++ implementation. The GIL is released while they run. -1 means use all the CPU cores.
+            With feature_dependence="independent" and fewer rows than threads the background samples
+            are split across the threads instead.
+
+        chunk_size : None (default) or int
+            With feature_dependence="independent" the background samples are streamed through in blocks of
+            this many samples, and each block explains every row of X before moving on to the next, which
+            keeps large background datasets in cache. None means use the whole background at once. With
+            feature_dependence="global_path_dependent" this many rows of X are merged with the background
+            dataset at a time. None means as many as fit in merged_tree_max_nodes.
+
+        top_k : None (default) or int
+            Only used when X is a scipy.sparse matrix. Only keep the top_k SHAP values of each sample
+            (by absolute value).
+
+        X_missing : None (default) or numpy.array
+            A boolean matrix the shape of X marking its missing values. By default the NaN values of X are
+            found during the tree traversals, so no mask is built.
+
+        leaves : None (default) or numpy.array
+            The leaves of the rows of X from `TreeEnsemble.apply` (explainer.model.apply) with the same
+            tree_limit. With feature_dependence="independent" and a model_output other than "margin" the
+            margins of X are summed from them instead of walking the trees again. The other algorithms
+            need the split decisions off the path to the leaf too, so they don't use them.
 
         Returns
         -------
@@ -158,15 +319,26 @@ class TreeExplainer(Explainer):
         (# samples x # features). Each row sums to the difference between the model output for that
         sample and the expected value of the model output (which is stored in the expected_value
         attribute of the explainer when it is constant). For models with vector outputs this returns
-        a list of such matrices, one for each output.
+        a list of such matrices, one for each output. When X is a scipy.sparse matrix the matrices are
+        scipy.sparse.csr_matrix objects that only store the non-zero SHAP values.
         """
 
         # see if we have a default tree_limit in place.
         if tree_limit is None:
             tree_limit = -1 if self.model.tree_limit is None else self.model.tree_limit
 
+        # LightGBM and CatBoost have no Saabas of their own, so they run it on the internal trees
+        internal_approximate = approximate and self.model.model_type in ["lightgbm", "catboost"]
+        if internal_approximate:
+            assert hasattr(self.model, "num_nodes"), \
+                "approximate=True needs a model that can be converted to internal trees, which this %s model could not!" % self.model.model_type
+            if self.model.model_type == "lightgbm":
+                assert self.model.n_outputs == self.model.original_model.num_model_per_iteration(), \
+                    "approximate=True needs one internal output per class of this LightGBM model!"
+
         # shortcut using the C++ version of Tree SHAP in XGBoost, LightGBM, and CatBoost
-        if self.feature_dependence == "tree_path_dependent" and self.model.model_type != "internal" and self.data is None:
+        if self.feature_dependence == "tree_path_dependent" and self.model.model_type != "internal" and self.data is None \
+                and not internal_approximate:
             phi = None
             if self.model.model_type == "xgboost":
                 assert_import("xgboost")
@@ -180,13 +352,11 @@ class TreeExplainer(Explainer):
                 )
             
             elif self.model.model_type == "lightgbm":
-                assert not approximate, "approximate=True is not supported for LightGBM models!"
                 phi = self.model.original_model.predict(X, num_iteration=tree_limit, pred_contrib=True)
                 if phi.shape[1] != X.shape[1] + 1:
                     phi = phi.reshape(X.shape[0], phi.shape[1]//(X.shape[1]+1), X.shape[1]+1)
             
             elif self.model.model_type == "catboost": # thanks to the CatBoost team for implementing this...
-                assert not approximate, "approximate=True is not supported for CatBoost models!"
                 assert tree_limit == -1, "tree_limit is not yet supported for CatBoost models!"
                 if type(X) != catboost.Pool:
                     X = catboost.Pool(X)
@@ -201,6 +371,9 @@ class TreeExplainer(Explainer):
                     self.expected_value = phi[0, -1]
                     return phi[:, :-1]
 
+        if sp.sparse.issparse(X):
+            return self._sparse_shap_values(X, tree_limit, approximate, n_jobs, top_k)
+
         # convert dataframes
         orig_X = X
         if str(type(X)).endswith("pandas.core.series.Series'>"):
@@ -211,14 +384,13 @@ class TreeExplainer(Explainer):
         if len(X.shape) == 1:
             flat_output = True
             X = X.reshape(1, X.shape[0])
-        if X.dtype != self.model.dtype:
-            X = X.astype(self.model.dtype)
-        X_missing = np.isnan(X, dtype=np.bool)
+        if X_missing is not None:
+            X_missing = np.asarray(X_missing).reshape(X.shape)
         assert str(type(X)).endswith("'numpy.ndarray'>"), "Unknown instance type: " + str(type(X))
         assert len(X.shape) == 2, "Passed input data matrix X must have 1 or 2 dimensions!"
 
-        if tree_limit < 0 or tree_limit > self.model.values.shape[0]:
-            tree_limit = self.model.values.shape[0]
+        if tree_limit < 0 or tree_limit > len(self.model.num_nodes):
+            tree_limit = len(self.model.num_nodes)
         
         if self.model_output == "logloss":
             assert y is not None, "Both samples and labels must be provided when explaining the loss (i.e. `explainer.shap_values(X, y)`)!"
@@ -232,23 +404,109 @@ class TreeExplainer(Explainer):
  
         # run the core algorithm using the C extension
         assert_import("cext")
+        if self.feature_dependence == "tree_path_dependent" and not approximate and self.path_table_max_entries > 0:
+            self.model.compiled.build_path_tables(self.path_table_max_entries)
+        if self.feature_dependence == "global_path_dependent":
+            max_chunk_size = self.merged_tree_max_nodes // 2 - self.data.shape[0]
+            assert max_chunk_size > 0, "The merged trees of the %d background samples don't fit in merged_tree_max_nodes = %d, " \
+                                       "so use a smaller background dataset or raise the limit!" % (self.data.shape[0], self.merged_tree_max_nodes)
+            chunk_size = max_chunk_size if chunk_size is None else min(chunk_size, max_chunk_size)
+        background_margins = None
+        if self.feature_dependence == "independent" and transform != "identity":
+            background_margins = self._background_margins(tree_limit, n_jobs)
         phi = np.zeros((X.shape[0], X.shape[1]+1, self.model.n_outputs))
         if not approximate:
-            _cext.dense_tree_shap(
-                self.model.children_left, self.model.children_right, self.model.children_default,
-                self.model.features, self.model.thresholds, self.model.values, self.model.node_sample_weight,
-                self.model.max_depth, X, X_missing, y, self.data, self.data_missing, tree_limit,
-                self.model.base_offset, phi, feature_dependence_codes[self.feature_dependence],
-                output_transform_codes[transform], False
+            self.model.compiled.shap_values(
+                X, X_missing, y, self.data, self.data_missing, tree_limit, phi,
+                feature_dependence_codes[self.feature_dependence], output_transform_codes[transform],
+                False, get_num_threads(n_jobs), 0 if chunk_size is None else chunk_size, 0, background_margins,
+                0, None if background_margins is None or leaves is None else np.asarray(leaves).reshape(X.shape[0], -1)
             )
         else:
-            _cext.dense_tree_saabas(
-                self.model.children_left, self.model.children_right, self.model.children_default,
-                self.model.features, self.model.thresholds, self.model.values,
-                self.model.max_depth, tree_limit, self.model.base_offset, output_transform_codes[transform], 
-                X, X_missing, y, phi
+            self.model.compiled.saabas(
+                X, X_missing, y, tree_limit, output_transform_codes[transform], phi, get_num_threads(n_jobs)
             )
 
+        return self._split_outputs(phi, flat_output)
+
+    def shap_values_by_stage(self, X, stages, y=None, n_jobs=1, chunk_size=None, X_missing=None):
+        """ Estimate the SHAP values for a set of samples at several stages (tree_limit values) of the ensemble.
+
+        SHAP values add up over the trees, so the trees are explained once, a range of trees at a time, and
+        the SHAP values at each stage are the running sum over the ranges before it. This costs about as much
+        as a single call to shap_values instead of one call per stage. Only supported with
+        feature_dependence="tree_path_dependent", or "independent" with model_output="margin".
+
+        Parameters
+        ----------
+        X : numpy.array or pandas.DataFrame
+            A matrix of samples (# samples x # features) on which to explain the model's output.
+
+        stages : list of int
+            The tree_limit values to return SHAP values for (-1 means all the trees).
+
+        y, n_jobs, chunk_size, X_missing
+            See shap_values.
+
+        Returns
+        -------
+        A list with what `shap_values(X, y, tree_limit=stage)` would return for each of the stages. The
+        expected_value attribute is left as it is for the last of the stages.
+        """
+        assert self.feature_dependence == "tree_path_dependent" or \
+               (self.feature_dependence == "independent" and self.model_output == "margin"), \
+               "shap_values_by_stage is only supported for feature_dependence=\"tree_path_dependent\", " \
+               "or \"independent\" with model_output=\"margin\"!"
+        if self.feature_dependence == "tree_path_dependent":
+            assert self.model.fully_defined_weighting, "The background dataset you provided does not cover all the leaves in the model, " \
+                                                       "so TreeExplainer cannot run with the feature_dependence=\"tree_path_dependent\" option! " \
+                                                       "Try providing a larger background dataset, or using feature_dependence=\"independent\"."
+
+        # convert dataframes
+        if str(type(X)).endswith("pandas.core.series.Series'>"):
+            X = X.values
+        elif str(type(X)).endswith("pandas.core.frame.DataFrame'>"):
+            X = X.values
+        flat_output = False
+        if len(X.shape) == 1:
+            flat_output = True
+            X = X.reshape(1, X.shape[0])
+        if X_missing is not None:
+            X_missing = np.asarray(X_missing).reshape(X.shape)
+        assert str(type(X)).endswith("'numpy.ndarray'>"), "Unknown instance type: " + str(type(X))
+        assert len(X.shape) == 2, "Passed input data matrix X must have 1 or 2 dimensions!"
+
+        num_trees = len(self.model.num_nodes)
+        stages = [num_trees if stage < 0 or stage > num_trees else stage for stage in stages]
+        assert min(stages) > 0, "The stages must be positive tree_limit values (or -1)!"
+
+        assert_import("cext")
+        if self.feature_dependence == "tree_path_dependent" and self.path_table_max_entries > 0:
+            self.model.compiled.build_path_tables(self.path_table_max_entries)
+        transform = self.model.get_transform(self.model_output)
+
+        # explain the trees between consecutive stages and keep a running sum
+        phi = np.zeros((X.shape[0], X.shape[1]+1, self.model.n_outputs))
+        phi_stages = {}
+        tree_start = 0
+        for stage in sorted(set(stages)):
+            if stage > tree_start:
+                phi_range = np.zeros(phi.shape)
+                self.model.compiled.shap_values(
+                    X, X_missing, y, self.data, self.data_missing, stage, phi_range,
+                    feature_dependence_codes[self.feature_dependence], output_transform_codes[transform],
+                    False, get_num_threads(n_jobs), 0 if chunk_size is None else chunk_size, 0, None, tree_start
+                )
+                phi += phi_range
+                tree_start = stage
+            phi_stages[stage] = phi.copy()
+
+        return [self._split_outputs(phi_stages[stage], flat_output) for stage in stages]
+
+    def _split_outputs(self, phi, flat_output):
+        """ Splits the (# samples x # features + 1 x # outputs) output of the C extension into SHAP values.
+        """
+
         # note we pull off the last column and keep it as our expected_value
         if self.model.n_outputs == 1:
             if self.model_output != "logloss":
@@ -265,7 +523,53 @@ class TreeExplainer(Explainer):
             else:
                 return [phi[:, :-1, i] for i in range(self.model.n_outputs)]
 
-    def shap_interaction_values(self, X, y=None, tree_limit=None):
+    def _sparse_shap_values(self, X, tree_limit, approximate, n_jobs, top_k):
+        """ Runs path dependent Tree SHAP (or Saabas) on the rows of a sparse matrix and returns CSR matrices.
+        """
+        assert self.feature_dependence == "tree_path_dependent" or approximate, \
+            "Sparse X is only supported with feature_dependence=\"tree_path_dependent\" or approximate=True!"
+        assert hasattr(self.model, "num_nodes"), "Sparse X is only supported for models parsed into trees!"
+        if top_k is not None:
+            assert top_k > 0, "top_k must be at least 1!"
+
+        X = X.tocsr()
+        if not X.has_canonical_format:
+            X = X.copy()
+            X.sum_duplicates()
+        num_features = X.shape[1]
+        assert self.model.features.max() < num_features, \
+            "The model splits on features beyond the %d columns of the sparse matrix X!" % num_features
+
+        if tree_limit < 0 or tree_limit > len(self.model.num_nodes):
+            tree_limit = len(self.model.num_nodes)
+
+        if not approximate:
+            assert self.model.fully_defined_weighting, "The background dataset you provided does not cover all the leaves in the model, " \
+                                                       "so TreeExplainer cannot run with the feature_dependence=\"tree_path_dependent\" option! " \
+                                                       "Try providing a larger background dataset, or using feature_dependence=\"independent\"."
+            if self.path_table_max_entries > 0:
+                self.model.compiled.build_path_tables(self.path_table_max_entries)
+
+        # run the core algorithm using the C extension
+        assert_import("cext")
+        bias = np.zeros(self.model.n_outputs)
+        indptr, indices, values = self.model.compiled.sparse_shap_values(
+            X.data.astype(self.model.dtype, copy=False), X.indices.astype(np.int32, copy=False),
+            X.indptr.astype(np.int64, copy=False), num_features, tree_limit, approximate,
+            0 if top_k is None else top_k, bias, get_num_threads(n_jobs)
+        )
+        phi = sp.sparse.csr_matrix((values, indices, indptr), shape=(X.shape[0], num_features * self.model.n_outputs))
+
+        if self.model.n_outputs == 1:
+            if X.shape[0] > 0:
+                self.expected_value = bias[0]
+            return phi
+        else:
+            if X.shape[0] > 0:
+                self.expected_value = list(bias)
+            return [phi[:, i * num_features:(i + 1) * num_features] for i in range(self.model.n_outputs)]
+
+    def shap_interaction_values(self, X, y=None, tree_limit=None, n_jobs=1, out=None, block_size=None):
         """ Estimate the SHAP interaction values for a set of samples.
 
         Parameters
@@ -280,6 +584,20 @@ class TreeExplainer(Explainer):
             Limit the number of trees used by the model. By default None means no use the limit of the
             original model, and -1 means no limit.
 
+        n_jobs : int
+            The number of native threads the rows of X are split across when running the internal
+            C++ implementation. The GIL is released while they run. -1 means use all the CPU cores.
+
+        out : None (default), numpy.array or list of numpy.array
+            Arrays to write the interaction values into, shaped like the return value (so a list with one
+            array per output for models with vector outputs). They can have any float dtype (such as
+            np.float32) and can be memory mapped, since the rows are computed in blocks of block_size rows
+            and copied in, so only one block of float64 values is ever held in memory.
+
+        block_size : None (default) or int
+            The number of rows of X explained at a time. By default all the rows are explained at once, unless
+            out is given in which case blocks of roughly 64MB are used.
+
         Returns
         -------
         For models with a single output this returns a tensor of SHAP values
@@ -292,6 +610,250 @@ class TreeExplainer(Explainer):
         this returns a list of tensors, one for each output.
         """
 
+        # convert series (dataframes are converted block by block)
+        if str(type(X)).endswith("pandas.core.series.Series'>"):
+            X = X.values
+        flat_output = False
+        if not str(type(X)).endswith("xgboost.core.DMatrix'>") and len(X.shape) == 1:
+            flat_output = True
+            X = X.reshape(1, X.shape[0])
+
+        if out is None and block_size is None:
+            phi = next(self._interaction_value_blocks(X, tree_limit, n_jobs, None))
+
+            # note we pull off the last column and keep it as our expected_value
+            if self.model.n_outputs == 1:
+                if flat_output:
+                    return phi[0, :-1, :-1, 0]
+                else:
+                    return phi[:, :-1, :-1, 0]
+            else:
+                if flat_output:
+                    return [phi[0, :-1, :-1, i] for i in range(self.model.n_outputs)]
+                else:
+                    return [phi[:, :-1, :-1, i] for i in range(self.model.n_outputs)]
+
+        # stream blocks of rows into the output arrays
+        num_rows, num_features = interaction_input_shape(X)
+        if out is None:
+            out = [np.zeros((num_rows, num_features, num_features)) for i in range(self.model.n_outputs)]
+            if flat_output:
+                out = [o[0] for o in out]
+            if self.model.n_outputs == 1:
+                out = out[0]
+        outs = [out] if self.model.n_outputs == 1 else out
+        assert len(outs) == self.model.n_outputs, "The out list must have one array for each model output!"
+        outs = [o[np.newaxis] if flat_output else o for o in outs]
+        for o in outs:
+            assert o.shape == (num_rows, num_features, num_features), \
+                "The out array has shape %s but (%d, %d, %d) is needed!" % (str(o.shape), num_rows, num_features, num_features)
+        if block_size is None:
+            block_size = self._default_interaction_block_size(num_features)
+
+        start = 0
+        for phi in self._interaction_value_blocks(X, tree_limit, n_jobs, block_size):
+            end = start + phi.shape[0]
+            for i in range(self.model.n_outputs):
+                outs[i][start:end] = phi[:, :-1, :-1, i]
+            start = end
+        return out
+
+    def iter_shap_interaction_values(self, X, tree_limit=None, n_jobs=1, block_size=None, dtype=np.float64, top_k=None):
+        """ Estimate the SHAP interaction values for consecutive blocks of rows of X.
+
+        Only one block of interaction values is held in memory at a time, so reductions over many samples
+        (such as the mean absolute interaction matrix) can be computed at constant memory.
+
+        Parameters
+        ----------
+        X : numpy.array or pandas.DataFrame
+            A matrix of samples (# samples x # features) on which to explain the model's output.
+
+        tree_limit : None (default) or int
+            Limit the number of trees used by the model. By default None means no use the limit of the
+            original model, and -1 means no limit.
+
+        n_jobs : int
+            The number of native threads the rows of each block are split across.
+
+        block_size : None (default) or int
+            The number of rows in each block. By default the blocks are roughly 64MB of float64 values.
+
+        dtype : numpy.dtype
+            The dtype of the yielded values.
+
+        top_k : None (default) or int
+            Only keep the top_k interaction partners (by absolute value, not including the feature
+            itself) of each feature.
+
+        Returns
+        -------
+        A generator over the blocks. Each block is formatted like the return value of
+        shap_interaction_values for those rows. When top_k is given each tensor is instead replaced by a
+        (indices, values) tuple of (# samples x # features x top_k) arrays, where indices are the partner
+        features sorted by decreasing absolute interaction value.
+        """
+
+        num_rows, num_features = interaction_input_shape(X)
+        if block_size is None:
+            block_size = self._default_interaction_block_size(num_features)
+        if top_k is not None:
+            assert 0 < top_k < num_features, "top_k must be between 1 and the number of features minus one!"
+
+        for phi in self._interaction_value_blocks(X, tree_limit, n_jobs, block_size):
+            values = []
+            for i in range(self.model.n_outputs):
+                v = phi[:, :-1, :-1, i]
+                if top_k is None:
+                    values.append(v.astype(dtype, copy=False))
+                else:
+                    magnitude = np.abs(v)
+                    magnitude[:, np.arange(num_features), np.arange(num_features)] = -1
+                    inds = np.argpartition(-magnitude, top_k - 1, axis=2)[:, :, :top_k]
+                    order = np.argsort(-np.take_along_axis(magnitude, inds, axis=2), axis=2)
+                    inds = np.take_along_axis(inds, order, axis=2)
+                    values.append((inds.astype(np.int32), np.take_along_axis(v, inds, axis=2).astype(dtype)))
+            yield values[0] if self.model.n_outputs == 1 else values
+
+    def global_interaction_values(self, X, reduce="mean_abs", tree_limit=None, n_jobs=1):
+        """ Reduce the SHAP interaction values of a set of samples to a single matrix.
+
+        The reduction is accumulated inside the C++ interaction kernel, so memory use is
+        O(# features^2) instead of the O(# samples x # features^2) of shap_interaction_values.
+
+        Parameters
+        ----------
+        X : numpy.array or pandas.DataFrame
+            A matrix of samples (# samples x # features) on which to explain the model's output.
+
+        reduce : "mean_abs" (default), "mean", "sum_abs" or "sum"
+            How the interaction matrices of the samples are combined.
+
+        tree_limit : None (default) or int
+            Limit the number of trees used by the model. By default None means no use the limit of the
+            original model, and -1 means no limit.
+
+        n_jobs : int
+            The number of native threads the rows of X are split across. -1 means use all the CPU cores.
+
+        Returns
+        -------
+        For models with a single output this returns a (# features x # features) matrix, and for models
+        with vector outputs a list of such matrices, one for each output. The expected_value attribute
+        of the explainer is set like it is by shap_interaction_values.
+        """
+
+        assert self.model_output == "margin", "Only model_output = \"margin\" is supported for SHAP interaction values right now!"
+        assert self.feature_dependence == "tree_path_dependent", "Only feature_dependence = \"tree_path_dependent\" is supported for SHAP interaction values right now!"
+        assert reduce in ["mean_abs", "mean", "sum_abs", "sum"], "Unknown reduce option: " + str(reduce)
+        assert hasattr(self.model, "num_nodes"), "global_interaction_values needs a model parsed into internal trees!"
+
+        # see if we have a default tree_limit in place.
+        if tree_limit is None:
+            tree_limit = -1 if self.model.tree_limit is None else self.model.tree_limit
+        if tree_limit < 0 or tree_limit > len(self.model.num_nodes):
+            tree_limit = len(self.model.num_nodes)
+
+        # convert dataframes
+        if str(type(X)).endswith("pandas.core.frame.DataFrame'>"):
+            X = X.values
+        assert str(type(X)).endswith("'numpy.ndarray'>"), "Unknown instance type: " + str(type(X))
+        assert len(X.shape) == 2, "Passed input data matrix X must have 2 dimensions!"
+        assert X.shape[0] > 0, "X must have at least one sample!"
+
+        # run the core algorithm using the C extension, which sums into a single matrix
+        assert_import("cext")
+        phi = np.zeros((X.shape[1]+1, X.shape[1]+1, self.model.n_outputs))
+        self.model.compiled.shap_values(
+            X, None, None, self.data, self.data_missing, tree_limit, phi,
+            feature_dependence_codes[self.feature_dependence], output_transform_codes["identity"],
+            True, get_num_threads(n_jobs), 0, interaction_reduce_codes[reduce.replace("mean", "sum")]
+        )
+        if reduce.startswith("mean"):
+            phi /= X.shape[0]
+
+        # the bias term is always summed with its sign, so it gives the expected value
+        expected_value = phi[-1, -1, :] * (1 if reduce.startswith("mean") else 1.0 / X.shape[0])
+        if self.model.n_outputs == 1:
+            self.expected_value = expected_value[0]
+            return phi[:-1, :-1, 0]
+        else:
+            self.expected_value = list(expected_value)
+            return [phi[:-1, :-1, i] for i in range(self.model.n_outputs)]
+
+    def per_tree_shap_values(self, X, reduce="mean_abs", tree_limit=None, n_jobs=1):
+        """ Reduce the SHAP values of a set of samples to one row of feature values per tree.
+
+        This shows how much each tree contributes to each feature (for example to find trees to prune)
+        without explaining every single tree model on its own. The reduction is accumulated inside the
+        C++ kernel, so memory use is O(# trees x # features) instead of O(# samples x # trees x # features).
+
+        Parameters
+        ----------
+        X : numpy.array or pandas.DataFrame
+            A matrix of samples (# samples x # features) on which to explain the model's output.
+
+        reduce : "mean_abs" (default), "mean", "sum_abs" or "sum"
+            How the SHAP values of the samples are combined for each tree.
+
+        tree_limit : None (default) or int
+            Limit the number of trees used by the model. By default None means no use the limit of the
+            original model, and -1 means no limit.
+
+        n_jobs : int
+            The number of native threads the rows of X are split across. -1 means use all the CPU cores.
+
+        Returns
+        -------
+        For models with a single output this returns a (# trees x # features) matrix, and for models
+        with vector outputs a list of such matrices, one for each output. Summing a "mean" matrix over
+        the trees gives the mean SHAP values of the samples.
+        """
+
+        assert self.model_output == "margin", "Only model_output = \"margin\" is supported for per tree SHAP values right now!"
+        assert self.feature_dependence == "tree_path_dependent", "Only feature_dependence = \"tree_path_dependent\" is supported for per tree SHAP values right now!"
+        assert reduce in ["mean_abs", "mean", "sum_abs", "sum"], "Unknown reduce option: " + str(reduce)
+        assert hasattr(self.model, "num_nodes"), "per_tree_shap_values needs a model parsed into internal trees!"
+        assert self.model.fully_defined_weighting, "The background dataset you provided does not cover all the leaves in the model, " \
+                                                   "so TreeExplainer cannot run with the feature_dependence=\"tree_path_dependent\" option! " \
+                                                   "Try providing a larger background dataset, or using feature_dependence=\"independent\"."
+
+        # see if we have a default tree_limit in place.
+        if tree_limit is None:
+            tree_limit = -1 if self.model.tree_limit is None else self.model.tree_limit
+        if tree_limit < 0 or tree_limit > len(self.model.num_nodes):
+            tree_limit = len(self.model.num_nodes)
+
+        # convert dataframes
+        if str(type(X)).endswith("pandas.core.frame.DataFrame'>"):
+            X = X.values
+        assert str(type(X)).endswith("'numpy.ndarray'>"), "Unknown instance type: " + str(type(X))
+        assert len(X.shape) == 2, "Passed input data matrix X must have 2 dimensions!"
+        assert X.shape[0] > 0, "X must have at least one sample!"
+
+        # run the core algorithm using the C extension, which sums into a single matrix per tree
+        assert_import("cext")
+        if self.path_table_max_entries > 0:
+            self.model.compiled.build_path_tables(self.path_table_max_entries)
+        phi = np.zeros((tree_limit, X.shape[1], self.model.n_outputs))
+        self.model.compiled.per_tree_shap_values(
+            X, None, tree_limit, phi, reduce.endswith("abs"), get_num_threads(n_jobs)
+        )
+        if reduce.startswith("mean"):
+            phi /= X.shape[0]
+
+        if self.model.n_outputs == 1:
+            return phi[:, :, 0]
+        else:
+            return [phi[:, :, i] for i in range(self.model.n_outputs)]
+
+    def _default_interaction_block_size(self, num_features):
+        return max(1, 2**23 // ((num_features + 1)**2 * self.model.n_outputs))
+
+    def _interaction_value_blocks(self, X, tree_limit, n_jobs, block_size):
+        """ Yields (# rows x # features+1 x # features+1 x # outputs) float64 blocks of interaction values.
+        """
+
         assert self.model_output == "margin", "Only model_output = \"margin\" is supported for SHAP interaction values right now!"
         assert self.feature_dependence == "tree_path_dependent", "Only feature_dependence = \"tree_path_dependent\" is supported for SHAP interaction values right now!"
         transform = "identity"
@@ -300,65 +862,167 @@ class TreeExplainer(Explainer):
         if tree_limit is None:
             tree_limit = -1 if self.model.tree_limit is None else self.model.tree_limit
 
+        num_rows = interaction_input_shape(X)[0]
+        if block_size is None:
+            block_size = max(num_rows, 1)
+
         # shortcut using the C++ version of Tree SHAP in XGBoost
         if self.model.model_type == "xgboost":
             assert_import("xgboost")
-            if not str(type(X)).endswith("xgboost.core.DMatrix'>"):
-                X = xgboost.DMatrix(X)
             if tree_limit == -1:
                 tree_limit = 0
-            phi = self.model.original_model.predict(X, ntree_limit=tree_limit, pred_interactions=True)
+            for start in range(0, num_rows, block_size):
+                end = min(start + block_size, num_rows)
+                if str(type(X)).endswith("xgboost.core.DMatrix'>"):
+                    X_block = X if end - start == num_rows else X.slice(list(range(start, end)))
+                else:
+                    X_block = xgboost.DMatrix(X[start:end])
+                phi = self.model.original_model.predict(X_block, ntree_limit=tree_limit, pred_interactions=True)
+                phi = np.transpose(phi, (0, 2, 3, 1)) if len(phi.shape) == 4 else phi[:, :, :, np.newaxis]
 
-            # note we pull off the last column and keep it as our expected_value
-            if len(phi.shape) == 4:
-                self.expected_value = [phi[0, i, -1, -1] for i in range(phi.shape[1])]
-                return [phi[:, i, :-1, :-1] for i in range(phi.shape[1])]
-            else:
-                self.expected_value = phi[0, -1, -1]
-                return phi[:, :-1, :-1]
+                # note we pull off the last column and keep it as our expected_value
+                if phi.shape[3] == 1:
+                    self.expected_value = phi[0, -1, -1, 0]
+                else:
+                    self.expected_value = [phi[0, -1, -1, i] for i in range(phi.shape[3])]
+                yield phi
+            return
 
         # convert dataframes
-        if str(type(X)).endswith("pandas.core.series.Series'>"):
+        if str(type(X)).endswith("pandas.core.frame.DataFrame'>"):
             X = X.values
-        elif str(type(X)).endswith("pandas.core.frame.DataFrame'>"):
-            X = X.values
-        flat_output = False
-        if len(X.shape) == 1:
-            flat_output = True
-            X = X.reshape(1, X.shape[0])
-        if X.dtype != self.model.dtype:
-            X = X.astype(self.model.dtype)
-        X_missing = np.isnan(X, dtype=np.bool)
         assert str(type(X)).endswith("'numpy.ndarray'>"), "Unknown instance type: " + str(type(X))
         assert len(X.shape) == 2, "Passed input data matrix X must have 1 or 2 dimensions!"
 
-        if tree_limit < 0 or tree_limit > self.model.values.shape[0]:
-            tree_limit = self.model.values.shape[0]
+        if tree_limit < 0 or tree_limit > len(self.model.num_nodes):
+            tree_limit = len(self.model.num_nodes)
 
-        # run the core algorithm using the C extension
+        # run the core algorithm using the C extension, one block at a time
         assert_import("cext")
-        phi = np.zeros((X.shape[0], X.shape[1]+1, X.shape[1]+1, self.model.n_outputs))
-        _cext.dense_tree_shap(
-            self.model.children_left, self.model.children_right, self.model.children_default,
-            self.model.features, self.model.thresholds, self.model.values, self.model.node_sample_weight,
-            self.model.max_depth, X, X_missing, y, self.data, self.data_missing, tree_limit,
-            self.model.base_offset, phi, feature_dependence_codes[self.feature_dependence],
-            output_transform_codes[transform], True
-        )
+        for start in range(0, num_rows, block_size):
+            X_block = X[start:start + block_size]
+            phi = np.zeros((X_block.shape[0], X.shape[1]+1, X.shape[1]+1, self.model.n_outputs))
+            self.model.compiled.shap_values(
+                X_block, None, None, self.data, self.data_missing, tree_limit, phi,
+                feature_dependence_codes[self.feature_dependence], output_transform_codes[transform],
+                True, get_num_threads(n_jobs)
+            )
 
-        # note we pull off the last column and keep it as our expected_value
-        if self.model.n_outputs == 1:
-            self.expected_value = phi[0, -1, -1, 0]
-            if flat_output:
-                return phi[0, :-1, :-1, 0]
+            if self.model.n_outputs == 1:
+                self.expected_value = phi[0, -1, -1, 0]
             else:
-                return phi[:, :-1, :-1, 0]
+                self.expected_value = [phi[0, -1, -1, i] for i in range(phi.shape[3])]
+            yield phi
+
+
+    saved_arrays = [
+        "children_left", "children_right", "children_default", "features", "thresholds", "values",
+        "node_sample_weight", "num_nodes", "tree_offsets"
+    ]
+
+    def save(self, path):
+        """ Save the parsed trees (and background data) to a directory of raw .npy files.
+
+        Loading the directory back with `TreeExplainer.load` skips parsing the model and re-weighting the
+        trees, and memory maps the arrays so forked worker processes share the same pages. The directory
+        records a hash of the original model (see `get_model_hash`), so a cache can be stored under
+        `os.path.join(cache_dir, get_model_hash(model))` and checked against the model when it is loaded.
+
+        Parameters
+        ----------
+        path : str
+            The directory to write (it is created if it does not exist).
+        """
+        assert hasattr(self.model, "children_left"), "Only models parsed into internal trees can be saved!"
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        for name in self.saved_arrays:
+            np.save(os.path.join(path, name + ".npy"), getattr(self.model, name))
+        if self.data is not None:
+            np.save(os.path.join(path, "data.npy"), self.data)
+            np.save(os.path.join(path, "data_missing.npy"), self.data_missing)
+
+        original_model = getattr(self.model, "original_model", None)
+        metadata = {
+            "model_hash": None if original_model is None else get_model_hash(original_model),
+            "model_output": self.model_output,
+            "feature_dependence": self.feature_dependence,
+            "expected_value": None if callable(self.expected_value) else np.asarray(self.expected_value).tolist(),
+            "base_offset": float(self.model.base_offset),
+            "max_depth": int(self.model.max_depth),
+            "n_outputs": int(self.model.n_outputs),
+            "objective": self.model.objective,
+            "tree_output": self.model.tree_output,
+            "tree_limit": None if self.model.tree_limit is None else int(self.model.tree_limit),
+            "dtype": np.dtype(self.model.dtype).name,
+            "fully_defined_weighting": bool(self.model.fully_defined_weighting),
+            "has_data": self.data is not None
+        }
+        with open(os.path.join(path, "explainer.json"), "w") as f:
+            json.dump(metadata, f)
+
+    @staticmethod
+    def load(path, model=None, mmap=True):
+        """ Load a TreeExplainer written by `TreeExplainer.save`.
+
+        Parameters
+        ----------
+        path : str
+            The directory the explainer was saved to.
+
+        model : model object
+            If given, the hash of this model must match the model the explainer was saved from,
+            otherwise a ValueError is raised (so stale caches are never used).
+
+        mmap : bool
+            Memory map the arrays read-only instead of reading them into memory.
+
+        Returns
+        -------
+        A TreeExplainer that runs on the internal C++ implementation (the original model is not kept).
+        """
+        with open(os.path.join(path, "explainer.json")) as f:
+            metadata = json.load(f)
+        if model is not None and get_model_hash(model) != metadata["model_hash"]:
+            raise ValueError("The TreeExplainer saved in %s was built from a different model!" % path)
+        mmap_mode = "r" if mmap else None
+
+        ensemble = TreeEnsemble.__new__(TreeEnsemble)
+        for name in TreeExplainer.saved_arrays:
+            setattr(ensemble, name, np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode))
+        ensemble.model_type = "internal"
+        ensemble.trees = None
+        ensemble.base_offset = metadata["base_offset"]
+        ensemble.max_depth = metadata["max_depth"]
+        ensemble.n_outputs = metadata["n_outputs"]
+        ensemble.objective = metadata["objective"]
+        ensemble.tree_output = metadata["tree_output"]
+        ensemble.tree_limit = metadata["tree_limit"]
+        ensemble.dtype = np.dtype(metadata["dtype"]).type
+        ensemble.fully_defined_weighting = metadata["fully_defined_weighting"]
+
+        explainer = TreeExplainer.__new__(TreeExplainer)
+        explainer.model = ensemble
+        explainer.model_output = metadata["model_output"]
+        explainer.feature_dependence = metadata["feature_dependence"]
+        if metadata["has_data"]:
+            explainer.data = np.load(os.path.join(path, "data.npy"), mmap_mode=mmap_mode)
+            explainer.data_missing = np.load(os.path.join(path, "data_missing.npy"), mmap_mode=mmap_mode)
         else:
-            self.expected_value = [phi[0, -1, -1, i] for i in range(phi.shape[3])]
-            if flat_output:
-                return [phi[0, :-1, :-1, i] for i in range(self.model.n_outputs)]
-            else:
-                return [phi[:, :-1, :-1, i] for i in range(self.model.n_outputs)]
+            explainer.data = None
+            explainer.data_missing = None
+        ensemble.data = explainer.data
+        ensemble.data_missing = explainer.data_missing
+        explainer._background_margins_cache = {}
+
+        if explainer.model_output == "logloss":
+            explainer.expected_value = explainer.__dynamic_expected_value
+        elif isinstance(metadata["expected_value"], list):
+            explainer.expected_value = np.array(metadata["expected_value"])
+        else:
+            explainer.expected_value = metadata["expected_value"]
+        return explainer
 
 
 class TreeEnsemble:
@@ -369,6 +1033,7 @@ class TreeEnsemble:
 
     def __init__(self, model, data=None, data_missing=None):
         self.model_type = "internal"
+        self.original_model = model
         self.trees = None
         less_than_or_equal = True
         self.base_offset = 0
@@ -409,47 +1074,47 @@ class TreeEnsemble:
         elif str(type(model)).endswith("sklearn.ensemble.forest.RandomForestRegressor'>"):
             self.dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif str(type(model)).endswith("skopt.learning.forest.RandomForestRegressor'>"):
             self.dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif str(type(model)).endswith("sklearn.ensemble.forest.ExtraTreesRegressor'>"):
             self.dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif str(type(model)).endswith("skopt.learning.forest.ExtraTreesRegressor'>"):
             self.dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif str(type(model)).endswith("sklearn.tree.tree.DecisionTreeRegressor'>"):
             self.dtype = np.float32
-            self.trees = [Tree(model.tree_, data=data, data_missing=data_missing)]
+            self.trees = [Tree(model.tree_)]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif str(type(model)).endswith("sklearn.tree.tree.DecisionTreeClassifier'>"):
             self.dtype = np.float32
-            self.trees = [Tree(model.tree_, normalize=True, data=data, data_missing=data_missing)]
+            self.trees = [Tree(model.tree_, normalize=True)]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "probability"
         elif str(type(model)).endswith("sklearn.ensemble.forest.RandomForestClassifier'>"):
             self.dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "probability"
         elif str(type(model)).endswith("sklearn.ensemble.forest.ExtraTreesClassifier'>"): # TODO: add unit test for this case
             self.dtype = np.float32
             scaling = 1.0 / len(model.estimators_) # output is average of trees
-            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling, data=data, data_missing=data_missing) for e in model.estimators_]
+            self.trees = [Tree(e.tree_, normalize=True, scaling=scaling) for e in model.estimators_]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "probability"
         elif str(type(model)).endswith("sklearn.ensemble.gradient_boosting.GradientBoostingRegressor'>"):
@@ -463,7 +1128,7 @@ class TreeEnsemble:
             else:
                 assert False, "Unsupported init model type: " + str(type(model.init_))
 
-            self.trees = [Tree(e.tree_, scaling=model.learning_rate, data=data, data_missing=data_missing) for e in model.estimators_[:,0]]
+            self.trees = [Tree(e.tree_, scaling=model.learning_rate) for e in model.estimators_[:,0]]
             self.objective = objective_name_map.get(model.criterion, None)
             self.tree_output = "raw_value"
         elif str(type(model)).endswith("sklearn.ensemble.gradient_boosting.GradientBoostingClassifier'>"):
@@ -476,14 +1141,14 @@ class TreeEnsemble:
             else:
                 assert False, "Unsupported init model type: " + str(type(model.init_))
 
-            self.trees = [Tree(e.tree_, scaling=model.learning_rate, data=data, data_missing=data_missing) for e in model.estimators_[:,0]]
+            self.trees = [Tree(e.tree_, scaling=model.learning_rate) for e in model.estimators_[:,0]]
             self.objective = objective_name_map.get(model.criterion, None)
         elif str(type(model)).endswith("xgboost.core.Booster'>"):
             assert_import("xgboost")
             self.original_model = model
             self.model_type = "xgboost"
             xgb_loader = XGBTreeModelLoader(self.original_model)
-            self.trees = xgb_loader.get_trees(data=data, data_missing=data_missing)
+            self.trees = xgb_loader.get_trees()
             self.base_offset = xgb_loader.base_score
             less_than_or_equal = False
             self.objective = objective_name_map.get(xgb_loader.name_obj, None)
@@ -494,7 +1159,7 @@ class TreeEnsemble:
             self.model_type = "xgboost"
             self.original_model = model.get_booster()
             xgb_loader = XGBTreeModelLoader(self.original_model)
-            self.trees = xgb_loader.get_trees(data=data, data_missing=data_missing)
+            self.trees = xgb_loader.get_trees()
             self.base_offset = xgb_loader.base_score
             less_than_or_equal = False
             self.objective = objective_name_map.get(xgb_loader.name_obj, None)
@@ -505,7 +1170,7 @@ class TreeEnsemble:
             self.original_model = model.get_booster()
             self.model_type = "xgboost"
             xgb_loader = XGBTreeModelLoader(self.original_model)
-            self.trees = xgb_loader.get_trees(data=data, data_missing=data_missing)
+            self.trees = xgb_loader.get_trees()
             self.base_offset = xgb_loader.base_score
             less_than_or_equal = False
             self.objective = objective_name_map.get(model.objective, None)
@@ -515,9 +1180,9 @@ class TreeEnsemble:
             assert_import("lightgbm")
             self.model_type = "lightgbm"
             self.original_model = model
-            tree_info = self.original_model.dump_model()["tree_info"]
             try:
-                self.trees = [Tree(e, data=data, data_missing=data_missing) for e in tree_info]
+                tree_info = get_lightgbm_trees(self.original_model.model_to_string())
+                self.trees = [Tree(e) for e in tree_info]
             except:
                 self.trees = None # we get here because the cext can't handle categorical splits yet
             
@@ -528,9 +1193,9 @@ class TreeEnsemble:
             assert_import("lightgbm")
             self.model_type = "lightgbm"
             self.original_model = model.booster_
-            tree_info = self.original_model.dump_model()["tree_info"]
             try:
-                self.trees = [Tree(e, data=data, data_missing=data_missing) for e in tree_info]
+                tree_info = get_lightgbm_trees(self.original_model.model_to_string())
+                self.trees = [Tree(e) for e in tree_info]
             except:
                 self.trees = None # we get here because the cext can't handle categorical splits yet
             self.objective = objective_name_map.get(model.objective, None)
@@ -542,9 +1207,9 @@ class TreeEnsemble:
             assert_import("lightgbm")
             self.model_type = "lightgbm"
             self.original_model = model.booster_
-            tree_info = self.original_model.dump_model()["tree_info"]
             try:
-                self.trees = [Tree(e, data=data, data_missing=data_missing) for e in tree_info]
+                tree_info = get_lightgbm_trees(self.original_model.model_to_string())
+                self.trees = [Tree(e) for e in tree_info]
             except:
                 self.trees = None # we get here because the cext can't handle categorical splits yet
             self.objective = objective_name_map.get(model.objective, None)
@@ -556,51 +1221,119 @@ class TreeEnsemble:
             assert_import("catboost")
             self.model_type = "catboost"
             self.original_model = model
+            self.dtype = np.float32 # catboost compares float32 features to float32 borders
+            try:
+                tree_info, self.base_offset = get_catboost_trees(get_catboost_json(model))
+                self.trees = [Tree(e) for e in tree_info]
+            except:
+                self.trees = None # we get here for splits on categorical features, which the cext can't handle
+            self.objective = "squared_error"
+            self.tree_output = "raw_value"
         elif str(type(model)).endswith("catboost.core.CatBoostClassifier'>"):
             assert_import("catboost")
             self.model_type = "catboost"
             self.original_model = model
+            self.dtype = np.float32
+            try:
+                tree_info, self.base_offset = get_catboost_trees(get_catboost_json(model))
+                self.trees = [Tree(e) for e in tree_info]
+            except:
+                self.trees = None # we get here for splits on categorical features, which the cext can't handle
+            self.objective = "binary_crossentropy"
+            self.tree_output = "log_odds"
         else:
             raise Exception("Model type not yet supported by TreeExplainer: " + str(type(model)))
         
-        # build a dense numpy version of all the tree objects
+        # build a ragged numpy version of all the tree objects, where the nodes of tree i are stored
+        # in entries tree_offsets[i]:tree_offsets[i+1] of each array (so small trees are not padded)
         if self.trees is not None:
-            max_nodes = np.max([len(t.values) for t in self.trees])
             assert len(np.unique([t.values.shape[1] for t in self.trees])) == 1, "All trees in the ensemble must have the same output dimension!"
-            ntrees = len(self.trees)
             self.n_outputs = self.trees[0].values.shape[1]
+            self.num_nodes = np.array([len(t.values) for t in self.trees], dtype=np.int32)
+            self.tree_offsets = np.zeros(len(self.trees) + 1, dtype=np.int32)
+            np.cumsum(self.num_nodes, out=self.tree_offsets[1:])
 
-            # important to be -1 in unused sections!! This way we can tell which entries are valid.
-            self.children_left = -np.ones((ntrees, max_nodes), dtype=np.int32)
-            self.children_right = -np.ones((ntrees, max_nodes), dtype=np.int32)
-            self.children_default = -np.ones((ntrees, max_nodes), dtype=np.int32)
-            self.features = -np.ones((ntrees, max_nodes), dtype=np.int32)
+            self.children_left = np.concatenate([t.children_left for t in self.trees]).astype(np.int32, copy=False)
+            self.children_right = np.concatenate([t.children_right for t in self.trees]).astype(np.int32, copy=False)
+            self.children_default = np.concatenate([t.children_default for t in self.trees]).astype(np.int32, copy=False)
+            self.features = np.concatenate([t.features for t in self.trees]).astype(np.int32, copy=False)
+
+            self.thresholds = np.concatenate([t.thresholds for t in self.trees]).astype(self.dtype, copy=False)
+            self.values = np.concatenate([t.values for t in self.trees]).astype(self.dtype, copy=False)
+            self.node_sample_weight = np.concatenate([t.node_sample_weight for t in self.trees]).astype(self.dtype, copy=False)
 
-            self.thresholds = np.zeros((ntrees, max_nodes), dtype=self.dtype)
-            self.values = np.zeros((ntrees, max_nodes, self.trees[0].values.shape[1]), dtype=self.dtype)
-            self.node_sample_weight = np.zeros((ntrees, max_nodes), dtype=self.dtype)
-            
-            for i in range(ntrees):
-                l = len(self.trees[i].features)
-                self.children_left[i,:l] = self.trees[i].children_left
-                self.children_right[i,:l] = self.trees[i].children_right
-                self.children_default[i,:l] = self.trees[i].children_default
-                self.features[i,:l] = self.trees[i].features
-                self.thresholds[i,:l] = self.trees[i].thresholds
-                self.values[i,:l,:] = self.trees[i].values
-                self.node_sample_weight[i,:l] = self.trees[i].node_sample_weight
-
-                # ensure that the passed background dataset lands in every leaf
-                if np.min(self.trees[i].node_sample_weight) <= 0:
-                    self.fully_defined_weighting = False
-            
             # If we should do <= then we nudge the thresholds to make our <= work like <
             if not less_than_or_equal:
                 self.thresholds = np.nextafter(self.thresholds, -np.inf)
-            
-            self.num_nodes = np.array([len(t.values) for t in self.trees], dtype=np.int32)
+
             self.max_depth = np.max([t.max_depth for t in self.trees])
 
+            # re-compute the number of samples that pass through each node of every tree in one pass if we are given data
+            if data is not None and type(model) != list:
+                self.node_sample_weight[:] = 0
+                self.update_weights(data, data_missing)
+
+            # ensure that the passed background dataset lands in every leaf
+            if np.min(self.node_sample_weight) <= 0:
+                self.fully_defined_weighting = False
+
+    @property
+    def compiled(self):
+        """ A native handle to the ragged tree arrays, built once and reused by every call into the C extension.
+
+        Building the handle validates and wraps the model arrays, so repeated calls (for example explaining one
+        row per request) only pay for the tree traversals. Set `_compiled` to None if the arrays are replaced.
+        """
+        if getattr(self, "_compiled", None) is None:
+            assert_import("cext")
+            self._compiled = _cext.CompiledEnsemble(
+                self.children_left, self.children_right, self.children_default, self.features,
+                self.thresholds, self.values, self.node_sample_weight, self.max_depth, self.base_offset,
+                self.tree_offsets
+            )
+        return self._compiled
+
+    def update_weights(self, X, X_missing=None, weight=1.0, n_jobs=1):
+        """ Adds weight to the sample weight of every node the rows of X pass through and then re-computes
+        the expected values of the internal nodes, for all the trees at once.
+
+        Parameters
+        ----------
+        X : numpy.array
+            The background samples to add (or remove with a negative weight).
+
+        weight : float
+            The weight of each sample, so -1 removes samples that were added before.
+
+        n_jobs : int
+            The number of native threads the trees are split across. -1 means use all the CPU cores.
+        """
+        assert_import("cext")
+        X = np.ascontiguousarray(X, dtype=self.dtype)
+        X_missing = np.isnan(X) if X_missing is None else np.ascontiguousarray(X_missing, dtype=np.bool_)
+
+        # the arrays are updated in place, so copy them if they were loaded read-only (memory mapped)
+        if not self.values.flags.writeable:
+            self.values = self.values.copy()
+        if not self.node_sample_weight.flags.writeable:
+            self.node_sample_weight = self.node_sample_weight.copy()
+
+        self.max_depth = _cext.dense_ensemble_update_weights(
+            self.children_left, self.children_right, self.children_default, self.features,
+            self.thresholds, self.values, self.node_sample_weight, self.tree_offsets,
+            X, X_missing, weight, get_num_threads(n_jobs)
+        )
+        self.fully_defined_weighting = np.min(self.node_sample_weight) > 0
+        self._compiled = None
+
+    def __getstate__(self):
+        # the native handle can't be pickled, but is cheap to rebuild
+        state = self.__dict__.copy()
+        state.pop("_compiled", None)
+        if self.model_type == "internal":
+            state.pop("original_model", None) # only the other model types call back into the original model
+        return state
+
     def get_transform(self, model_output):
         """ A consistent interface to make predictions from this model.
         """
@@ -623,7 +1356,7 @@ class TreeEnsemble:
                 raise Exception("model_output = \"logloss\" is not supported when model.objective = \"" + self.objective + "\"!")
         return transform
 
-    def predict(self, X, y=None, output="margin", tree_limit=None):
+    def predict(self, X, y=None, output="margin", tree_limit=None, n_jobs=1, X_missing=None, leaves=None):
         """ A consistent interface to make predictions from this model.
 
         Parameters
@@ -631,6 +1364,17 @@ class TreeEnsemble:
         tree_limit : None (default) or int 
             Limit the number of trees used by the model. By default None means no use the limit of the
             original model, and -1 means no limit.
+
+        n_jobs : int
+            The number of native threads the rows of X are split across. -1 means use all the CPU cores.
+
+        X_missing : None (default) or numpy.array
+            A boolean matrix the shape of X marking its missing values. By default the NaN values of X are
+            found during the tree traversals.
+
+        leaves : None (default) or numpy.array
+            The leaves of the rows of X from `apply` with the same tree_limit. Their values are summed
+            instead of walking the trees again.
         """
 
         # see if we have a default tree_limit in place.
@@ -646,14 +1390,13 @@ class TreeEnsemble:
         if len(X.shape) == 1:
             flat_output = True
             X = X.reshape(1, X.shape[0])
-        if X.dtype != self.dtype:
-            X = X.astype(self.dtype)
-        X_missing = np.isnan(X, dtype=np.bool)
-        assert str(type(X)).endswith("'numpy.ndarray'>"), "Unknown instance type: " + str(type(X))
+        if X_missing is not None:
+            X_missing = np.asarray(X_missing).reshape(X.shape)
+        assert isinstance(X, np.ndarray), "Unknown instance type: " + str(type(X))
         assert len(X.shape) == 2, "Passed input data matrix X must have 1 or 2 dimensions!"
 
-        if tree_limit < 0 or tree_limit > self.values.shape[0]:
-            tree_limit = self.values.shape[0]
+        if tree_limit < 0 or tree_limit > len(self.num_nodes):
+            tree_limit = len(self.num_nodes)
 
         if output == "logloss":
             assert y is not None, "Both samples and labels must be provided when explaining the loss (i.e. `explainer.shap_values(X, y)`)!"
@@ -662,12 +1405,10 @@ class TreeEnsemble:
         
         if True or self.model_type == "internal":
             output = np.zeros((X.shape[0], self.n_outputs))
-            assert_import("cext")
-            _cext.dense_tree_predict(
-                self.children_left, self.children_right, self.children_default,
-                self.features, self.thresholds, self.values,
-                self.max_depth, tree_limit, self.base_offset, output_transform_codes[transform], 
-                X, X_missing, y, output
+            if leaves is not None:
+                leaves = np.asarray(leaves).reshape(X.shape[0], -1)
+            self.compiled.predict(
+                X, X_missing, y, tree_limit, output_transform_codes[transform], output, get_num_threads(n_jobs), leaves
             )
 
         elif self.model_type == "xgboost":
@@ -686,6 +1427,47 @@ class TreeEnsemble:
             else:
                 return output
 
+    def apply(self, X, tree_limit=None, n_jobs=1, X_missing=None):
+        """ The leaf each sample reaches in each tree.
+
+        The leaves can be passed to `predict` and `TreeExplainer.shap_values` (with the same tree_limit),
+        which then sum their values instead of walking the trees again to find the model's outputs.
+
+        Parameters
+        ----------
+        tree_limit, n_jobs, X_missing
+            See predict.
+
+        Returns
+        -------
+        An int32 matrix (# samples x # trees) of node indexes within each tree (a vector for a single sample).
+        """
+
+        # see if we have a default tree_limit in place.
+        if tree_limit is None:
+            tree_limit = -1 if self.tree_limit is None else self.tree_limit
+
+        # convert dataframes
+        if str(type(X)).endswith("pandas.core.series.Series'>"):
+            X = X.values
+        elif str(type(X)).endswith("pandas.core.frame.DataFrame'>"):
+            X = X.values
+        flat_output = False
+        if len(X.shape) == 1:
+            flat_output = True
+            X = X.reshape(1, X.shape[0])
+        if X_missing is not None:
+            X_missing = np.asarray(X_missing).reshape(X.shape)
+        assert isinstance(X, np.ndarray), "Unknown instance type: " + str(type(X))
+        assert len(X.shape) == 2, "Passed input data matrix X must have 1 or 2 dimensions!"
+
+        if tree_limit < 0 or tree_limit > len(self.num_nodes):
+            tree_limit = len(self.num_nodes)
+
+        leaves = np.zeros((X.shape[0], tree_limit), dtype=np.int32)
+        self.compiled.apply(X, X_missing, tree_limit, leaves, get_num_threads(n_jobs))
+        return leaves[0] if flat_output else leaves
+
 
 class Tree:
     """ A single decision tree.
@@ -727,9 +1509,9 @@ class Tree:
             self.thresholds = np.empty((2*num_parents+1), dtype=np.float64)
             self.values = [-2]*(2*num_parents+1)
             self.node_sample_weight = np.empty((2*num_parents+1), dtype=np.float64)
-            visited, queue = [], [start]
+            visited, queue = set(), collections.deque([start])
             while queue:
-                vertex = queue.pop(0)
+                vertex = queue.popleft()
                 if 'split_index' in vertex.keys():
                     if vertex['split_index'] not in visited:
                         if 'split_index' in vertex['left_child'].keys():
@@ -748,7 +1530,7 @@ class Tree:
                         self.thresholds[vertex['split_index']] = vertex['threshold']
                         self.values[vertex['split_index']] = [vertex['internal_value']]
                         self.node_sample_weight[vertex['split_index']] = vertex['internal_count']
-                        visited.append(vertex['split_index'])
+                        visited.add(vertex['split_index'])
                         queue.append(vertex['left_child'])
                         queue.append(vertex['right_child'])
                 else:
@@ -875,6 +1657,41 @@ class Tree:
 
 
 
+def get_num_threads(n_jobs):
+    """ Converts an sklearn style n_jobs value into a number of threads for the C extension.
+    """
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    return max(n_jobs, 1)
+
+
+def interaction_input_shape(X):
+    """ The (# samples, # features) of an input matrix, which may be an XGBoost DMatrix.
+    """
+    if str(type(X)).endswith("xgboost.core.DMatrix'>"):
+        return X.num_row(), X.num_col()
+    return X.shape[0], X.shape[1]
+
+
+def get_model_hash(model):
+    """ A hex digest of the bytes of a trained model, used to key saved TreeExplainer caches.
+
+    XGBoost and LightGBM models are hashed from their own serialized form, everything else is pickled.
+    """
+    if str(type(model)).endswith("xgboost.core.Booster'>"):
+        model_bytes = bytes(model.save_raw())
+    elif str(type(model)).endswith("xgboost.sklearn.XGBRegressor'>") or str(type(model)).endswith("xgboost.sklearn.XGBClassifier'>"):
+        model_bytes = bytes(model.get_booster().save_raw())
+    elif str(type(model)).endswith("lightgbm.basic.Booster'>"):
+        model_bytes = model.model_to_string().encode()
+    elif str(type(model)).endswith("lightgbm.sklearn.LGBMRegressor'>") or str(type(model)).endswith("lightgbm.sklearn.LGBMClassifier'>"):
+        model_bytes = model.booster_.model_to_string().encode()
+    else:
+        model_bytes = pickle.dumps(model, protocol=2)
+    return hashlib.sha1(model_bytes).hexdigest()
+
  
 def get_xgboost_json(model):
     """ This gets a JSON dump of an XGBoost model while ensuring the features names are their indexes.
@@ -891,12 +1708,277 @@ def get_xgboost_json(model):
     return json_trees
 
 
+def get_lightgbm_trees(model_string, max_tree_nodes=2**20):
+    """ This parses the trees of a LightGBM text model (from `Booster.model_to_string()`).
+
+    Each tree's node arrays are read straight from the text in time linear in the size of the
+    model, and are returned as dicts in the format the Tree constructor accepts. The internal
+    nodes of a tree come first followed by its leaves (just like the `dump_model()` JSON).
+
+    Categorical splits are rewritten as threshold splits (see `expand_lightgbm_categorical_tree`),
+    which copies the subtrees below them. A tree that would grow past max_tree_nodes raises an error.
+
+    Multi-class models grow num_tree_per_iteration trees per boosting round (one for each class), so
+    tree i only writes to output i % num_tree_per_iteration of the returned multi-output trees.
+    """
+    blocks = model_string.split("\nend of trees")[0].split("\nTree=")
+    header = dict(line.split("=", 1) for line in blocks[0].split("\n") if "=" in line)
+    num_outputs = int(header.get("num_tree_per_iteration", 1))
+
+    trees = []
+    for block in blocks[1:]:
+        fields = dict(line.split("=", 1) for line in block.split("\n")[1:] if "=" in line)
+        num_leaves = int(fields["num_leaves"])
+        num_parents = num_leaves - 1
+        leaf_value = np.array(fields["leaf_value"].split(), dtype=np.float64)
+        leaf_count = np.array(fields["leaf_count"].split(), dtype=np.float64)
+        leaf_fill = -np.ones(num_leaves, dtype=np.int32)
+
+        if num_parents == 0:
+            children_left = children_right = children_default = features = leaf_fill
+            thresholds = -np.ones(1)
+            values = leaf_value[:1]
+            node_sample_weight = leaf_count[:1]
+        else:
+            decision_type = np.array(fields["decision_type"].split(), dtype=np.int32)
+            if np.any(decision_type & 1 != 0):
+                trees.append(expand_lightgbm_categorical_tree(fields, max_tree_nodes))
+                continue
+
+            # negative children are leaves, stored as ~leaf_index
+            left = np.array(fields["left_child"].split(), dtype=np.int32)
+            right = np.array(fields["right_child"].split(), dtype=np.int32)
+            left = np.where(left < 0, ~left + num_parents, left)
+            right = np.where(right < 0, ~right + num_parents, right)
+            default = np.where(decision_type & 2 != 0, left, right)
+            children_left = np.concatenate([left, leaf_fill])
+            children_right = np.concatenate([right, leaf_fill])
+            children_default = np.concatenate([default, leaf_fill])
+            features = np.concatenate([np.array(fields["split_feature"].split(), dtype=np.int32), leaf_fill])
+            thresholds = np.concatenate([np.array(fields["threshold"].split(), dtype=np.float64), leaf_fill])
+            values = np.concatenate([np.array(fields["internal_value"].split(), dtype=np.float64), leaf_value])
+            node_sample_weight = np.concatenate([
+                np.array(fields["internal_count"].split(), dtype=np.float64), leaf_count
+            ])
+
+        trees.append({
+            "children_left": children_left,
+            "children_right": children_right,
+            "children_default": children_default,
+            "feature": features,
+            "threshold": thresholds,
+            "value": values.reshape(-1, 1),
+            "node_sample_weight": node_sample_weight
+        })
+
+    if num_outputs > 1:
+        for i, tree in enumerate(trees):
+            values = np.zeros((len(tree["value"]), num_outputs))
+            values[:, i % num_outputs] = tree["value"][:, 0]
+            tree["value"] = values
+    return trees
+
+
+def expand_lightgbm_categorical_tree(fields, max_tree_nodes=2**20):
+    """ Builds a tree dict from the fields of a LightGBM text tree that has categorical splits.
+
+    LightGBM sends a value down the left branch of a categorical split when its integer category is
+    in the split's bitset. The categories in the bitset form runs of consecutive integers, so the split
+    is equivalent to a chain of threshold splits on the same feature that cut the real line into
+    intervals, each of which belongs to the left or the right branch. Every interval gets its own copy
+    of the branch's subtree, with the branch's sample weight shared equally between the copies (so
+    the tree's expected value is unchanged).
+    """
+    split_feature = np.array(fields["split_feature"].split(), dtype=np.int32)
+    threshold = np.array(fields["threshold"].split(), dtype=np.float64)
+    decision_type = np.array(fields["decision_type"].split(), dtype=np.int32)
+    left_child = np.array(fields["left_child"].split(), dtype=np.int32)
+    right_child = np.array(fields["right_child"].split(), dtype=np.int32)
+    internal_count = np.array(fields["internal_count"].split(), dtype=np.float64)
+    leaf_value = np.array(fields["leaf_value"].split(), dtype=np.float64)
+    leaf_count = np.array(fields["leaf_count"].split(), dtype=np.float64)
+    cat_boundaries = np.array(fields["cat_boundaries"].split(), dtype=np.int64)
+    cat_threshold = np.array(fields["cat_threshold"].split(), dtype=np.uint32)
+
+    children_left, children_right, children_default = [], [], []
+    features, thresholds, values, node_sample_weight = [], [], [], []
+
+    def new_node():
+        if len(values) >= max_tree_nodes:
+            raise Exception("Expanding the categorical splits of a LightGBM tree needs more than %d nodes!" % max_tree_nodes)
+        for l in (children_left, children_right, children_default, features):
+            l.append(-1)
+        thresholds.append(0.0)
+        values.append(0.0) # the internal values are filled in by compute_expectations
+        node_sample_weight.append(0.0)
+        return len(values) - 1
+
+    def set_split(i, feature, threshold, left, right, default):
+        children_left[i], children_right[i], children_default[i] = left, right, default
+        features[i] = feature
+        thresholds[i] = threshold
+        node_sample_weight[i] = node_sample_weight[left] + node_sample_weight[right]
+
+    def build(node, scale):
+        if node >= 0 and decision_type[node] & 1:
+            return build_categorical(node, scale)
+        i = new_node()
+        if node < 0:
+            values[i] = leaf_value[~node]
+            node_sample_weight[i] = leaf_count[~node] * scale
+        else:
+            left = build(left_child[node], scale)
+            right = build(right_child[node], scale)
+            default = left if decision_type[node] & 2 else right
+            set_split(i, split_feature[node], threshold[node], left, right, default)
+            node_sample_weight[i] = internal_count[node] * scale
+        return i
+
+    def build_categorical(node, scale):
+        # the categories where membership in the bitset changes (the first category of every run and the one after it)
+        cat_index = int(threshold[node])
+        words = cat_threshold[cat_boundaries[cat_index]:cat_boundaries[cat_index + 1]]
+        in_set = np.unpackbits(words.astype("<u4").view(np.uint8), bitorder="little").astype(bool)
+        in_set = np.concatenate([[False], in_set, [False]])
+        breakpoints = np.flatnonzero(in_set[1:] != in_set[:-1])
+        num_left = len(breakpoints) // 2
+        num_right = num_left + 1
+
+        # negative values go right, and missing values go right when the missing type is NaN (otherwise
+        # they are treated as category 0)
+        missing_value = np.inf if (decision_type[node] >> 2) & 3 == 2 else 0.0
+
+        # the odd numbered intervals between the breakpoints are the runs of categories that go left
+        def build_intervals(lo, hi):
+            if lo == hi:
+                if lo % 2 == 1:
+                    return build(left_child[node], scale / num_left)
+                return build(right_child[node], scale / num_right)
+            mid = (lo + hi) // 2
+            i = new_node()
+            cut = breakpoints[mid]
+            cut_threshold = -1.0 if cut == 0 else np.nextafter(float(cut), -np.inf) # x <= t means x < cut
+            left = build_intervals(lo, mid)
+            right = build_intervals(mid + 1, hi)
+            set_split(i, split_feature[node], cut_threshold, left, right, left if missing_value < cut else right)
+            return i
+
+        return build_intervals(0, len(breakpoints))
+
+    build(0, 1.0)
+    return {
+        "children_left": np.array(children_left, dtype=np.int32),
+        "children_right": np.array(children_right, dtype=np.int32),
+        "children_default": np.array(children_default, dtype=np.int32),
+        "feature": np.array(features, dtype=np.int32),
+        "threshold": np.array(thresholds, dtype=np.float64),
+        "value": np.array(values, dtype=np.float64).reshape(-1, 1),
+        "node_sample_weight": np.array(node_sample_weight, dtype=np.float64)
+    }
+
+
+def get_catboost_json(model):
+    """ This gets the JSON export of a CatBoost model (which can only be written to a file).
+    """
+    fd, path = tempfile.mkstemp(suffix=".json")
+    os.close(fd)
+    try:
+        model.save_model(path, format="json")
+        with open(path) as f:
+            return json.load(f)
+    finally:
+        os.remove(path)
+
+
+def get_catboost_trees(model_json):
+    """ This converts the oblivious trees of a CatBoost JSON model into tree dicts for the Tree constructor.
+
+    Every level of an oblivious tree uses the same split, and the leaf index has bit i set when
+    the value is above the border of the i'th split. So the tree is expanded into a complete binary
+    tree (stored breadth first) whose root uses the last split. Only splits on float features are
+    supported. Returns the list of trees and the model's bias (the base offset).
+    """
+    float_features = model_json["features_info"]["float_features"]
+    flat_index = dict((f["feature_index"], f["flat_feature_index"]) for f in float_features)
+    nan_goes_right = dict((f["feature_index"], f.get("nan_value_treatment") == "AsTrue") for f in float_features)
+
+    scale, bias = 1.0, 0.0
+    if "scale_and_bias" in model_json:
+        scale, bias = model_json["scale_and_bias"]
+        bias = np.atleast_1d(bias)
+        assert np.all(bias == bias[0]), "CatBoost models with a different bias for each output are not yet supported!"
+        bias = float(bias[0])
+
+    trees = []
+    for tree in model_json["oblivious_trees"]:
+        splits = tree.get("splits") or []
+        for split in splits:
+            assert split["split_type"] == "FloatFeature", "Only CatBoost splits on float features are supported!"
+        depth = len(splits)
+        num_internal = 2**depth - 1
+        num_nodes = 2**(depth + 1) - 1
+        leaf_values = np.array(tree["leaf_values"], dtype=np.float64).reshape(2**depth, -1) * scale
+        leaf_weights = np.array(tree["leaf_weights"], dtype=np.float64)
+
+        # leaves no training sample reached have zero weight, which leaves the expectations and path
+        # fractions above them undefined, so give them a vanishing weight (the limit CatBoost's own
+        # ShapValues take)
+        leaf_weights[leaf_weights <= 0] = 1e-12 * max(leaf_weights.sum(), 1.0)
+
+        # node i has children 2i+1 and 2i+2, and level l of the tree uses splits[depth - 1 - l]
+        nodes = np.arange(num_internal)
+        level_splits = [splits[depth - 1 - l] for l in np.floor(np.log2(nodes + 1)).astype(np.int32)]
+        children_left = -np.ones(num_nodes, dtype=np.int32)
+        children_right = -np.ones(num_nodes, dtype=np.int32)
+        children_left[:num_internal] = 2 * nodes + 1
+        children_right[:num_internal] = 2 * nodes + 2
+        children_default = children_left.copy()
+        features = -np.ones(num_nodes, dtype=np.int32)
+        thresholds = np.zeros(num_nodes, dtype=np.float64)
+        for i, split in enumerate(level_splits):
+            features[i] = flat_index[split["float_feature_index"]]
+            thresholds[i] = split["border"]
+            if nan_goes_right[split["float_feature_index"]]:
+                children_default[i] = children_right[i]
+
+        values = np.zeros((num_nodes, leaf_values.shape[1]), dtype=np.float64)
+        values[num_internal:] = leaf_values
+        node_sample_weight = np.zeros(num_nodes, dtype=np.float64)
+        node_sample_weight[num_internal:] = leaf_weights
+        for l in range(depth - 1, -1, -1):
+            start = 2**l - 1
+            node_sample_weight[start:2 * start + 1] = node_sample_weight[2 * start + 1:4 * start + 3].reshape(-1, 2).sum(1)
+
+        trees.append({
+            "children_left": children_left,
+            "children_right": children_right,
+            "children_default": children_default,
+            "feature": features,
+            "threshold": thresholds,
+            "value": values,
+            "node_sample_weight": node_sample_weight
+        })
+    return trees, bias
+
+
 class XGBTreeModelLoader(object):
     """ This loads an XGBoost model directly from a raw memory dump.
 
     We can't use the JSON dump because due to numerical precision issues those
     tree can actually be wrong when feature values land almost on a threshold.
     """
+    tree_param_dtype = np.dtype([
+        ("num_roots", np.int32), ("num_nodes", np.int32), ("num_deleted", np.int32),
+        ("max_depth", np.int32), ("num_feature", np.int32), ("size_leaf_vector", np.int32),
+        ("reserved", np.int32, 31)
+    ])
+    node_dtype = np.dtype([
+        ("parent", np.int32), ("cleft", np.int32), ("cright", np.int32), ("sindex", np.uint32), ("info", np.float32)
+    ])
+    stat_dtype = np.dtype([
+        ("loss_chg", np.float32), ("sum_hess", np.float32), ("base_weight", np.float32), ("leaf_child_cnt", np.int32)
+    ])
+
     def __init__(self, xgb_model):
         self.buf = xgb_model.save_raw()
         self.pos = 0
@@ -925,7 +2007,7 @@ class XGBTreeModelLoader(object):
         self.size_leaf_vector = self.read('i')
         self.read_arr('i', 32) # reserved
         
-        # load each tree
+        # load each tree (the node and stat blocks are read as zero-copy structured arrays over the buffer)
         self.num_roots = np.zeros(self.num_trees, dtype=np.int32)
         self.num_nodes = np.zeros(self.num_trees, dtype=np.int32)
         self.num_deleted = np.zeros(self.num_trees, dtype=np.int32)
@@ -944,76 +2026,57 @@ class XGBTreeModelLoader(object):
         for i in range(self.num_trees):
             
             # load the per-tree params
-            self.num_roots[i] = self.read('i')
-            self.num_nodes[i] = self.read('i')
-            self.num_deleted[i] = self.read('i')
-            self.max_depth[i] = self.read('i')
-            self.num_feature[i] = self.read('i')
-            self.size_leaf_vector[i] = self.read('i')
+            tree_param = self.read_struct_arr(self.tree_param_dtype, 1)[0]
+            self.num_roots[i] = tree_param["num_roots"]
+            self.num_nodes[i] = tree_param["num_nodes"]
+            self.num_deleted[i] = tree_param["num_deleted"]
+            self.max_depth[i] = tree_param["max_depth"]
+            self.num_feature[i] = tree_param["num_feature"]
+            self.size_leaf_vector[i] = tree_param["size_leaf_vector"]
             
             # load the nodes
-            self.read_arr('i', 31) # reserved
-            self.node_parents.append(np.zeros(self.num_nodes[i], dtype=np.int32))
-            self.node_cleft.append(np.zeros(self.num_nodes[i], dtype=np.int32))
-            self.node_cright.append(np.zeros(self.num_nodes[i], dtype=np.int32))
-            self.node_sindex.append(np.zeros(self.num_nodes[i], dtype=np.uint32))
-            self.node_info.append(np.zeros(self.num_nodes[i], dtype=np.float32))
-            for j in range(self.num_nodes[i]):
-                self.node_parents[-1][j] = self.read('i')
-                self.node_cleft[-1][j] = self.read('i')
-                self.node_cright[-1][j] = self.read('i')
-                self.node_sindex[-1][j] = self.read('I')
-                self.node_info[-1][j] = self.read('f')
-#                 print("self.node_cleft[-1][%d]" % j, self.node_cleft[-1][j])
-#                 print("self.node_cright[-1][%d]" % j, self.node_cright[-1][j])
-#                 print("self.node_sindex[-1][%d]" % j, self.node_sindex[-1][j])
-#                 print("self.node_info[-1][%d]" % j, self.node_info[-1][j])
-#                 print()
+            nodes = self.read_struct_arr(self.node_dtype, self.num_nodes[i])
+            self.node_parents.append(nodes["parent"])
+            self.node_cleft.append(nodes["cleft"])
+            self.node_cright.append(nodes["cright"])
+            self.node_sindex.append(nodes["sindex"])
+            self.node_info.append(nodes["info"])
             
             # load the stat nodes
-            self.loss_chg.append(np.zeros(self.num_nodes[i], dtype=np.float32))
-            self.sum_hess.append(np.zeros(self.num_nodes[i], dtype=np.float32))
-            self.base_weight.append(np.zeros(self.num_nodes[i], dtype=np.float32))
-            self.leaf_child_cnt.append(np.zeros(self.num_nodes[i], dtype=np.int))
-            for j in range(self.num_nodes[i]):
-                self.loss_chg[-1][j] = self.read('f')
-                self.sum_hess[-1][j] = self.read('f')
-                self.base_weight[-1][j] = self.read('f')
-                self.leaf_child_cnt[-1][j] = self.read('i')
-#                 print("self.loss_chg[-1][%d]" % j, self.loss_chg[-1][j])
-#                 print("self.sum_hess[-1][%d]" % j, self.sum_hess[-1][j])
-#                 print("self.base_weight[-1][%d]" % j, self.base_weight[-1][j])
-#                 print("self.leaf_child_cnt[-1][%d]" % j, self.leaf_child_cnt[-1][j])
-#                 print()
+            stats = self.read_struct_arr(self.stat_dtype, self.num_nodes[i])
+            self.loss_chg.append(stats["loss_chg"])
+            self.sum_hess.append(stats["sum_hess"])
+            self.base_weight.append(stats["base_weight"])
+            self.leaf_child_cnt.append(stats["leaf_child_cnt"])
 
     def get_trees(self, data=None, data_missing=None):
-        shape = (self.num_trees, self.num_nodes.max())
-        self.children_default = np.zeros(shape, dtype=np.int)
-        self.features = np.zeros(shape, dtype=np.int)
-        self.thresholds = np.zeros(shape, dtype=np.float32)
-        self.values = np.zeros((shape[0], shape[1], 1), dtype=np.float32)
+        
+        # decode all the nodes of all the trees at once, where tree i spans tree_offsets[i]:tree_offsets[i+1]
+        tree_offsets = np.zeros(self.num_trees + 1, dtype=np.int64)
+        np.cumsum(self.num_nodes, out=tree_offsets[1:])
+        cleft = np.concatenate(self.node_cleft)
+        cright = np.concatenate(self.node_cright)
+        sindex = np.concatenate(self.node_sindex)
+        info = np.concatenate(self.node_info)
+        sum_hess = np.concatenate(self.sum_hess) # a copy, since the trees update their weights in place
+        is_leaf = cleft < 0
+        default_left = np.right_shift(sindex, np.uint32(31)) != 0
+        self.children_default = np.where(default_left, cleft, cright)
+        self.features = (sindex & ((np.uint32(1) << np.uint32(31)) - np.uint32(1))).astype(np.int32)
+        self.thresholds = np.where(is_leaf, np.float32(0), info)
+        self.values = np.where(is_leaf, info, np.float32(0)).reshape(-1, 1)
+
         trees = []
         for i in range(self.num_trees):
-            for j in range(self.num_nodes[i]):
-                if np.right_shift(self.node_sindex[i][j], np.uint32(31)) != 0:
-                    self.children_default[i,j] = self.node_cleft[i][j]
-                else:
-                    self.children_default[i,j] = self.node_cright[i][j]
-                self.features[i,j] = self.node_sindex[i][j] & ((np.uint32(1) << np.uint32(31)) - np.uint32(1))
-                if self.node_cleft[i][j] >= 0:
-                    self.thresholds[i,j] = self.node_info[i][j]
-                else:
-                    self.values[i,j] = self.node_info[i][j]
-
-            l = len(self.node_cleft[i])
+            start, end = tree_offsets[i], tree_offsets[i+1]
             trees.append(Tree({
                 "children_left": self.node_cleft[i],
                 "children_right": self.node_cright[i],
-                "children_default": self.children_default[i,:l],
-                "feature": self.features[i,:l],
-                "threshold": self.thresholds[i,:l],
-                "value": self.values[i,:l],
-                "node_sample_weight": self.sum_hess[i]
+                "children_default": self.children_default[start:end],
+                "feature": self.features[start:end],
+                "threshold": self.thresholds[start:end],
+                "value": self.values[start:end],
+                "node_sample_weight": sum_hess[start:end]
             }, data=data, data_missing=data_missing))
         return trees
             
@@ -1031,6 +2094,11 @@ class XGBTreeModelLoader(object):
         self.pos += size
         return val
     
+    def read_struct_arr(self, dtype, n_items):
+        val = np.frombuffer(self.buf, dtype=dtype, count=n_items, offset=self.pos)
+        self.pos += dtype.itemsize * n_items
+        return val
+    
     def read_str(self, size):
         val = self.buf[self.pos:self.pos+size].decode('utf-8')
         self.pos += size
@@ -11,6 +11,8 @@
 #include <stdio.h> 
 #include <cmath>
 #include <ctime>
+#include <thread>
+#include <vector>
 #if defined(_WIN32) || defined(WIN32)
     #include <malloc.h>
 #else
@@ -18,6 +20,8 @@
 #endif
 using namespace std;
 
+// tfloat is used for all accumulations and outputs, while the model and data arrays are
+// stored in the float type T that the templated structs and functions below are given
 typedef double tfloat;
 
 namespace FEATURE_DEPENDENCE {
@@ -33,6 +37,12 @@ namespace MODEL_TRANSFORM {
     const unsigned squared_loss = 3;
 }
 
+namespace INTERACTION_REDUCE {
+    const unsigned none = 0;
+    const unsigned sum = 1;
+    const unsigned sum_abs = 2;
+}
+
 namespace OBJECTIVE { 
     const unsigned squared_error = 0;
     const unsigned logistic = 1;
@@ -43,34 +53,101 @@ namespace TRANSFORM {
     const unsigned logistic = 1;
 }
 
+/**
+ * Whether feature f of x is missing. Without an explicit mask (x_missing is NULL) NaN values are missing,
+ * which saves building a full boolean copy of X for every call.
+ */
+template <typename T>
+inline bool is_missing(const T *x, const bool *x_missing, const unsigned f) {
+    return x_missing == NULL ? x[f] != x[f] : x_missing[f];
+}
+
+// the mask of the rows starting at offset (or NULL when there is no explicit mask)
+inline const bool *missing_offset(const bool *x_missing, const size_t offset) {
+    return x_missing == NULL ? NULL : x_missing + offset;
+}
+
+inline bool *missing_offset(bool *x_missing, const size_t offset) {
+    return x_missing == NULL ? NULL : x_missing + offset;
+}
+
+/**
+ * The split structure of a tree node packed into a single struct (16 bytes for float32 models),
+ * so walking down a tree touches one cache line per node instead of one per array. Instead of
+ * storing children_default we store the complement ~feature for nodes whose missing values go
+ * right. Leaves have children_left < 0 and a meaningless feature.
+ */
+template <typename T>
+struct TreeNode {
+    int children_left;
+    int children_right;
+    int feature;
+    T threshold;
+
+    inline unsigned split_feature() const {
+        return feature < 0 ? ~feature : feature;
+    }
+
+    inline int next_node(const T *x, const bool *x_missing) const {
+        if (feature < 0) {
+            const unsigned f = ~feature;
+            return !is_missing(x, x_missing, f) && x[f] <= threshold ? children_left : children_right;
+        }
+        return is_missing(x, x_missing, feature) || x[feature] <= threshold ? children_left : children_right;
+    }
+};
+
+/**
+ * The nodes of every tree are stored contiguously in each array. When tree_offsets is given the
+ * trees are stored back to back (tree i spans [tree_offsets[i], tree_offsets[i + 1])) and max_nodes
+ * is the size of the largest tree, otherwise every tree is padded to max_nodes entries. An ensemble
+ * can also be a view of the trees [first_tree, first_tree + tree_limit) of the arrays (see get_tree_range).
+ */
+template <typename T = tfloat>
 struct TreeEnsemble {
+    TreeNode<T> *nodes;
+    int *tree_offsets;
+    int *unique_features; // optional, see fill_unique_features
     int *children_left;
     int *children_right;
     int *children_default;
     int *features;
-    tfloat *thresholds;
-    tfloat *values;
-    tfloat *node_sample_weights;
+    T *thresholds;
+    T *values;
+    T *node_sample_weights;
     unsigned max_depth;
     unsigned tree_limit;
     tfloat base_offset;
     unsigned max_nodes;
     unsigned num_outputs;
+    unsigned first_tree;
 
-    TreeEnsemble() {}
+    TreeEnsemble() : nodes(NULL), tree_offsets(NULL), unique_features(NULL), first_tree(0) {}
     TreeEnsemble(int *children_left, int *children_right, int *children_default, int *features,
-                 tfloat *thresholds, tfloat *values, tfloat *node_sample_weights,
+                 T *thresholds, T *values, T *node_sample_weights,
                  unsigned max_depth, unsigned tree_limit, tfloat base_offset,
-                 unsigned max_nodes, unsigned num_outputs) :
-        children_left(children_left), children_right(children_right),
+                 unsigned max_nodes, unsigned num_outputs, int *tree_offsets = NULL) :
+        nodes(NULL), tree_offsets(tree_offsets), unique_features(NULL), children_left(children_left), children_right(children_right),
         children_default(children_default), features(features), thresholds(thresholds),
         values(values), node_sample_weights(node_sample_weights),
         max_depth(max_depth), tree_limit(tree_limit),
-        base_offset(base_offset), max_nodes(max_nodes), num_outputs(num_outputs) {}
+        base_offset(base_offset), max_nodes(max_nodes), num_outputs(num_outputs), first_tree(0) {}
+
+    // the position of the first node of tree i (tree_offset(tree_limit) is one past the last node)
+    inline unsigned tree_offset(const unsigned i) const {
+        return tree_offsets == NULL ? (first_tree + i) * max_nodes : tree_offsets[first_tree + i];
+    }
+
+    inline unsigned tree_num_nodes(const unsigned i) const {
+        return tree_offset(i + 1) - tree_offset(i);
+    }
 
     void get_tree(TreeEnsemble &tree, const unsigned i) const {
-        const unsigned d = i * max_nodes;
+        const unsigned d = tree_offset(i);
 
+        tree.nodes = nodes + d;
+        tree.tree_offsets = NULL;
+        tree.unique_features = unique_features == NULL ? NULL : unique_features + d;
         tree.children_left = children_left + d;
         tree.children_right = children_right + d;
         tree.children_default = children_default + d;
@@ -83,22 +160,83 @@ struct TreeEnsemble {
         tree.base_offset = base_offset;
         tree.max_nodes = max_nodes;
         tree.num_outputs = num_outputs;
+        tree.first_tree = 0;
+    }
+
+    // a view of the trees [start, start + count) that shares the arrays, so node positions (and any
+    // tables laid out like the nodes) stay those of this ensemble
+    void get_tree_range(TreeEnsemble &range, const unsigned start, const unsigned count) const {
+        range = *this;
+        range.first_tree = first_tree + start;
+        range.tree_limit = count;
     }
 
     void allocate(unsigned tree_limit_in, unsigned max_nodes_in, unsigned num_outputs_in) {
         tree_limit = tree_limit_in;
         max_nodes = max_nodes_in;
         num_outputs = num_outputs_in;
+        first_tree = 0;
+        tree_offsets = NULL;
+        unique_features = NULL;
         children_left = new int[tree_limit * max_nodes];
         children_right = new int[tree_limit * max_nodes];
         children_default = new int[tree_limit * max_nodes];
         features = new int[tree_limit * max_nodes];
-        thresholds = new tfloat[tree_limit * max_nodes];
-        values = new tfloat[tree_limit * max_nodes * num_outputs];
-        node_sample_weights = new tfloat[tree_limit * max_nodes];
+        thresholds = new T[tree_limit * max_nodes];
+        values = new T[tree_limit * max_nodes * num_outputs];
+        node_sample_weights = new T[tree_limit * max_nodes];
+    }
+
+    // fills the packed nodes of the first tree_limit trees from the separate node arrays
+    void fill_nodes(TreeNode<T> *out_nodes) const {
+        for (unsigned i = 0; i < tree_offset(tree_limit); ++i) {
+            TreeNode<T> &node = out_nodes[i];
+            node.children_left = children_left[i];
+            node.children_right = children_right[i];
+            node.threshold = thresholds[i];
+            if (children_left[i] < 0) {
+                node.feature = 0;
+            } else if (children_default[i] == children_right[i]) {
+                node.feature = ~features[i];
+            } else {
+                node.feature = features[i];
+            }
+        }
+    }
+
+    // builds packed nodes owned by this ensemble (released by free_nodes or free)
+    void pack_nodes() {
+        nodes = new TreeNode<T>[tree_offset(tree_limit)];
+        fill_nodes(nodes);
+    }
+
+    // fills out (laid out like the nodes) with the distinct split features of each tree in the order they
+    // first appear, followed by -1 when a tree splits on fewer features than it has nodes
+    void fill_unique_features(int *out) const {
+        std::vector<unsigned> last_tree; // one more than the last tree each feature was seen in
+        for (unsigned i = 0; i < tree_limit; ++i) {
+            const unsigned d = tree_offset(i);
+            const unsigned num_nodes = tree_num_nodes(i);
+            unsigned count = 0;
+            for (unsigned j = d; j < d + num_nodes; ++j) {
+                if (children_left[j] < 0) continue;
+                const unsigned f = features[j];
+                if (f >= last_tree.size()) last_tree.resize(f + 1, 0);
+                if (last_tree[f] == i + 1) continue;
+                last_tree[f] = i + 1;
+                out[d + count++] = f;
+            }
+            if (count < num_nodes) out[d + count] = -1;
+        }
+    }
+
+    void free_nodes() {
+        delete[] nodes;
+        nodes = NULL;
     }
 
     void free() {
+        free_nodes();
         delete[] children_left;
         delete[] children_right;
         delete[] children_default;
@@ -109,30 +247,70 @@ struct TreeEnsemble {
     }
 };
 
+template <typename T = tfloat>
 struct ExplanationDataset {
-    tfloat *X;
+    T *X;
     bool *X_missing;
     tfloat *y;
-    tfloat *R;
+    T *R;
     bool *R_missing;
     unsigned num_X;
     unsigned M;
     unsigned num_R;
+    const tfloat *R_margins = NULL; // optional precomputed margins of R (num_R x num_outputs)
+    const int *X_leaves = NULL; // optional leaf of each row of X in each tree (num_X x num_leaf_trees)
+    unsigned num_leaf_trees = 0;
 
     ExplanationDataset() {}
-    ExplanationDataset(tfloat *X, bool *X_missing, tfloat *y, tfloat *R, bool *R_missing, unsigned num_X,
+    ExplanationDataset(T *X, bool *X_missing, tfloat *y, T *R, bool *R_missing, unsigned num_X,
                        unsigned M, unsigned num_R) : 
         X(X), X_missing(X_missing), y(y), R(R), R_missing(R_missing), num_X(num_X), M(M), num_R(num_R) {}
 
     void get_x_instance(ExplanationDataset &instance, const unsigned i) const {
         instance.M = M;
         instance.X = X + i * M;
-        instance.X_missing = X_missing + i * M;
+        instance.X_missing = missing_offset(X_missing, i * M);
+        instance.X_leaves = X_leaves == NULL ? NULL : X_leaves + i * num_leaf_trees;
+        instance.num_leaf_trees = num_leaf_trees;
         instance.num_X = 1;
     }
+
+    // a view of the rows [start, end) of X (and y) that shares the background data
+    void get_x_slice(ExplanationDataset &slice, const unsigned start, const unsigned end) const {
+        slice = *this;
+        slice.X = X + start * M;
+        slice.X_missing = missing_offset(X_missing, start * M);
+        slice.y = y == NULL ? NULL : y + start;
+        slice.X_leaves = X_leaves == NULL ? NULL : X_leaves + start * num_leaf_trees;
+        slice.num_X = end - start;
+    }
 };
 
 
+/**
+ * Splits the rows [0, num_rows) into contiguous blocks and runs func(start, end, thread_index)
+ * on each block in its own native thread. With a single thread func runs in the calling thread.
+ */
+template<typename Func>
+inline void parallel_for_rows(const unsigned num_rows, unsigned num_threads, Func func) {
+    if (num_threads > num_rows) num_threads = num_rows;
+    if (num_threads <= 1) {
+        func(0, num_rows, 0);
+        return;
+    }
+
+    const unsigned block_size = (num_rows + num_threads - 1) / num_threads;
+    std::vector<std::thread> threads;
+    for (unsigned i = 0; i < num_threads; ++i) {
+        const unsigned start = i * block_size;
+        const unsigned end = std::min(start + block_size, num_rows);
+        if (start >= end) break;
+        threads.push_back(std::thread(func, start, end, i));
+    }
+    for (unsigned i = 0; i < threads.size(); ++i) threads[i].join();
+}
+
+
 // data we keep about our decision path
 // note that pweight is included for convenience and is not tied with the other attributes
 // the pweight of the i'th path element is the permuation weight of paths with i-1 ones in them
@@ -160,33 +338,140 @@ inline tfloat squared_loss_transform(const tfloat margin, const tfloat y) {
 }
 
 
-inline tfloat *tree_predict(unsigned i, const TreeEnsemble &trees, const tfloat *x, const bool *x_missing) {
-    const unsigned offset = i * trees.max_nodes;
+template <typename T>
+inline T *tree_predict(unsigned i, const TreeEnsemble<T> &trees, const T *x, const bool *x_missing) {
+    const unsigned offset = trees.tree_offset(i);
+    const TreeNode<T> *nodes = trees.nodes + offset;
     unsigned node = 0;
-    while (true) {
-        const unsigned pos = offset + node;
-        const unsigned feature = trees.features[pos];
-        
-        // we hit a leaf so return a pointer to the values
-        if (trees.children_left[pos] < 0) {
-            return trees.values + pos * trees.num_outputs;
+
+    // walk down the tree until we hit a leaf
+    while (nodes[node].children_left >= 0) {
+        node = nodes[node].next_node(x, x_missing);
+    }
+    return trees.values + (offset + node) * trees.num_outputs;
+}
+
+// the number of rows that walk down each tree together in block_tree_margins
+const unsigned PREDICT_BLOCK_SIZE = 64;
+
+/**
+ * Moves every row of a block of rows one level down tree i at a time (level-synchronous), until all of
+ * them are in leaves. The rows still inside the tree are kept compacted at the front of active_rows, and
+ * the next node is picked arithmetically, so the loop over them has no data dependent branches and their
+ * independent node loads overlap (or are vectorized into gathers) instead of waiting on each other like a
+ * row at a time walk does.
+ */
+template <typename T>
+inline void tree_predict_block(unsigned i, const TreeEnsemble<T> &trees, const T *X, const bool *X_missing,
+                               const unsigned M, const unsigned num_rows, int *row_nodes, unsigned *active_rows) {
+    const TreeNode<T> *nodes = trees.nodes + trees.tree_offset(i);
+    std::fill_n(row_nodes, num_rows, 0);
+    if (nodes[0].children_left < 0) return;
+
+    unsigned num_active = num_rows;
+    for (unsigned j = 0; j < num_rows; ++j) active_rows[j] = j;
+    while (num_active > 0) {
+        unsigned num_still_active = 0;
+        for (unsigned j = 0; j < num_active; ++j) {
+            const unsigned row = active_rows[j];
+            const TreeNode<T> &node = nodes[row_nodes[row]];
+            const unsigned f = node.split_feature();
+            const bool missing = is_missing(X + row * M, missing_offset(X_missing, row * M), f);
+            const bool go_left = (missing & (node.feature >= 0)) | (!missing & (X[row * M + f] <= node.threshold));
+            const int next = node.children_left + !go_left * (node.children_right - node.children_left);
+            row_nodes[row] = next;
+            active_rows[num_still_active] = row;
+            num_still_active += nodes[next].children_left >= 0;
         }
-        
-        // otherwise we are at an internal node and need to recurse
-        if (x_missing[feature]) {
-            node = trees.children_default[pos];
-        } else if (x[feature] <= trees.thresholds[pos]) {
-            node = trees.children_left[pos];
-        } else {
-            node = trees.children_right[pos];
+        num_active = num_still_active;
+    }
+}
+
+/**
+ * Adds the model's margin output (num_rows x num_outputs) for each row of X to out. The rows are
+ * processed in blocks that walk each tree together (see tree_predict_block), so a block of X stays
+ * in cache for the whole ensemble.
+ */
+template <typename T>
+inline void block_tree_margins(tfloat *out, const TreeEnsemble<T> &trees, const T *X, const bool *X_missing,
+                               const unsigned num_rows, const unsigned M) {
+    const unsigned num_outputs = trees.num_outputs;
+    int row_nodes[PREDICT_BLOCK_SIZE];
+    unsigned active_rows[PREDICT_BLOCK_SIZE];
+    for (unsigned start = 0; start < num_rows; start += PREDICT_BLOCK_SIZE) {
+        const unsigned block_rows = std::min(PREDICT_BLOCK_SIZE, num_rows - start);
+        const T *X_block = X + start * M;
+        const bool *X_missing_block = missing_offset(X_missing, start * M);
+        tfloat *block_out = out + start * num_outputs;
+
+        // add the base offset
+        for (unsigned j = 0; j < block_rows * num_outputs; ++j) block_out[j] += trees.base_offset;
+
+        // add the leaf values from each tree
+        for (unsigned i = 0; i < trees.tree_limit; ++i) {
+            tree_predict_block(i, trees, X_block, X_missing_block, M, block_rows, row_nodes, active_rows);
+            const T *values = trees.values + trees.tree_offset(i) * num_outputs;
+            if (num_outputs == 1) {
+                for (unsigned j = 0; j < block_rows; ++j) block_out[j] += values[row_nodes[j]];
+            } else {
+                for (unsigned j = 0; j < block_rows; ++j) {
+                    const T *leaf_value = values + row_nodes[j] * num_outputs;
+                    for (unsigned k = 0; k < num_outputs; ++k) block_out[j * num_outputs + k] += leaf_value[k];
+                }
+            }
+        }
+    }
+}
+
+/**
+ * Adds the model's margin output (num_rows x num_outputs) for each row to out from the leaf it reaches
+ * in each tree (num_rows x trees.tree_limit, see dense_tree_apply), without walking the trees again.
+ */
+template <typename T>
+inline void leaf_tree_margins(tfloat *out, const TreeEnsemble<T> &trees, const int *leaves, const unsigned num_rows) {
+    const unsigned num_outputs = trees.num_outputs;
+    for (unsigned j = 0; j < num_rows; ++j) {
+        const int *row_leaves = leaves + j * trees.tree_limit;
+        tfloat *row_out = out + j * num_outputs;
+        for (unsigned k = 0; k < num_outputs; ++k) row_out[k] += trees.base_offset;
+        for (unsigned i = 0; i < trees.tree_limit; ++i) {
+            const T *leaf_value = trees.values + (trees.tree_offset(i) + row_leaves[i]) * num_outputs;
+            for (unsigned k = 0; k < num_outputs; ++k) row_out[k] += leaf_value[k];
         }
     }
 }
 
-inline void dense_tree_predict(tfloat *out, const TreeEnsemble &trees, const ExplanationDataset &data, unsigned model_transform) {
-    tfloat *row_out = out;
-    const tfloat *x = data.X;
-    const bool *x_missing = data.X_missing;
+/**
+ * Writes the leaf (its node index within the tree) that each row of X reaches in each tree to the
+ * num_X x trees.tree_limit matrix out. The rows walk the trees in blocks like block_tree_margins,
+ * and are split across num_threads threads.
+ */
+template <typename T>
+inline void dense_tree_apply(int *out, const TreeEnsemble<T> &trees, const ExplanationDataset<T> &data,
+                             unsigned num_threads = 1) {
+    const unsigned num_trees = trees.tree_limit;
+    parallel_for_rows(data.num_X, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+        int row_nodes[PREDICT_BLOCK_SIZE];
+        unsigned active_rows[PREDICT_BLOCK_SIZE];
+        for (unsigned block_start = start; block_start < end; block_start += PREDICT_BLOCK_SIZE) {
+            const unsigned block_rows = std::min(PREDICT_BLOCK_SIZE, end - block_start);
+            const T *X_block = data.X + block_start * data.M;
+            const bool *X_missing_block = missing_offset(data.X_missing, block_start * data.M);
+            for (unsigned i = 0; i < num_trees; ++i) {
+                tree_predict_block(i, trees, X_block, X_missing_block, data.M, block_rows, row_nodes, active_rows);
+                for (unsigned j = 0; j < block_rows; ++j) out[(block_start + j) * num_trees + i] = row_nodes[j];
+            }
+        }
+    });
+}
+
+/**
+ * The model's output for each row of X (num_X x num_outputs) added to out. When the dataset carries the
+ * leaves of the rows (data.X_leaves) those are summed instead of walking the trees.
+ */
+template <typename T>
+inline void dense_tree_predict(tfloat *out, const TreeEnsemble<T> &trees, const ExplanationDataset<T> &data,
+                               unsigned model_transform, unsigned num_threads = 1) {
 
     // see what transform (if any) we have
     tfloat (* transform)(const tfloat margin, const tfloat y) = NULL;
@@ -204,51 +489,43 @@ inline void dense_tree_predict(tfloat *out, const TreeEnsemble &trees, const Exp
             break;
     }
 
-    for (unsigned i = 0; i < data.num_X; ++i) {
-
-        // add the base offset
-        for (unsigned k = 0; k < trees.num_outputs; ++k) {
-            row_out[k] += trees.base_offset;
-        }
-
-        // add the leaf values from each tree
-        for (unsigned j = 0; j < trees.tree_limit; ++j) {
-            const tfloat *leaf_value = tree_predict(j, trees, x, x_missing);
-
-            for (unsigned k = 0; k < trees.num_outputs; ++k) {
-                row_out[k] += leaf_value[k];
-            }
-        }
+    parallel_for_rows(data.num_X, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+        if (data.X_leaves != NULL) {
+            leaf_tree_margins(out + start * trees.num_outputs, trees, data.X_leaves + start * trees.tree_limit, end - start);
+        } else block_tree_margins(
+            out + start * trees.num_outputs, trees, data.X + start * data.M, missing_offset(data.X_missing, start * data.M),
+            end - start, data.M
+        );
+    });
 
-        // apply any needed transform
-        if (transform != NULL) {
+    // apply any needed transform
+    if (transform != NULL) {
+        for (unsigned i = 0; i < data.num_X; ++i) {
             const tfloat y_i = data.y == NULL ? 0 : data.y[i];
             for (unsigned k = 0; k < trees.num_outputs; ++k) {
-                row_out[k] = transform(row_out[k], y_i);
+                out[i * trees.num_outputs + k] = transform(out[i * trees.num_outputs + k], y_i);
             }
         }
-
-        x += data.M;
-        x_missing += data.M;
-        row_out += trees.num_outputs;
     }
 }
 
-inline void tree_update_weights(unsigned i, TreeEnsemble &trees, const tfloat *x, const bool *x_missing) {
-    const unsigned offset = i * trees.max_nodes;
+template <typename T>
+inline void tree_update_weights(unsigned i, TreeEnsemble<T> &trees, const T *x, const bool *x_missing,
+                                const T weight = 1) {
+    const unsigned offset = trees.tree_offset(i);
     unsigned node = 0;
     while (true) {
         const unsigned pos = offset + node;
         const unsigned feature = trees.features[pos];
 
         // Record that a sample passed through this node
-        trees.node_sample_weights[pos] += 1.0;
+        trees.node_sample_weights[pos] += weight;
         
         // we hit a leaf so return a pointer to the values
         if (trees.children_left[pos] < 0) break;
         
         // otherwise we are at an internal node and need to recurse
-        if (x_missing[feature]) {
+        if (is_missing(x, x_missing, feature)) {
             node = trees.children_default[pos];
         } else if (x[feature] <= trees.thresholds[pos]) {
             node = trees.children_left[pos];
@@ -258,39 +535,40 @@ inline void tree_update_weights(unsigned i, TreeEnsemble &trees, const tfloat *x
     }
 }
 
-inline void dense_tree_update_weights(TreeEnsemble &trees, const ExplanationDataset &data) {
-    const tfloat *x = data.X;
-    const bool *x_missing = data.X_missing;
-
-    for (unsigned i = 0; i < data.num_X; ++i) {
+/**
+ * Adds weight to the node sample weights of every node each row of X passes through. The trees
+ * are split across num_threads native threads, so each thread only writes to its own trees.
+ */
+template <typename T>
+inline void dense_tree_update_weights(TreeEnsemble<T> &trees, const ExplanationDataset<T> &data,
+                                      const T weight = 1, unsigned num_threads = 1) {
+    parallel_for_rows(trees.tree_limit, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+        const T *x = data.X;
+        const bool *x_missing = data.X_missing;
+        for (unsigned i = 0; i < data.num_X; ++i) {
+            for (unsigned j = start; j < end; ++j) {
+                tree_update_weights(j, trees, x, x_missing, weight);
+            }
 
-        // add the leaf values from each tree
-        for (unsigned j = 0; j < trees.tree_limit; ++j) {
-            tree_update_weights(j, trees, x, x_missing);
+            x += data.M;
+            x_missing = missing_offset(x_missing, data.M);
         }
-
-        x += data.M;
-        x_missing += data.M;
-    }
+    });
 }
 
-inline void tree_saabas(tfloat *out, const TreeEnsemble &tree, const ExplanationDataset &data) {
+template <typename T>
+inline void tree_saabas(tfloat *out, const TreeEnsemble<T> &tree, const ExplanationDataset<T> &data) {
     unsigned curr_node = 0;
     unsigned next_node = 0;
     while (true) {
-        
+        const TreeNode<T> &node = tree.nodes[curr_node];
+
         // we hit a leaf and are done
-        if (tree.children_left[curr_node] < 0) return;
+        if (node.children_left < 0) return;
         
         // otherwise we are at an internal node and need to recurse
-        const unsigned feature = tree.features[curr_node];
-        if (data.X_missing[feature]) {
-            next_node = tree.children_default[curr_node];
-        } else if (data.X[feature] <= tree.thresholds[curr_node]) {
-            next_node = tree.children_left[curr_node];
-        } else {
-            next_node = tree.children_right[curr_node];
-        }
+        const unsigned feature = node.split_feature();
+        next_node = node.next_node(data.X, data.X_missing);
 
         // assign credit to this feature as the difference in values at the current node vs. the next node
         for (unsigned i = 0; i < tree.num_outputs; ++i) {
@@ -302,30 +580,36 @@ inline void tree_saabas(tfloat *out, const TreeEnsemble &tree, const Explanation
 }
 
 /**
- * This runs Tree SHAP with a per tree path conditional dependence assumption.
+ * This runs Saabas (the credit each split on a row's path gets for the change in the expected value
+ * at the node), splitting the rows of X across num_threads native threads.
  */
-void dense_tree_saabas(tfloat *out_contribs, const TreeEnsemble& trees, const ExplanationDataset &data) {
-    tfloat *instance_out_contribs;
-    TreeEnsemble tree;
-    ExplanationDataset instance;
-
-    // build explanation for each sample
-    for (unsigned i = 0; i < data.num_X; ++i) {
-        instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
-        data.get_x_instance(instance, i);
-
-        // aggregate the effect of explaining each tree
-        // (this works because of the linearity property of Shapley values)
-        for (unsigned j = 0; j < trees.tree_limit; ++j) {
-            trees.get_tree(tree, j);
-            tree_saabas(instance_out_contribs, tree, instance);
-        }
+template <typename T>
+void dense_tree_saabas(tfloat *out_contribs, const TreeEnsemble<T>& trees, const ExplanationDataset<T> &data,
+                       unsigned num_threads = 1) {
+    parallel_for_rows(data.num_X, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+        tfloat *instance_out_contribs;
+        TreeEnsemble<T> tree;
+        ExplanationDataset<T> instance;
+
+        // build explanation for each sample
+        for (unsigned i = start; i < end; ++i) {
+            instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
+            tfloat *bias = instance_out_contribs + data.M * trees.num_outputs;
+            data.get_x_instance(instance, i);
+
+            // aggregate the effect of explaining each tree, starting from its expected value
+            for (unsigned j = 0; j < trees.tree_limit; ++j) {
+                trees.get_tree(tree, j);
+                tree_saabas(instance_out_contribs, tree, instance);
+                for (unsigned k = 0; k < trees.num_outputs; ++k) bias[k] += tree.values[k];
+            }
 
-        // apply the base offset to the bias term
-        for (unsigned j = 0; j < trees.num_outputs; ++j) {
-            instance_out_contribs[data.M * trees.num_outputs + j] += trees.base_offset;
+            // apply the base offset to the bias term
+            for (unsigned j = 0; j < trees.num_outputs; ++j) {
+                bias[j] += trees.base_offset;
+            }
         }
-    }
+    });
 }
 
 
@@ -394,33 +678,37 @@ inline tfloat unwound_path_sum(const PathElement *unique_path, unsigned unique_d
 }
 
 // recursive computation of SHAP values for a decision tree
-inline void tree_shap_recursive(const unsigned num_outputs, const int *children_left,
-                                const int *children_right,
-                                const int *children_default, const int *features,
-                                const tfloat *thresholds, const tfloat *values,
-                                const tfloat *node_sample_weight,
-                                const tfloat *x, const bool *x_missing, tfloat *phi,
+// condition = 1 (-1) conditions on condition_feature being on (off), and condition = 2 adds the
+// difference between the two in a single traversal: both passes follow the same paths until the first
+// split on condition_feature, so only the subtrees below such splits are visited twice (and the leaves
+// that are never below one are skipped, since they contribute equally to both)
+template <typename T>
+inline void tree_shap_recursive(const unsigned num_outputs, const TreeNode<T> *nodes,
+                                const T *values, const T *node_sample_weight,
+                                const T *x, const bool *x_missing, tfloat *phi,
                                 unsigned node_index, unsigned unique_depth,
                                 PathElement *parent_unique_path, tfloat parent_zero_fraction,
                                 tfloat parent_one_fraction, int parent_feature_index,
                                 int condition, unsigned condition_feature,
-                                tfloat condition_fraction) {
+                                tfloat condition_fraction, bool on_x_path = true) {
 
-    // stop if we have no weight coming down to us
-    if (condition_fraction == 0) return;
+    // stop if we have no weight coming down to us (or the branch is neither followed by x nor the background)
+    const bool extend = condition == 0 || condition_feature != static_cast<unsigned>(parent_feature_index);
+    if (condition_fraction == 0 || (extend && parent_zero_fraction == 0 && parent_one_fraction == 0)) return;
 
     // extend the unique path
     PathElement *unique_path = parent_unique_path + unique_depth + 1;
     std::copy(parent_unique_path, parent_unique_path + unique_depth + 1, unique_path);
 
-    if (condition == 0 || condition_feature != static_cast<unsigned>(parent_feature_index)) {
+    if (extend) {
         extend_path(unique_path, unique_depth, parent_zero_fraction,
                     parent_one_fraction, parent_feature_index);
     }
-    const unsigned split_index = features[node_index];
+    const TreeNode<T> &node = nodes[node_index];
 
     // leaf node
-    if (children_right[node_index] < 0) {
+    if (node.children_right < 0) {
+        if (condition == 2) return;
         for (unsigned i = 1; i <= unique_depth; ++i) {
             const tfloat w = unwound_path_sum(unique_path, unique_depth, i);
             const PathElement &el = unique_path[i];
@@ -435,19 +723,18 @@ inline void tree_shap_recursive(const unsigned num_outputs, const int *children_
     // internal node
     } else {
         // find which branch is "hot" (meaning x would follow it)
-        unsigned hot_index = 0;
-        if (x_missing[split_index]) {
-            hot_index = children_default[node_index];
-        } else if (x[split_index] <= thresholds[node_index]) {
-            hot_index = children_left[node_index];
-        } else {
-            hot_index = children_right[node_index];
-        }
-        const unsigned cold_index = (static_cast<int>(hot_index) == children_left[node_index] ?
-                                        children_right[node_index] : children_left[node_index]);
+        const unsigned split_index = node.split_feature();
+        unsigned hot_index = node.next_node(x, x_missing);
+        unsigned cold_index = (static_cast<int>(hot_index) == node.children_left ?
+                                  node.children_right : node.children_left);
+
+        // global_path_dependent merged trees also split off the other rows of X, which are not splits for x:
+        // nodes no background sample reaches just follow x, and away from the path of x we follow the
+        // background where it all goes one way
+        if (!on_x_path && node_sample_weight[hot_index] == 0) std::swap(hot_index, cold_index);
         const tfloat w = node_sample_weight[node_index];
-        const tfloat hot_zero_fraction = node_sample_weight[hot_index] / w;
-        const tfloat cold_zero_fraction = node_sample_weight[cold_index] / w;
+        const tfloat hot_zero_fraction = w > 0 ? node_sample_weight[hot_index] / w : 1;
+        const tfloat cold_zero_fraction = w > 0 ? node_sample_weight[cold_index] / w : 0;
         tfloat incoming_zero_fraction = 1;
         tfloat incoming_one_fraction = 1;
 
@@ -464,6 +751,30 @@ inline void tree_shap_recursive(const unsigned num_outputs, const int *children_
             unique_depth -= 1;
         }
 
+        // split into the on pass and the (negated) off pass at the first split on the condition feature
+        if (condition == 2 && split_index == condition_feature) {
+            unique_depth -= 1;
+            tree_shap_recursive(
+                num_outputs, nodes, values, node_sample_weight, x, x_missing, phi,
+                hot_index, unique_depth + 1, unique_path,
+                hot_zero_fraction * incoming_zero_fraction, incoming_one_fraction,
+                split_index, 1, condition_feature, condition_fraction
+            );
+            tree_shap_recursive(
+                num_outputs, nodes, values, node_sample_weight, x, x_missing, phi,
+                hot_index, unique_depth + 1, unique_path,
+                hot_zero_fraction * incoming_zero_fraction, incoming_one_fraction,
+                split_index, -1, condition_feature, -condition_fraction * hot_zero_fraction
+            );
+            tree_shap_recursive(
+                num_outputs, nodes, values, node_sample_weight, x, x_missing, phi,
+                cold_index, unique_depth + 1, unique_path,
+                cold_zero_fraction * incoming_zero_fraction, 0,
+                split_index, -1, condition_feature, -condition_fraction * cold_zero_fraction
+            );
+            return;
+        }
+
         // divide up the condition_fraction among the recursive calls
         tfloat hot_condition_fraction = condition_fraction;
         tfloat cold_condition_fraction = condition_fraction;
@@ -477,22 +788,23 @@ inline void tree_shap_recursive(const unsigned num_outputs, const int *children_
         }
 
         tree_shap_recursive(
-            num_outputs, children_left, children_right, children_default, features, thresholds, values,
-            node_sample_weight, x, x_missing, phi, hot_index, unique_depth + 1, unique_path,
+            num_outputs, nodes, values, node_sample_weight, x, x_missing, phi,
+            hot_index, unique_depth + 1, unique_path,
             hot_zero_fraction * incoming_zero_fraction, incoming_one_fraction,
-            split_index, condition, condition_feature, hot_condition_fraction
+            split_index, condition, condition_feature, hot_condition_fraction, on_x_path
         );
 
         tree_shap_recursive(
-            num_outputs, children_left, children_right, children_default, features, thresholds, values,
-            node_sample_weight, x, x_missing, phi, cold_index, unique_depth + 1, unique_path,
+            num_outputs, nodes, values, node_sample_weight, x, x_missing, phi,
+            cold_index, unique_depth + 1, unique_path,
             cold_zero_fraction * incoming_zero_fraction, 0,
-            split_index, condition, condition_feature, cold_condition_fraction
+            split_index, condition, condition_feature, cold_condition_fraction, false
         );
     }
 }
 
-inline int compute_expectations(TreeEnsemble &tree, int i = 0, int depth = 0) {
+template <typename T>
+inline int compute_expectations(TreeEnsemble<T> &tree, int i = 0, int depth = 0) {
     unsigned max_depth = 0;
 
     if (tree.children_right[i] >= 0) {
@@ -517,7 +829,25 @@ inline int compute_expectations(TreeEnsemble &tree, int i = 0, int depth = 0) {
     return max_depth;
 }
 
-inline void tree_shap(const TreeEnsemble& tree, const ExplanationDataset &data,
+/**
+ * Recomputes the internal node values of every tree from their leaves and node sample weights,
+ * splitting the trees across num_threads native threads. Returns the depth of the deepest tree.
+ */
+template <typename T>
+inline unsigned compute_ensemble_expectations(const TreeEnsemble<T> &trees, unsigned num_threads = 1) {
+    std::vector<unsigned> depths(trees.tree_limit, 0);
+    parallel_for_rows(trees.tree_limit, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+        TreeEnsemble<T> tree;
+        for (unsigned i = start; i < end; ++i) {
+            trees.get_tree(tree, i);
+            depths[i] = compute_expectations(tree);
+        }
+    });
+    return depths.empty() ? 0 : *std::max_element(depths.begin(), depths.end());
+}
+
+template <typename T>
+inline void tree_shap(const TreeEnsemble<T>& tree, const ExplanationDataset<T> &data,
                       tfloat *out_contribs, int condition, unsigned condition_feature) {
 
     // update the reference value with the expected value of the tree's predictions
@@ -532,8 +862,7 @@ inline void tree_shap(const TreeEnsemble& tree, const ExplanationDataset &data,
     PathElement *unique_path_data = new PathElement[(maxd * (maxd + 1)) / 2];
 
     tree_shap_recursive(
-        tree.num_outputs, tree.children_left, tree.children_right, tree.children_default,
-        tree.features, tree.thresholds, tree.values, tree.node_sample_weights, data.X,
+        tree.num_outputs, tree.nodes, tree.values, tree.node_sample_weights, data.X,
         data.X_missing, out_contribs, 0, 0, unique_path_data, 1, 1, -1, condition,
         condition_feature, 1
     );
@@ -542,162 +871,153 @@ inline void tree_shap(const TreeEnsemble& tree, const ExplanationDataset &data,
 }
 
 
-unsigned build_merged_tree_recursive(TreeEnsemble &out_tree, const TreeEnsemble &trees,
-                                     const tfloat *data, const bool *data_missing, int *data_inds,
-                                     const unsigned num_background_data_inds, unsigned num_data_inds,
-                                     unsigned M, unsigned row = 0, unsigned i = 0, unsigned pos = 0,
-                                     tfloat *leaf_value = NULL) {
-    //tfloat new_leaf_value[trees.num_outputs];
-    tfloat *new_leaf_value = (tfloat *) alloca(sizeof(tfloat) * trees.num_outputs); // allocate on the stack
-    unsigned row_offset = row * trees.max_nodes;
-  
-    // we have hit a terminal leaf!!!
-    if (trees.children_left[row_offset + i] < 0 && row + 1 == trees.tree_limit) {
-
-        // create the leaf node
-        const tfloat *vals = trees.values + (row * trees.max_nodes + i) * trees.num_outputs;
-        if (leaf_value == NULL) {
-            for (unsigned j = 0; j < trees.num_outputs; ++j) {
-                out_tree.values[pos * trees.num_outputs + j] = vals[j];
-            }
-        } else {
-            for (unsigned j = 0; j < trees.num_outputs; ++j) {
-                out_tree.values[pos * trees.num_outputs + j] = leaf_value[j] + vals[j];
-            }
+/**
+ * A node of the merged tree that is still to be built: the rows data_inds[start, end) have reached node i
+ * of tree row of the ensemble. The merged node becomes a child of parent (-1 for the root).
+ */
+struct MergeTask {
+    unsigned row;
+    unsigned i;
+    unsigned start;
+    unsigned end;
+    unsigned num_background;
+    int parent;
+    bool right;
+};
+
+/**
+ * Collapses the ensemble into a single tree that behaves the same for every row of X and R, where the
+ * node sample weights count the rows of R that reach each node. A node is only created where the rows
+ * split both ways, so the merged tree has fewer than 2 * (num_X + num_R) nodes. It is built in pre-order
+ * (every child after its parent) from an explicit stack, so deep merged trees can't overflow the call stack.
+ */
+template <typename T>
+void build_merged_tree(TreeEnsemble<T> &out_tree, const ExplanationDataset<T> &data, const TreeEnsemble<T> &trees) {
+    const unsigned num_outputs = trees.num_outputs;
+    const unsigned num_rows = data.num_X + data.num_R;
+    const unsigned M = data.M;
+
+    // rows [0, num_X) are the rows of X and the rest are the rows of R
+    std::vector<unsigned> data_inds(num_rows);
+    for (unsigned i = 0; i < num_rows; ++i) data_inds[i] = i;
+    auto goes_right = [&](const unsigned ind, const unsigned f, const T t, const bool right_default) {
+        const bool in_x = ind < data.num_X;
+        const size_t offset = (size_t)(in_x ? ind : ind - data.num_X) * M;
+        const T *x = (in_x ? data.X : data.R) + offset;
+        const bool missing = is_missing(x, missing_offset(in_x ? data.X_missing : data.R_missing, offset), f);
+        return missing ? right_default : x[f] > t;
+    };
+
+    std::vector<MergeTask> tasks;
+    std::vector<tfloat> task_values; // the summed leaf values of the earlier trees for each task
+    std::vector<tfloat> leaf_value(num_outputs);
+    std::vector<bool> default_left;
+    MergeTask root = {0, 0, 0, num_rows, data.num_R, -1, false};
+    tasks.push_back(root);
+    task_values.resize(num_outputs, 0);
+    unsigned num_nodes = 0;
+    while (!tasks.empty()) {
+        MergeTask task = tasks.back();
+        tasks.pop_back();
+        std::copy(task_values.end() - num_outputs, task_values.end(), leaf_value.begin());
+        task_values.resize(task_values.size() - num_outputs);
+
+        const unsigned pos = num_nodes++;
+        default_left.push_back(true);
+        if (task.parent >= 0) {
+            if (task.right) out_tree.children_right[task.parent] = pos;
+            else out_tree.children_left[task.parent] = pos;
         }
-        out_tree.children_left[pos] = -1;
-        out_tree.children_right[pos] = -1;
-        out_tree.children_default[pos] = -1;
-        out_tree.features[pos] = -1;
-        out_tree.thresholds[pos] = 0;
-        out_tree.node_sample_weights[pos] = num_background_data_inds;
-
-        return pos;
-    }
-  
-    // we hit an intermediate leaf (so just add the value to our accumulator and move to the next tree)
-    if (trees.children_left[row_offset + i] < 0) {
-        
-        // accumulate the value of this original leaf so it will land on all eventual terminal leaves
-        const tfloat *vals = trees.values + (row * trees.max_nodes + i) * trees.num_outputs;
-        if (leaf_value == NULL) {
-            for (unsigned j = 0; j < trees.num_outputs; ++j) {
-                new_leaf_value[j] = vals[j];
+
+        // walk down the trees while all the rows go the same way
+        while (true) {
+            const unsigned node = trees.tree_offset(task.row) + task.i;
+
+            // we hit a leaf, so add its value and move on to the next tree (or create a terminal leaf)
+            if (trees.children_left[node] < 0) {
+                for (unsigned j = 0; j < num_outputs; ++j) leaf_value[j] += trees.values[node * num_outputs + j];
+                if (task.row + 1 < trees.tree_limit) {
+                    task.row += 1;
+                    task.i = 0;
+                    continue;
+                }
+                std::copy(leaf_value.begin(), leaf_value.end(), out_tree.values + pos * num_outputs);
+                out_tree.children_left[pos] = -1;
+                out_tree.children_right[pos] = -1;
+                out_tree.features[pos] = -1;
+                out_tree.thresholds[pos] = 0;
+                out_tree.node_sample_weights[pos] = task.num_background;
+                break;
             }
-        } else {
-            for (unsigned j = 0; j < trees.num_outputs; ++j) {
-                new_leaf_value[j] = leaf_value[j] + vals[j];
+
+            // split the data inds by this node's threshold
+            const unsigned f = trees.features[node];
+            const T t = trees.thresholds[node];
+            const bool right_default = trees.children_default[node] == trees.children_right[node];
+            unsigned low = task.start;
+            unsigned high = task.end;
+            unsigned num_left_background = 0;
+            while (low < high) {
+                if (goes_right(data_inds[low], f, t, right_default)) {
+                    std::swap(data_inds[low], data_inds[--high]);
+                } else {
+                    if (data_inds[low] >= data.num_X) ++num_left_background;
+                    ++low;
+                }
             }
-        }
-        leaf_value = new_leaf_value;
 
-        // move forward to the next tree
-        row += 1;
-        row_offset += trees.max_nodes;
-        i = 0;
-    }
-    
-    // split the data inds by this node's threshold
-    const tfloat t = trees.thresholds[row_offset + i];
-    const int f = trees.features[row_offset + i];
-    const bool right_default = trees.children_default[row_offset + i] == trees.children_right[row_offset + i];
-    int low_ptr = 0;
-    int high_ptr = num_data_inds - 1;
-    unsigned num_left_background_data_inds = 0;
-    int low_data_ind;
-    while (low_ptr <= high_ptr) {
-        low_data_ind = data_inds[low_ptr];
-        const int data_ind = std::abs(low_data_ind) * M + f;
-        const bool is_missing = data_missing[data_ind];
-        if ((!is_missing && data[data_ind] > t) || (right_default && is_missing)) {
-            data_inds[low_ptr] = data_inds[high_ptr];
-            data_inds[high_ptr] = low_data_ind;
-            high_ptr -= 1;
-        } else {
-            if (low_data_ind >= 0) ++num_left_background_data_inds; // negative data_inds are not background samples
-            low_ptr += 1;
+            // all the data went one way, so we skip creating this node
+            if (low == task.start) {
+                task.i = trees.children_right[node];
+                continue;
+            } else if (low == task.end) {
+                task.i = trees.children_left[node];
+                continue;
+            }
+
+            // the data went both ways, so we create this node and queue both children (the left one on top)
+            out_tree.features[pos] = f;
+            out_tree.thresholds[pos] = t;
+            out_tree.node_sample_weights[pos] = task.num_background;
+            default_left[pos] = !right_default;
+            MergeTask right = {task.row, (unsigned)trees.children_right[node], low, task.end,
+                               task.num_background - num_left_background, (int)pos, true};
+            MergeTask left = {task.row, (unsigned)trees.children_left[node], task.start, low,
+                              num_left_background, (int)pos, false};
+            tasks.push_back(right);
+            task_values.insert(task_values.end(), leaf_value.begin(), leaf_value.end());
+            tasks.push_back(left);
+            task_values.insert(task_values.end(), leaf_value.begin(), leaf_value.end());
+            break;
         }
     }
-    int *left_data_inds = data_inds;
-    const unsigned num_left_data_inds = low_ptr;
-    int *right_data_inds = data_inds + low_ptr;
-    const unsigned num_right_data_inds = num_data_inds - num_left_data_inds;
-    const unsigned num_right_background_data_inds = num_background_data_inds - num_left_background_data_inds;
-  
-    // all the data went right, so we skip creating this node and just recurse right
-    if (num_left_data_inds == 0) {
-        return build_merged_tree_recursive(
-            out_tree, trees, data, data_missing, data_inds,
-            num_background_data_inds, num_data_inds, M, row,
-            trees.children_right[row_offset + i], pos, leaf_value
-        );
-
-    // all the data went left, so we skip creating this node and just recurse left
-    } else if (num_right_data_inds == 0) {
-        return build_merged_tree_recursive(
-            out_tree, trees, data, data_missing, data_inds,
-            num_background_data_inds, num_data_inds, M, row,
-            trees.children_left[row_offset + i], pos, leaf_value
-        );
-
-    // data went both ways so we create this node and recurse down both paths
-    } else {
-        
-        // build the left subtree
-        const unsigned new_pos = build_merged_tree_recursive(
-            out_tree, trees, data, data_missing, left_data_inds,
-            num_left_background_data_inds, num_left_data_inds, M, row,
-            trees.children_left[row_offset + i], pos + 1, leaf_value
-        );
 
-        // fill in the data for this node
-        out_tree.children_left[pos] = pos + 1;
-        out_tree.children_right[pos] = new_pos + 1;
-        if (trees.children_left[row_offset + i] == trees.children_default[row_offset + i]) {
-            out_tree.children_default[pos] = pos + 1;
-        } else {
-            out_tree.children_default[pos] = new_pos + 1;
+    // children come after their parents, so a forward pass finds the depths and a backward pass the
+    // expected values (nodes only the rows of X reach have no weight, and just keep their left value)
+    std::vector<unsigned> depths(num_nodes, 0);
+    out_tree.max_depth = 0;
+    for (unsigned i = 0; i < num_nodes; ++i) {
+        if (out_tree.children_left[i] < 0) {
+            out_tree.children_default[i] = -1;
+            continue;
+        }
+        out_tree.children_default[i] = default_left[i] ? out_tree.children_left[i] : out_tree.children_right[i];
+        depths[out_tree.children_left[i]] = depths[out_tree.children_right[i]] = depths[i] + 1;
+        out_tree.max_depth = std::max(out_tree.max_depth, depths[i] + 1);
+    }
+    for (unsigned i = num_nodes; i-- > 0;) {
+        if (out_tree.children_left[i] < 0) continue;
+        const unsigned li = out_tree.children_left[i];
+        const unsigned ri = out_tree.children_right[i];
+        const tfloat left_weight = out_tree.node_sample_weights[li];
+        const tfloat right_weight = out_tree.node_sample_weights[ri];
+        for (unsigned j = 0; j < num_outputs; ++j) {
+            const tfloat left_value = out_tree.values[li * num_outputs + j];
+            out_tree.values[i * num_outputs + j] = left_weight + right_weight > 0 ?
+                (left_weight * left_value + right_weight * out_tree.values[ri * num_outputs + j]) / (left_weight + right_weight) :
+                left_value;
         }
-        
-        out_tree.features[pos] = trees.features[row_offset + i];
-        out_tree.thresholds[pos] = trees.thresholds[row_offset + i];
-        out_tree.node_sample_weights[pos] = num_background_data_inds;
-
-        // build the right subtree
-        return build_merged_tree_recursive(
-            out_tree, trees, data, data_missing, right_data_inds,
-            num_right_background_data_inds, num_right_data_inds, M, row,
-            trees.children_right[row_offset + i], new_pos + 1, leaf_value
-        );
     }
-}
-
-
-void build_merged_tree(TreeEnsemble &out_tree, const ExplanationDataset &data, const TreeEnsemble &trees) {
-    
-    // create a joint data matrix from both X and R matrices
-    tfloat *joined_data = new tfloat[(data.num_X + data.num_R) * data.M];
-    std::copy(data.X, data.X + data.num_X * data.M, joined_data);
-    std::copy(data.R, data.R + data.num_R * data.M, joined_data + data.num_X * data.M);
-    bool *joined_data_missing = new bool[(data.num_X + data.num_R) * data.M];
-    std::copy(data.X_missing, data.X_missing + data.num_X * data.M, joined_data_missing);
-    std::copy(data.R_missing, data.R_missing + data.num_R * data.M, joined_data_missing + data.num_X * data.M);
-
-    // create an starting array of data indexes we will recursively sort
-    int *data_inds = new int[data.num_X + data.num_R];
-    for (unsigned i = 0; i < data.num_X; ++i) data_inds[i] = i;
-    for (unsigned i = data.num_X; i < data.num_X + data.num_R; ++i) {
-        data_inds[i] = -i; // a negative index means it won't be recorded as a background sample
-    }
-
-    build_merged_tree_recursive(
-        out_tree, trees, joined_data, joined_data_missing, data_inds, data.num_R,
-        data.num_X + data.num_R, data.M
-    );
-
-    delete[] joined_data;
-    delete[] joined_data_missing;
-    delete[] data_inds;
 }
 
 
@@ -705,7 +1025,7 @@ void build_merged_tree(TreeEnsemble &out_tree, const ExplanationDataset &data, c
 // ------------------------------------------
 struct Node {
     short cl, cr, cd, pnode, feat, pfeat; // uint_16
-    float thres, value;
+    tfloat thres; // double so the thresholds of double precision models are not rounded
     char from_flag;
 };
 
@@ -725,13 +1045,15 @@ inline int bin_coeff(int n, int k) {
     return res; 
 } 
 
-// note this only handles single output models, so multi-output models get explained using multiple passes
+// all the outputs of a multi-output model are explained in the same traversal, so the leaf values
+// (values) and pos_lst/neg_lst hold num_outputs entries per node and out_contribs is (num_feats+1) x num_outputs
+template <typename T>
 inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
-                            const unsigned num_nodes, const tfloat *x,
-                            const bool *x_missing, const tfloat *r,
+                            const unsigned num_nodes, const unsigned num_outputs, const T *x,
+                            const bool *x_missing, const T *r,
                             const bool *r_missing, tfloat *out_contribs,
                             float *pos_lst, float *neg_lst, signed short *feat_hist,
-                            float *memoized_weights, int *node_stack, Node *mytree) {
+                            const float *memoized_weights, int *node_stack, Node *mytree, const T *values) {
 
 //     const bool DEBUG = true;
 //     ofstream myfile;
@@ -744,7 +1066,8 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
     short node = 0, feat, cl, cr, cd, pnode, pfeat = -1;
     short next_xnode = -1, next_rnode = -1;
     short next_node = -1, from_child = -1;
-    float thres, pos_x = 0, neg_x = 0, pos_r = 0, neg_r = 0;
+    tfloat thres;
+    float pos_x = 0, neg_x = 0, pos_r = 0, neg_r = 0;
     char from_flag;
     unsigned M = 0, N = 0;
     
@@ -757,7 +1080,9 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
 
     // short circut when this is a stump tree (with no splits)
     if (cl < 0) {
-        out_contribs[num_feats] += curr_node.value;
+        for (unsigned o = 0; o < num_outputs; ++o) {
+            out_contribs[num_feats * num_outputs + o] += values[o];
+        }
         return;
     }
     
@@ -767,7 +1092,7 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
 //       myfile << "thres: " << thres << "\n";
 //     }
     
-    if (x_missing[feat]) {
+    if (is_missing(x, x_missing, feat)) {
         next_xnode = cd;
     } else if (x[feat] > thres) {
         next_xnode = cr;
@@ -775,7 +1100,7 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
         next_xnode = cl;
     }
     
-    if (r_missing[feat]) {
+    if (is_missing(r, r_missing, feat)) {
         next_rnode = cd;
     } else if (r[feat] > thres) {
         next_rnode = cr;
@@ -838,17 +1163,25 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
             //        myfile << "At a leaf\n";
             //      }
 
+            const T *leaf_values = values + node * num_outputs;
             if (M == 0) {
-              out_contribs[num_feats] += mytree[node].value;
+                for (unsigned o = 0; o < num_outputs; ++o) {
+                    out_contribs[num_feats * num_outputs + o] += leaf_values[o];
+                }
             }
 
-            // Currently assuming a single output
             if (N != 0) {
                 if (M != 0) {
-                    pos_lst[node] = mytree[node].value * memoized_weights[N + max_depth * (M-1)];
+                    const float w = memoized_weights[N + max_depth * (M-1)];
+                    for (unsigned o = 0; o < num_outputs; ++o) {
+                        pos_lst[node * num_outputs + o] = leaf_values[o] * w;
+                    }
                 }
                 if (M != N) {
-                    neg_lst[node] = -mytree[node].value * memoized_weights[N + max_depth * M];
+                    const float w = memoized_weights[N + max_depth * M];
+                    for (unsigned o = 0; o < num_outputs; ++o) {
+                        neg_lst[node * num_outputs + o] = -leaf_values[o] * w;
+                    }
                 }
             }
 //             if (DEBUG) {
@@ -879,7 +1212,7 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
         const bool x_right = x[feat] > thres;
         const bool r_right = r[feat] > thres;
 
-        if (x_missing[feat]) {
+        if (is_missing(x, x_missing, feat)) {
             next_xnode = cd;
         } else if (x_right) {
             next_xnode = cr;
@@ -887,7 +1220,7 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
             next_xnode = cl;
         }
         
-        if (r_missing[feat]) {
+        if (is_missing(r, r_missing, feat)) {
             next_rnode = cd;
         } else if (r_right) {
             next_rnode = cr;
@@ -972,8 +1305,8 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
                     break;
                 }
                 // Update and unroll
-                pos_lst[node] = pos_lst[from_child];
-                neg_lst[node] = neg_lst[from_child];
+                std::copy_n(pos_lst + from_child * num_outputs, num_outputs, pos_lst + node * num_outputs);
+                std::copy_n(neg_lst + from_child * num_outputs, num_outputs, neg_lst + node * num_outputs);
 
 //                 if (DEBUG) {
 //                   myfile << "pos_lst[node]: " << pos_lst[node] << "\n";
@@ -1020,28 +1353,30 @@ inline void tree_shap_indep(const unsigned max_depth, const unsigned num_feats,
 //                 if (DEBUG) {
 //                   myfile << "Compute stuff and unroll - Arriving from the right child\n";
 //                 }
-                pos_x = 0;
-                neg_x = 0;
-                pos_r = 0;
-                neg_r = 0;
+                short xchild = -1, rchild = -1;
                 if ((next_xnode == cr) && (next_rnode == cl)) {
-                    pos_x = pos_lst[cr];
-                    neg_x = neg_lst[cr];
-                    pos_r = pos_lst[cl];
-                    neg_r = neg_lst[cl];
+                    xchild = cr;
+                    rchild = cl;
                 } else if ((next_xnode == cl) && (next_rnode == cr)) {
-                    pos_x = pos_lst[cl];
-                    neg_x = neg_lst[cl];
-                    pos_r = pos_lst[cr];
-                    neg_r = neg_lst[cr];
+                    xchild = cl;
+                    rchild = cr;
                 }
                 // out_contribs needs to have been initialized as all zeros
-                // if (pos_x + neg_r != 0) {
-                //   std::cout << "val " << pos_x + neg_r << "\n";
-                // }
-                out_contribs[feat] += pos_x + neg_r;
-                pos_lst[node] = pos_x + pos_r;
-                neg_lst[node] = neg_x + neg_r;
+                for (unsigned o = 0; o < num_outputs; ++o) {
+                    pos_x = 0;
+                    neg_x = 0;
+                    pos_r = 0;
+                    neg_r = 0;
+                    if (xchild >= 0) {
+                        pos_x = pos_lst[xchild * num_outputs + o];
+                        neg_x = neg_lst[xchild * num_outputs + o];
+                        pos_r = pos_lst[rchild * num_outputs + o];
+                        neg_r = neg_lst[rchild * num_outputs + o];
+                    }
+                    out_contribs[feat * num_outputs + o] += pos_x + neg_r;
+                    pos_lst[node * num_outputs + o] = pos_x + pos_r;
+                    neg_lst[node * num_outputs + o] = neg_x + neg_r;
+                }
 
 //                 if (DEBUG) {
 //                   myfile << "out_contribs[feat]: " << out_contribs[feat] << "\n";
@@ -1090,7 +1425,9 @@ inline void print_progress_bar(tfloat &last_print, tfloat start_time, unsigned i
         const tfloat fraction = static_cast<tfloat>(i) / total_count;
         const double total_seconds = elapsed_seconds / fraction;
         last_print = elapsed_seconds;
-        
+
+        // we may be running in a native thread without the GIL
+        PyGILState_STATE gil_state = PyGILState_Ensure();
         PySys_WriteStderr(
             "\r%3.0f%%|%.*s%.*s| %d/%d [%02d:%02d<%02d:%02d]       ",
             fraction * 100, int(0.5 + fraction*20), "===================",
@@ -1106,153 +1443,225 @@ inline void print_progress_bar(tfloat &last_print, tfloat start_time, unsigned i
             PyObject *result = PyObject_CallMethod(pyStderr, "flush", NULL);
             Py_XDECREF(result);
         }
+        PyGILState_Release(gil_state);
     }
 }
 
 /**
- * Runs Tree SHAP with feature independence assumptions on dense data.
+ * The model's margin output for each row of X (num_rows x num_outputs), computed across num_threads threads.
+ * When the leaves of the rows are given (see dense_tree_apply) they are summed instead of walking the trees.
  */
-void dense_independent(const TreeEnsemble& trees, const ExplanationDataset &data,
-                       tfloat *out_contribs, tfloat transform(const tfloat, const tfloat)) {
+template <typename T>
+inline void dense_tree_margins(tfloat *out, const TreeEnsemble<T>& trees, const T *X, const bool *X_missing,
+                               const unsigned num_rows, const unsigned M, const unsigned num_threads,
+                               const int *leaves = NULL) {
+    const unsigned num_outputs = trees.num_outputs;
+    parallel_for_rows(num_rows, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+        std::fill(out + start * num_outputs, out + end * num_outputs, 0);
+        if (leaves != NULL) leaf_tree_margins(out + start * num_outputs, trees, leaves + start * trees.tree_limit, end - start);
+        else block_tree_margins(out + start * num_outputs, trees, X + start * M, missing_offset(X_missing, start * M), end - start, M);
+    });
+}
 
-    // reformat the trees for faster access
-    Node *node_trees = new Node[trees.tree_limit * trees.max_nodes];
-    for (unsigned i = 0; i < trees.tree_limit; ++i) {
-        Node *node_tree = node_trees + i * trees.max_nodes;
-        for (unsigned j = 0; j < trees.max_nodes; ++j) {
-            const unsigned en_ind = i * trees.max_nodes + j;
-            node_tree[j].cl = trees.children_left[en_ind];
-            node_tree[j].cr = trees.children_right[en_ind];
-            node_tree[j].cd = trees.children_default[en_ind];
-            if (j == 0) {
-                node_tree[j].pnode = 0;
-            }
-            if (trees.children_left[en_ind] >= 0) { // relies on all unused entries having negative values in them
-                node_tree[trees.children_left[en_ind]].pnode = j;
-                node_tree[trees.children_left[en_ind]].pfeat = trees.features[en_ind];
-            }
-            if (trees.children_right[en_ind] >= 0) { // relies on all unused entries having negative values in them
-                node_tree[trees.children_right[en_ind]].pnode = j;
-                node_tree[trees.children_right[en_ind]].pfeat = trees.features[en_ind];
-            }
+/**
+ * Adds the (unnormalized) independent Tree SHAP values of the rows [x_start, x_end) of X against the
+ * references [r_start, r_end) to out_contribs. The references are visited in blocks of chunk_size
+ * (0 means all at once), so a block of the background stays in cache while every row is explained.
+ */
+template <typename T>
+void dense_independent_block(const TreeEnsemble<T>& trees, const ExplanationDataset<T> &data,
+                             tfloat *out_contribs, tfloat transform(const tfloat, const tfloat),
+                             const Node *node_trees, const float *memoized_weights,
+                             const tfloat *X_margins, const tfloat *R_margins,
+                             unsigned x_start, unsigned x_end, unsigned r_start, unsigned r_end,
+                             unsigned chunk_size, bool show_progress) {
+
+    // each block gets its own copy of the reformatted trees since the traversal writes to them
+    const unsigned total_nodes = trees.tree_offset(trees.tree_limit);
+    Node *my_trees = new Node[total_nodes];
+    std::copy_n(node_trees, total_nodes, my_trees);
 
-            node_tree[j].thres = trees.thresholds[en_ind];
-            node_tree[j].feat = trees.features[en_ind];
-        }
-    }
-    
     // preallocate arrays needed by the algorithm
-    float *pos_lst = new float[trees.max_nodes];
-    float *neg_lst = new float[trees.max_nodes];
+    const unsigned num_outputs = trees.num_outputs;
+    float *pos_lst = new float[trees.max_nodes * num_outputs];
+    float *neg_lst = new float[trees.max_nodes * num_outputs];
     int *node_stack = new int[(unsigned) trees.max_depth];
     signed short *feat_hist = new signed short[data.M];
-    tfloat *tmp_out_contribs = new tfloat[(data.M + 1)];
-
-    // precompute all the weight coefficients
-    float *memoized_weights = new float[(trees.max_depth+1) * (trees.max_depth+1)];
-    for (unsigned n = 0; n <= trees.max_depth; ++n) {
-        for (unsigned m = 0; m <= trees.max_depth; ++m) {
-            memoized_weights[n + trees.max_depth * m] = 1.0 / (n * bin_coeff(n-1, m));
-        }
-    }
+    tfloat *tmp_out_contribs = new tfloat[(data.M + 1) * num_outputs];
+    tfloat *rescale_factors = new tfloat[num_outputs];
+    std::fill_n(rescale_factors, num_outputs, 1.0);
 
-    // compute the explanations for each sample
-    tfloat *instance_out_contribs;
-    tfloat rescale_factor = 1.0;
-    tfloat margin_x = 0;
-    tfloat margin_r = 0;
+    if (chunk_size == 0 || chunk_size > r_end - r_start) chunk_size = r_end - r_start;
+    const unsigned num_chunks = (r_end - r_start + chunk_size - 1) / chunk_size;
     time_t start_time = time(NULL);
     tfloat last_print = 0;
-    for (unsigned oind = 0; oind < trees.num_outputs; ++oind) {
-        // set the values int he reformated tree to the current output index
-        for (unsigned i = 0; i < trees.tree_limit; ++i) {
-            Node *node_tree = node_trees + i * trees.max_nodes;
-            for (unsigned j = 0; j < trees.max_nodes; ++j) {
-                const unsigned en_ind = i * trees.max_nodes + j;
-                node_tree[j].value = trees.values[en_ind * trees.num_outputs + oind];
-            }
-        }
-
-        // loop over all the samples
-        for (unsigned i = 0; i < data.num_X; ++i) {
-            const tfloat *x = data.X + i * data.M;
-            const bool *x_missing = data.X_missing + i * data.M;
-            instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
+    for (unsigned c = 0; c < num_chunks; ++c) {
+        const unsigned chunk_start = r_start + c * chunk_size;
+        const unsigned chunk_end = std::min(chunk_start + chunk_size, r_end);
+
+        for (unsigned i = x_start; i < x_end; ++i) {
+            const T *x = data.X + i * data.M;
+            const bool *x_missing = missing_offset(data.X_missing, i * data.M);
+            tfloat *instance_out_contribs = out_contribs + i * (data.M + 1) * num_outputs;
             const tfloat y_i = data.y == NULL ? 0 : data.y[i];
 
-            print_progress_bar(last_print, start_time, oind * data.num_X + i, data.num_X * trees.num_outputs);
-
-            // compute the model's margin output for x
-            if (transform != NULL) {
-                margin_x = trees.base_offset;
-                for (unsigned k = 0; k < trees.tree_limit; ++k) {
-                    margin_x += tree_predict(k, trees, x, x_missing)[oind];
-                }
+            if (show_progress) {
+                print_progress_bar(last_print, start_time, c * (x_end - x_start) + i - x_start, num_chunks * (x_end - x_start));
             }
 
-            for (unsigned j = 0; j < data.num_R; ++j) {
-                const tfloat *r = data.R + j * data.M;
-                const bool *r_missing = data.R_missing + j * data.M;
-                std::fill_n(tmp_out_contribs, (data.M + 1), 0);
-
-                // compute the model's margin output for r
-                if (transform != NULL) {
-                    margin_r = trees.base_offset;
-                    for (unsigned k = 0; k < trees.tree_limit; ++k) {
-                        margin_r += tree_predict(k, trees, r, r_missing)[oind];
-                    }
-                }
+            for (unsigned j = chunk_start; j < chunk_end; ++j) {
+                const T *r = data.R + j * data.M;
+                const bool *r_missing = missing_offset(data.R_missing, j * data.M);
+                std::fill_n(tmp_out_contribs, (data.M + 1) * num_outputs, 0);
 
                 for (unsigned k = 0; k < trees.tree_limit; ++k) {
                     tree_shap_indep(
-                        trees.max_depth, data.M, trees.max_nodes, x, x_missing, r, r_missing, 
-                        tmp_out_contribs, pos_lst, neg_lst, feat_hist, memoized_weights, 
-                        node_stack, node_trees + k * trees.max_nodes
+                        trees.max_depth, data.M, trees.max_nodes, num_outputs, x, x_missing, r, r_missing,
+                        tmp_out_contribs, pos_lst, neg_lst, feat_hist, memoized_weights,
+                        node_stack, my_trees + trees.tree_offset(k),
+                        trees.values + trees.tree_offset(k) * num_outputs
                     );
                 }
 
-                // compute the rescale factor
+                // compute the rescale factors from the precomputed margins of x and r
                 if (transform != NULL) {
-                    if (margin_x == margin_r) {
-                        rescale_factor = 1.0;
-                    } else {
-                        rescale_factor = (*transform)(margin_x, y_i) - (*transform)(margin_r, y_i);
-                        rescale_factor /= margin_x - margin_r;
+                    const tfloat *margin_x = X_margins + i * num_outputs;
+                    const tfloat *margin_r = R_margins + j * num_outputs;
+                    for (unsigned o = 0; o < num_outputs; ++o) {
+                        if (margin_x[o] == margin_r[o]) {
+                            rescale_factors[o] = 1.0;
+                        } else {
+                            rescale_factors[o] = (*transform)(margin_x[o], y_i) - (*transform)(margin_r[o], y_i);
+                            rescale_factors[o] /= margin_x[o] - margin_r[o];
+                        }
                     }
                 }
 
                 // add the effect of the current reference to our running total
                 // this is where we can do per reference scaling for non-linear transformations
                 for (unsigned k = 0; k < data.M; ++k) {
-                    instance_out_contribs[k * trees.num_outputs + oind] += tmp_out_contribs[k] * rescale_factor;
+                    for (unsigned o = 0; o < num_outputs; ++o) {
+                        instance_out_contribs[k * num_outputs + o] += tmp_out_contribs[k * num_outputs + o] * rescale_factors[o];
+                    }
                 }
 
                 // Add the base offset
-                if (transform != NULL) {
-                    instance_out_contribs[data.M * trees.num_outputs + oind] += (*transform)(trees.base_offset + tmp_out_contribs[data.M], 0);
-                } else {
-                    instance_out_contribs[data.M * trees.num_outputs + oind] += trees.base_offset + tmp_out_contribs[data.M];
+                for (unsigned o = 0; o < num_outputs; ++o) {
+                    const tfloat bias = trees.base_offset + tmp_out_contribs[data.M * num_outputs + o];
+                    instance_out_contribs[data.M * num_outputs + o] += transform != NULL ? (*transform)(bias, 0) : bias;
                 }
             }
-
-            // average the results over all the references.
-            for (unsigned j = 0; j < (data.M + 1); ++j) {
-                instance_out_contribs[j * trees.num_outputs + oind] /= data.num_R;
-            }
-
-            // apply the base offset to the bias term
-            // for (unsigned j = 0; j < trees.num_outputs; ++j) {
-            //     instance_out_contribs[data.M * trees.num_outputs + j] += (*transform)(trees.base_offset, 0);
-            // }
         }
     }
-    
+
+    delete[] my_trees;
     delete[] tmp_out_contribs;
-    delete[] node_trees;
+    delete[] rescale_factors;
     delete[] pos_lst;
     delete[] neg_lst;
     delete[] node_stack;
     delete[] feat_hist;
+}
+
+/**
+ * Runs Tree SHAP with feature independence assumptions on dense data.
+ *
+ * The margins of the references are computed once per call, unless the dataset already carries them
+ * (data.R_margins) from an earlier call against the same background, and the margins of X are summed
+ * from data.X_leaves when it is given. The (x, r) pairs are split across
+ * num_threads threads by rows of X, or by references when there are fewer rows than threads
+ * (each thread then sums into its own buffer). See dense_independent_block for chunk_size.
+ */
+template <typename T>
+void dense_independent(const TreeEnsemble<T>& trees, const ExplanationDataset<T> &data,
+                       tfloat *out_contribs, tfloat transform(const tfloat, const tfloat),
+                       unsigned num_threads = 1, unsigned chunk_size = 0) {
+    if (data.num_X == 0 || data.num_R == 0) return;
+
+    // reformat the trees for faster access
+    Node *node_trees = new Node[trees.tree_offset(trees.tree_limit)];
+    for (unsigned i = 0; i < trees.tree_limit; ++i) {
+        Node *node_tree = node_trees + trees.tree_offset(i);
+        for (unsigned j = 0; j < trees.tree_num_nodes(i); ++j) {
+            const unsigned en_ind = trees.tree_offset(i) + j;
+            node_tree[j].cl = trees.children_left[en_ind];
+            node_tree[j].cr = trees.children_right[en_ind];
+            node_tree[j].cd = trees.children_default[en_ind];
+            if (j == 0) {
+                node_tree[j].pnode = 0;
+            }
+            if (trees.children_left[en_ind] >= 0) { // relies on all unused entries having negative values in them
+                node_tree[trees.children_left[en_ind]].pnode = j;
+                node_tree[trees.children_left[en_ind]].pfeat = trees.features[en_ind];
+            }
+            if (trees.children_right[en_ind] >= 0) { // relies on all unused entries having negative values in them
+                node_tree[trees.children_right[en_ind]].pnode = j;
+                node_tree[trees.children_right[en_ind]].pfeat = trees.features[en_ind];
+            }
+
+            node_tree[j].thres = trees.thresholds[en_ind];
+            node_tree[j].feat = trees.features[en_ind];
+        }
+    }
+
+    // precompute all the weight coefficients
+    float *memoized_weights = new float[(trees.max_depth+1) * (trees.max_depth+1)];
+    for (unsigned n = 0; n <= trees.max_depth; ++n) {
+        for (unsigned m = 0; m <= trees.max_depth; ++m) {
+            memoized_weights[n + trees.max_depth * m] = 1.0 / (n * bin_coeff(n-1, m));
+        }
+    }
+
+    // the margins only depend on a single row, so compute them once instead of once per (x, r) pair
+    const unsigned num_outputs = trees.num_outputs;
+    tfloat *X_margins = NULL;
+    tfloat *R_margins = NULL;
+    if (transform != NULL) {
+        X_margins = new tfloat[data.num_X * num_outputs];
+        dense_tree_margins(X_margins, trees, data.X, data.X_missing, data.num_X, data.M, num_threads, data.X_leaves);
+        if (data.R_margins == NULL) {
+            R_margins = new tfloat[data.num_R * num_outputs];
+            dense_tree_margins(R_margins, trees, data.R, data.R_missing, data.num_R, data.M, num_threads);
+        }
+    }
+    const tfloat *background_margins = data.R_margins == NULL ? R_margins : data.R_margins;
+
+    const unsigned row_size = (data.M + 1) * num_outputs;
+    if (data.num_X >= num_threads || data.num_R < 2) {
+        parallel_for_rows(data.num_X, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+            dense_independent_block(
+                trees, data, out_contribs, transform, node_trees, memoized_weights, X_margins, background_margins,
+                start, end, 0, data.num_R, chunk_size, thread_index == 0
+            );
+        });
+    } else {
+        const unsigned num_blocks = std::min(num_threads, data.num_R);
+        std::vector<tfloat*> block_out_contribs(num_blocks, (tfloat*)NULL);
+        parallel_for_rows(data.num_R, num_blocks, [&](unsigned start, unsigned end, unsigned thread_index) {
+            tfloat *block_out = out_contribs;
+            if (thread_index > 0) {
+                block_out = block_out_contribs[thread_index] = new tfloat[data.num_X * row_size]();
+            }
+            dense_independent_block(
+                trees, data, block_out, transform, node_trees, memoized_weights, X_margins, background_margins,
+                0, data.num_X, start, end, chunk_size, thread_index == 0
+            );
+        });
+        for (unsigned b = 1; b < num_blocks; ++b) {
+            if (block_out_contribs[b] == NULL) continue;
+            for (unsigned j = 0; j < data.num_X * row_size; ++j) out_contribs[j] += block_out_contribs[b][j];
+            delete[] block_out_contribs[b];
+        }
+    }
+
+    // average the results over all the references.
+    for (unsigned j = 0; j < data.num_X * row_size; ++j) {
+        out_contribs[j] /= data.num_R;
+    }
+
+    delete[] X_margins;
+    delete[] R_margins;
+    delete[] node_trees;
     delete[] memoized_weights;
 }
 
@@ -1260,11 +1669,12 @@ void dense_independent(const TreeEnsemble& trees, const ExplanationDataset &data
 /**
  * This runs Tree SHAP with a per tree path conditional dependence assumption.
  */
-void dense_tree_path_dependent(const TreeEnsemble& trees, const ExplanationDataset &data,
+template <typename T>
+void dense_tree_path_dependent(const TreeEnsemble<T>& trees, const ExplanationDataset<T> &data,
                                tfloat *out_contribs, tfloat transform(const tfloat, const tfloat)) {
     tfloat *instance_out_contribs;
-    TreeEnsemble tree;
-    ExplanationDataset instance;
+    TreeEnsemble<T> tree;
+    ExplanationDataset<T> instance;
 
     // build explanation for each sample
     for (unsigned i = 0; i < data.num_X; ++i) {
@@ -1285,6 +1695,240 @@ void dense_tree_path_dependent(const TreeEnsemble& trees, const ExplanationDatas
     }
 }
 
+/**
+ * Precomputed per leaf tables that turn path dependent Tree SHAP into lookups, for ensembles of
+ * shallow trees (this is the idea behind "Fast TreeSHAP v2").
+ *
+ * A leaf whose path splits on d distinct features (its slots) adds
+ *     v * (o_i - p_i) * Q_i(A \ {i})
+ * to the SHAP value of the feature in slot i, where v is the leaf value, p_i is the product of the
+ * zero fractions (cover ratios) of the path's splits on that feature, o_i is 1 when x follows all of
+ * them, A is the set of slots with o = 1, and
+ *     Q_i(B) = sum over S in B of |S|!(d-|S|-1)!/d! * prod of p_j for the slots j not in S or {i}.
+ * Q_i only depends on the tree, so it is tabulated for every subset B of the other d-1 slots, which
+ * takes d * 2^(d-1) entries per leaf. Explaining a row then costs one pass over the internal nodes
+ * (to find which path conditions hold) plus d lookups per leaf, instead of the O(d^2) path updates
+ * per leaf that tree_shap_recursive does.
+ */
+struct PathTables {
+    std::vector<int> node_slots; // laid out like the nodes, the slot of each internal node's split feature
+    std::vector<unsigned> preorder; // laid out like the nodes, the internal nodes of each tree in preorder
+    std::vector<unsigned> tree_num_internal;
+    std::vector<unsigned> tree_leaf_offsets; // tree i has the leaves [tree_leaf_offsets[i], tree_leaf_offsets[i + 1])
+    std::vector<unsigned> leaf_nodes; // the node index (within its tree) of each leaf
+    std::vector<unsigned> leaf_slot_offsets; // leaf l has the slots [leaf_slot_offsets[l], leaf_slot_offsets[l + 1])
+    std::vector<int> slot_features;
+    std::vector<tfloat> slot_zero_fractions;
+    std::vector<size_t> leaf_table_offsets; // Q_i of leaf l starts at leaf_table_offsets[l] + i * 2^(d-1)
+    std::vector<tfloat> tables;
+};
+
+/**
+ * The number of table entries PathTables needs for the trees (or max_entries + 1 if that is exceeded).
+ */
+template <typename T>
+inline size_t path_table_size(const TreeEnsemble<T> &trees, const size_t max_entries) {
+    size_t total = 0;
+    std::vector<int> path_features;
+    std::vector<std::pair<unsigned, unsigned> > stack; // (node, path length when the node is entered)
+    for (unsigned i = 0; i < trees.tree_limit; ++i) {
+        const unsigned offset = trees.tree_offset(i);
+        path_features.clear();
+        stack.push_back(std::make_pair(0u, 0u));
+        while (!stack.empty()) {
+            const unsigned node = stack.back().first;
+            path_features.resize(stack.back().second);
+            stack.pop_back();
+            const unsigned pos = offset + node;
+            if (trees.children_left[pos] < 0) {
+                const size_t d = path_features.size();
+                if (d > 30) return max_entries + 1;
+                if (d > 0) total += d << (d - 1);
+                if (total > max_entries) return max_entries + 1;
+                continue;
+            }
+            if (std::find(path_features.begin(), path_features.end(), trees.features[pos]) == path_features.end()) {
+                path_features.push_back(trees.features[pos]);
+            }
+            stack.push_back(std::make_pair((unsigned)trees.children_right[pos], (unsigned)path_features.size()));
+            stack.push_back(std::make_pair((unsigned)trees.children_left[pos], (unsigned)path_features.size()));
+        }
+    }
+    return total;
+}
+
+// fills the Q_i tables (see PathTables) of a leaf with d slots whose zero fractions are p
+inline void fill_leaf_path_tables(tfloat *out, const tfloat *p, const unsigned d) {
+    const unsigned num_other = d - 1;
+    const unsigned num_subsets = 1 << num_other;
+
+    // the Shapley weight of a subset of size k out of d players
+    std::vector<tfloat> weights(d);
+    for (unsigned k = 0; k < d; ++k) {
+        weights[k] = 1.0 / (d * (tfloat)bin_coeff(d - 1, k));
+    }
+
+    std::vector<tfloat> other(num_other);
+    std::vector<tfloat> products(num_subsets); // prod of p over each subset
+    std::vector<tfloat> polys(num_subsets * d); // coefficients of prod (t + p_j) over each subset
+    for (unsigned i = 0; i < d; ++i) {
+        for (unsigned j = 0, k = 0; j < d; ++j) {
+            if (j != i) other[k++] = p[j];
+        }
+
+        products[0] = 1;
+        std::fill(polys.begin(), polys.begin() + d, 0);
+        polys[0] = 1;
+        for (unsigned b = 1; b < num_subsets; ++b) {
+            unsigned low = 0;
+            while (!(b & (1 << low))) ++low;
+            const unsigned prev = b & (b - 1);
+            products[b] = products[prev] * other[low];
+
+            // multiply the previous polynomial by (t + p_low)
+            const tfloat *prev_poly = &polys[prev * d];
+            tfloat *poly = &polys[b * d];
+            poly[0] = prev_poly[0] * other[low];
+            for (unsigned k = 1; k < d; ++k) poly[k] = prev_poly[k] * other[low] + prev_poly[k - 1];
+        }
+
+        // Q_i(B) is the weighted sum over the sizes of S, times the zero fractions outside of B
+        for (unsigned b = 0; b < num_subsets; ++b) {
+            tfloat sum = 0;
+            for (unsigned k = 0; k < d; ++k) sum += weights[k] * polys[b * d + k];
+            out[i * num_subsets + b] = sum * products[(num_subsets - 1) & ~b];
+        }
+    }
+}
+
+// adds the node (and recursively its children) of tree i to the PathTables, given the path leading to it
+template <typename T>
+inline void add_path_table_nodes(PathTables &tables, const TreeEnsemble<T> &trees, const unsigned i,
+                                 const unsigned node, std::vector<int> path_features,
+                                 std::vector<tfloat> path_zero_fractions, size_t &table_offset) {
+    const unsigned offset = trees.tree_offset(i);
+    const unsigned pos = offset + node;
+    if (trees.children_left[pos] < 0) {
+        const unsigned d = path_features.size();
+        tables.leaf_nodes.push_back(node);
+        tables.slot_features.insert(tables.slot_features.end(), path_features.begin(), path_features.end());
+        tables.slot_zero_fractions.insert(tables.slot_zero_fractions.end(), path_zero_fractions.begin(), path_zero_fractions.end());
+        tables.leaf_slot_offsets.push_back(tables.slot_features.size());
+        tables.leaf_table_offsets.push_back(table_offset);
+        if (d > 0) {
+            fill_leaf_path_tables(&tables.tables[table_offset], &path_zero_fractions[0], d);
+            table_offset += (size_t)d << (d - 1);
+        }
+        return;
+    }
+
+    // the slot of this split's feature is the same for every leaf below it
+    const int feature = trees.features[pos];
+    const unsigned slot = std::find(path_features.begin(), path_features.end(), feature) - path_features.begin();
+    if (slot == path_features.size()) {
+        path_features.push_back(feature);
+        path_zero_fractions.push_back(1);
+    }
+    tables.node_slots[pos] = slot;
+    tables.preorder[offset + tables.tree_num_internal[i]++] = node;
+
+    const unsigned children[2] = {(unsigned)trees.children_left[pos], (unsigned)trees.children_right[pos]};
+    const tfloat incoming_zero_fraction = path_zero_fractions[slot];
+    for (unsigned k = 0; k < 2; ++k) {
+        path_zero_fractions[slot] = incoming_zero_fraction * trees.node_sample_weights[offset + children[k]] / trees.node_sample_weights[pos];
+        add_path_table_nodes(tables, trees, i, children[k], path_features, path_zero_fractions, table_offset);
+    }
+}
+
+/**
+ * Builds the PathTables of the trees, unless they would take more than max_entries table entries.
+ */
+template <typename T>
+inline bool build_path_tables(PathTables &tables, const TreeEnsemble<T> &trees, const size_t max_entries) {
+    const size_t num_entries = path_table_size(trees, max_entries);
+    if (num_entries > max_entries) return false;
+
+    const unsigned total_nodes = trees.tree_offset(trees.tree_limit);
+    tables.node_slots.assign(total_nodes, -1);
+    tables.preorder.assign(total_nodes, 0);
+    tables.tree_num_internal.assign(trees.tree_limit, 0);
+    tables.tree_leaf_offsets.assign(1, 0);
+    tables.leaf_nodes.clear();
+    tables.leaf_slot_offsets.assign(1, 0);
+    tables.slot_features.clear();
+    tables.slot_zero_fractions.clear();
+    tables.leaf_table_offsets.clear();
+    tables.tables.assign(num_entries, 0);
+
+    size_t table_offset = 0;
+    for (unsigned i = 0; i < trees.tree_limit; ++i) {
+        add_path_table_nodes(tables, trees, i, 0, std::vector<int>(), std::vector<tfloat>(), table_offset);
+        tables.tree_leaf_offsets.push_back(tables.leaf_nodes.size());
+    }
+    return true;
+}
+
+/**
+ * This runs Tree SHAP with a per tree path conditional dependence assumption using PathTables.
+ */
+template <typename T>
+void dense_tree_path_table_shap(const TreeEnsemble<T>& trees, const PathTables &tables,
+                                const ExplanationDataset<T> &data, tfloat *out_contribs) {
+    const unsigned num_outputs = trees.num_outputs;
+    std::vector<unsigned> failed(trees.max_nodes); // the slots whose conditions fail on the way to each node
+    for (unsigned i = 0; i < data.num_X; ++i) {
+        const T *x = data.X + i * data.M;
+        const bool *x_missing = missing_offset(data.X_missing, i * data.M);
+        tfloat *phi = out_contribs + i * (data.M + 1) * num_outputs;
+
+        for (unsigned j = 0; j < trees.tree_limit; ++j) {
+            const unsigned offset = trees.tree_offset(j);
+            const unsigned tree = trees.first_tree + j; // the tables cover the whole ensemble
+            const TreeNode<T> *nodes = trees.nodes + offset;
+
+            // find which path conditions x meets
+            failed[0] = 0;
+            for (unsigned k = 0; k < tables.tree_num_internal[tree]; ++k) {
+                const unsigned node = tables.preorder[offset + k];
+                const int hot = nodes[node].next_node(x, x_missing);
+                const int cold = hot == nodes[node].children_left ? nodes[node].children_right : nodes[node].children_left;
+                failed[hot] = failed[node];
+                failed[cold] = failed[node] | (1u << tables.node_slots[offset + node]);
+            }
+
+            // combine the table entries of every leaf
+            for (unsigned l = tables.tree_leaf_offsets[tree]; l < tables.tree_leaf_offsets[tree + 1]; ++l) {
+                const unsigned node = tables.leaf_nodes[l];
+                const unsigned slot_offset = tables.leaf_slot_offsets[l];
+                const unsigned d = tables.leaf_slot_offsets[l + 1] - slot_offset;
+                if (d == 0) continue;
+                const unsigned fail_mask = failed[node];
+                const unsigned met = ((1u << d) - 1) & ~fail_mask;
+                const tfloat *table = &tables.tables[tables.leaf_table_offsets[l]];
+                const T *values = trees.values + (offset + node) * num_outputs;
+                const unsigned num_subsets = 1u << (d - 1);
+                for (unsigned s = 0; s < d; ++s) {
+                    const unsigned others = (met & ((1u << s) - 1)) | ((met >> (s + 1)) << s);
+                    const tfloat one_fraction = (fail_mask >> s) & 1 ? 0 : 1;
+                    const tfloat scale = (one_fraction - tables.slot_zero_fractions[slot_offset + s]) * table[s * num_subsets + others];
+                    tfloat *feature_phi = phi + tables.slot_features[slot_offset + s] * num_outputs;
+                    for (unsigned k = 0; k < num_outputs; ++k) feature_phi[k] += scale * values[k];
+                }
+            }
+
+            // the expected value of the tree
+            for (unsigned k = 0; k < num_outputs; ++k) {
+                phi[data.M * num_outputs + k] += trees.values[offset * num_outputs + k];
+            }
+        }
+
+        // apply the base offset to the bias term
+        for (unsigned k = 0; k < num_outputs; ++k) {
+            phi[data.M * num_outputs + k] += trees.base_offset;
+        }
+    }
+}
+
 // phi = np.zeros((self._current_X.shape[1] + 1, self._current_X.shape[1] + 1, self.n_outputs))
 //         phi_diag = np.zeros((self._current_X.shape[1] + 1, self.n_outputs))
 //         for t in range(self.tree_limit):
@@ -1301,37 +1945,32 @@ void dense_tree_path_dependent(const TreeEnsemble& trees, const ExplanationDatas
 //         phi /= self.tree_limit
 //         return phi
 
-void dense_tree_interactions_path_dependent(const TreeEnsemble& trees, const ExplanationDataset &data,
+template <typename T>
+void dense_tree_interactions_path_dependent(const TreeEnsemble<T>& trees, const ExplanationDataset<T> &data,
                                             tfloat *out_contribs,
-                                            tfloat transform(const tfloat, const tfloat)) {
+                                            tfloat transform(const tfloat, const tfloat),
+                                            unsigned reduce = INTERACTION_REDUCE::none) {
 
-    // build a list of all the unique features in each tree
-    int *unique_features = new int[trees.tree_limit * trees.max_nodes];
-    std::fill(unique_features, unique_features + trees.tree_limit * trees.max_nodes, -1);
-    for (unsigned j = 0; j < trees.tree_limit; ++j) {
-        const int *features_row = trees.features + j * trees.max_nodes;
-        int *unique_features_row = unique_features + j * trees.max_nodes;
-        for (unsigned k = 0; k < trees.max_nodes; ++k) {
-            for (unsigned l = 0; l < trees.max_nodes; ++l) {
-                if (features_row[k] == unique_features_row[l]) break;
-                if (unique_features_row[l] < 0) {
-                    unique_features_row[l] = features_row[k];
-                    break;
-                }
-            }
-        }
-    }
-    
     // build an interaction explanation for each sample
     tfloat *instance_out_contribs;
-    TreeEnsemble tree;
-    ExplanationDataset instance;
+    TreeEnsemble<T> tree;
+    ExplanationDataset<T> instance;
     const unsigned contrib_row_size = (data.M + 1) * trees.num_outputs;
+    const unsigned instance_size = (data.M + 1) * contrib_row_size;
     tfloat *diag_contribs = new tfloat[contrib_row_size];
-    tfloat *on_contribs = new tfloat[contrib_row_size];
-    tfloat *off_contribs = new tfloat[contrib_row_size];
+    tfloat *on_off_contribs = new tfloat[contrib_row_size];
+
+    // when reducing over the samples each one is explained into the same (cache resident) scratch
+    // matrix, which is then added into out_contribs, so out_contribs only holds a single matrix
+    tfloat *scratch_contribs = NULL;
+    if (reduce != INTERACTION_REDUCE::none) scratch_contribs = new tfloat[instance_size];
+
     for (unsigned i = 0; i < data.num_X; ++i) {
-        instance_out_contribs = out_contribs + i * (data.M + 1) * contrib_row_size;
+        if (scratch_contribs == NULL) instance_out_contribs = out_contribs + i * instance_size;
+        else {
+            instance_out_contribs = scratch_contribs;
+            std::fill(scratch_contribs, scratch_contribs + instance_size, 0);
+        }
         data.get_x_instance(instance, i);
 
         // aggregate the effect of explaining each tree
@@ -1341,22 +1980,19 @@ void dense_tree_interactions_path_dependent(const TreeEnsemble& trees, const Exp
             trees.get_tree(tree, j);
             tree_shap(tree, instance, diag_contribs, 0, 0);
 
-            const int *unique_features_row = unique_features + j * trees.max_nodes;
-            for (unsigned k = 0; k < trees.max_nodes; ++k) {
-                const int ind = unique_features_row[k];
+            for (unsigned k = 0; k < trees.tree_num_nodes(j); ++k) {
+                const int ind = tree.unique_features[k];
                 if (ind < 0) break; // < 0 means we have seen all the features for this tree
 
-                // compute the shap value with this feature held on and off
-                std::fill(on_contribs, on_contribs + contrib_row_size, 0);
-                std::fill(off_contribs, off_contribs + contrib_row_size, 0);
-                tree_shap(tree, instance, on_contribs, 1, ind);
-                tree_shap(tree, instance, off_contribs, -1, ind);
+                // compute the difference between the shap values with this feature held on and off
+                std::fill(on_off_contribs, on_off_contribs + contrib_row_size, 0);
+                tree_shap(tree, instance, on_off_contribs, 2, ind);
 
                 // save the difference between on and off as the interaction value
                 for (unsigned l = 0; l < contrib_row_size; ++l) {
-                    const tfloat val = (on_contribs[l] - off_contribs[l]) / 2;
+                    const tfloat val = on_off_contribs[l] / 2;
                     instance_out_contribs[ind * contrib_row_size + l] += val;
-                    diag_contribs[ind] -= val;
+                    diag_contribs[ind * trees.num_outputs + l % trees.num_outputs] -= val;
                 }
             }
         }
@@ -1369,65 +2005,155 @@ void dense_tree_interactions_path_dependent(const TreeEnsemble& trees, const Exp
             }
         }
 
-        // apply the base offset to the bias term
+        // the bias term is the expected value of the trees plus the base offset
         const unsigned last_ind = (data.M * (data.M + 1) + data.M) * trees.num_outputs;
         for (unsigned j = 0; j < trees.num_outputs; ++j) {
-            instance_out_contribs[last_ind + j] += trees.base_offset;
+            instance_out_contribs[last_ind + j] += diag_contribs[data.M * trees.num_outputs + j] + trees.base_offset;
+        }
+
+        // accumulate the reduction (the bias term is always summed with its sign so it stays usable)
+        if (reduce == INTERACTION_REDUCE::sum) {
+            for (unsigned j = 0; j < instance_size; ++j) out_contribs[j] += scratch_contribs[j];
+        } else if (reduce == INTERACTION_REDUCE::sum_abs) {
+            for (unsigned j = 0; j < last_ind; ++j) out_contribs[j] += std::abs(scratch_contribs[j]);
+            for (unsigned j = last_ind; j < instance_size; ++j) out_contribs[j] += scratch_contribs[j];
         }
     }
 
     delete[] diag_contribs;
-    delete[] on_contribs;
-    delete[] off_contribs;
-    delete[] unique_features;
+    delete[] on_off_contribs;
+    delete[] scratch_contribs;
 }
 
 /**
- * This runs Tree SHAP with a global path conditional dependence assumption.
- * 
- * By first merging all the trees in a tree ensemble into an equivalent single tree
- * this method allows arbitrary marginal transformations and also ensures that all the
- * evaluations of the model are consistent with some training data point.
+ * This runs Tree SHAP with a global path conditional dependence assumption: the ensemble is merged into a
+ * single tree (see build_merged_tree) whose node weights count the background rows of R, which is then
+ * explained like a path dependent tree. Only the splits between a row and the background matter for its
+ * SHAP values, so the rows of X are merged with R chunk_size rows at a time (0 means all at once), which
+ * bounds each merged tree at 2 * (chunk_size + num_R) nodes. The chunks are split across num_threads threads.
  */
-void dense_global_path_dependent(const TreeEnsemble& trees, const ExplanationDataset &data,
-                                 tfloat *out_contribs, tfloat transform(const tfloat, const tfloat)) {
-
-    // allocate space for our new merged tree (we save enough room to totally split all samples if need be)
-    TreeEnsemble merged_tree;
-    merged_tree.allocate(1, (data.num_X + data.num_R) * 2, trees.num_outputs);
-    
-    // collapse the ensemble of trees into a single tree that has the same behavior
-    // for all the X and R samples in the dataset
-    build_merged_tree(merged_tree, data, trees);
+template <typename T>
+void dense_global_path_dependent(const TreeEnsemble<T>& trees, const ExplanationDataset<T> &data,
+                                 tfloat *out_contribs, tfloat transform(const tfloat, const tfloat),
+                                 unsigned chunk_size = 0, unsigned num_threads = 1) {
+    if (chunk_size == 0 || chunk_size > data.num_X) chunk_size = data.num_X;
+    if (chunk_size == 0) return;
+    const unsigned num_chunks = (data.num_X + chunk_size - 1) / chunk_size;
+    const unsigned num_outputs = trees.num_outputs;
+
+    parallel_for_rows(num_chunks, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+
+        // allocate space for the merged tree (we save enough room to totally split all samples if need be)
+        TreeEnsemble<T> merged_tree;
+        merged_tree.allocate(1, (chunk_size + data.num_R) * 2, num_outputs);
+        std::vector<PathElement> unique_path_data;
+
+        for (unsigned c = start; c < end; ++c) {
+            ExplanationDataset<T> chunk;
+            data.get_x_slice(chunk, c * chunk_size, std::min((c + 1) * chunk_size, data.num_X));
+
+            // collapse the ensemble of trees into a single tree that has the same behavior
+            // for all the X and R samples in the chunk
+            build_merged_tree(merged_tree, chunk, trees);
+            merged_tree.pack_nodes();
+
+            // the unique path of each level holds at most one element per feature (plus the root)
+            const size_t maxd = merged_tree.max_depth + 2;
+            unique_path_data.resize(std::min(maxd * (maxd + 1) / 2, (maxd + 1) * (data.M + 2)));
+
+            // explain each sample using the merged tree with the tree_path_dependent algorithm
+            ExplanationDataset<T> instance;
+            for (unsigned i = 0; i < chunk.num_X; ++i) {
+                tfloat *instance_out_contribs = out_contribs + (size_t)(c * chunk_size + i) * (data.M + 1) * num_outputs;
+                chunk.get_x_instance(instance, i);
+                tree_shap_recursive(
+                    num_outputs, merged_tree.nodes, merged_tree.values, merged_tree.node_sample_weights,
+                    instance.X, instance.X_missing, instance_out_contribs, 0, 0, unique_path_data.data(),
+                    1, 1, -1, 0, 0, 1
+                );
+
+                // the expected value of the merged tree plus the base offset is the bias term
+                for (unsigned j = 0; j < num_outputs; ++j) {
+                    instance_out_contribs[data.M * num_outputs + j] += merged_tree.values[j] + trees.base_offset;
+                }
+            }
+            merged_tree.free_nodes();
+        }
+        merged_tree.free();
+    });
+}
 
-    // compute the expected value and depth of the new merged tree
-    compute_expectations(merged_tree);
 
-    // explain each sample using our new merged tree
-    ExplanationDataset instance;
-    tfloat *instance_out_contribs;
-    for (unsigned i = 0; i < data.num_X; ++i) {
-        instance_out_contribs = out_contribs + i * (data.M + 1) * trees.num_outputs;
-        data.get_x_instance(instance, i);
-       
-        // since we now just have a single merged tree we can just use the tree_path_dependent algorithm
-        tree_shap(merged_tree, instance, instance_out_contribs, 0, 0);
+/**
+ * Sums the path dependent Tree SHAP values of the rows of X separately for each tree, into the
+ * tree_limit x M x num_outputs matrix in out_contribs (the absolute values when absolute is set).
+ * Only the split features of a tree can get non-zero values from it, so each row costs the same
+ * as dense_tree_path_dependent. The rows are split across num_threads threads that each sum into
+ * their own matrix. Needs trees.unique_features, and path_tables are used like in dense_tree_shap.
+ */
+template <typename T>
+void dense_tree_shap_per_tree(const TreeEnsemble<T>& trees, const ExplanationDataset<T> &data,
+                              tfloat *out_contribs, bool absolute, unsigned num_threads = 1,
+                              const PathTables *path_tables = NULL) {
+    const unsigned num_outputs = trees.num_outputs;
+    const size_t tree_size = (size_t)data.M * num_outputs;
+    const size_t out_size = trees.tree_limit * tree_size;
+    if (num_threads > data.num_X) num_threads = data.num_X > 0 ? data.num_X : 1;
+
+    // the first thread sums into out_contribs and the others into their own matrices
+    std::vector<tfloat> thread_contribs((num_threads - 1) * out_size, 0);
+    parallel_for_rows(data.num_X, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+        tfloat *my_contribs = thread_index == 0 ? out_contribs : &thread_contribs[(thread_index - 1) * out_size];
+        std::vector<tfloat> phi((data.M + 1) * num_outputs, 0);
+        TreeEnsemble<T> tree;
+        ExplanationDataset<T> instance;
+        for (unsigned i = start; i < end; ++i) {
+            data.get_x_instance(instance, i);
+            for (unsigned j = 0; j < trees.tree_limit; ++j) {
+                if (path_tables != NULL) {
+                    trees.get_tree_range(tree, j, 1);
+                    tree.base_offset = 0;
+                    dense_tree_path_table_shap(tree, *path_tables, instance, phi.data());
+                } else {
+                    trees.get_tree(tree, j);
+                    tree_shap(tree, instance, phi.data(), 0, 0);
+                }
 
-        // apply the base offset to the bias term
-        for (unsigned j = 0; j < trees.num_outputs; ++j) {
-            instance_out_contribs[data.M * trees.num_outputs + j] += trees.base_offset;
+                // move the values of the tree's features into its matrix, leaving phi zeroed for the next tree
+                tfloat *tree_contribs = my_contribs + j * tree_size;
+                const int *features = trees.unique_features + trees.tree_offset(j);
+                for (unsigned k = 0; k < trees.tree_num_nodes(j) && features[k] >= 0; ++k) {
+                    const unsigned f = features[k] * num_outputs;
+                    for (unsigned o = 0; o < num_outputs; ++o) {
+                        tree_contribs[f + o] += absolute ? std::abs(phi[f + o]) : phi[f + o];
+                        phi[f + o] = 0;
+                    }
+                }
+                std::fill(phi.begin() + tree_size, phi.end(), 0);
+            }
         }
-    }
+    });
 
-    merged_tree.free();
+    for (unsigned b = 0; b + 1 < num_threads; ++b) {
+        for (size_t j = 0; j < out_size; ++j) out_contribs[j] += thread_contribs[b * out_size + j];
+    }
 }
 
 
 /**
  * The main method for computing Tree SHAP on model using dense data.
+ *
+ * The rows of X are split across num_threads native threads, each writing to its own
+ * slice of out_contribs.
+ * For interactions a reduce other than INTERACTION_REDUCE::none sums the interaction matrices
+ * of all the rows into the single (M+1) x (M+1) x num_outputs matrix in out_contribs. When path_tables
+ * (built for the same trees) are given, tree path dependent SHAP values are looked up from them.
  */
-void dense_tree_shap(const TreeEnsemble& trees, const ExplanationDataset &data, tfloat *out_contribs,
-                     const int feature_dependence, unsigned model_transform, bool interactions) {
+template <typename T>
+void dense_tree_shap(const TreeEnsemble<T>& trees, const ExplanationDataset<T> &data, tfloat *out_contribs,
+                     const int feature_dependence, unsigned model_transform, bool interactions,
+                     unsigned num_threads = 1, unsigned chunk_size = 0,
+                     unsigned reduce = INTERACTION_REDUCE::none, const PathTables *path_tables = NULL) {
 
     // see what transform (if any) we have
     tfloat (* transform)(const tfloat margin, const tfloat y) = NULL;
@@ -1450,18 +2176,173 @@ void dense_tree_shap(const TreeEnsemble& trees, const ExplanationDataset &data,
         case FEATURE_DEPENDENCE::independent:
             if (interactions) {
                 std::cerr << "FEATURE_DEPENDENCE::independent does not support interactions!\n";
-            } else dense_independent(trees, data, out_contribs, transform);
-            return;
-        
-        case FEATURE_DEPENDENCE::tree_path_dependent:
-            if (interactions) dense_tree_interactions_path_dependent(trees, data, out_contribs, transform);
-            else dense_tree_path_dependent(trees, data, out_contribs, transform);
+            } else dense_independent(trees, data, out_contribs, transform, num_threads, chunk_size);
             return;
 
         case FEATURE_DEPENDENCE::global_path_dependent:
             if (interactions) {
                 std::cerr << "FEATURE_DEPENDENCE::global_path_dependent does not support interactions!\n";
-            } else dense_global_path_dependent(trees, data, out_contribs, transform);
+            } else dense_global_path_dependent(trees, data, out_contribs, transform, chunk_size, num_threads);
             return;
     }
+
+    // the interactions need the unique features of each tree, which all the threads share
+    TreeEnsemble<T> interaction_trees = trees;
+    if (interactions && trees.unique_features == NULL) {
+        interaction_trees.unique_features = new int[trees.tree_offset(trees.tree_limit)];
+        trees.fill_unique_features(interaction_trees.unique_features);
+    }
+
+    // the per-row algorithms can each work on their own block of rows
+    const unsigned row_size = (data.M + 1) * trees.num_outputs * (interactions ? data.M + 1 : 1);
+    if (interactions && reduce != INTERACTION_REDUCE::none) {
+
+        // each thread reduces its rows into a private matrix, and those are summed at the end
+        if (num_threads > data.num_X) num_threads = data.num_X > 0 ? data.num_X : 1;
+        tfloat *thread_contribs = new tfloat[row_size * num_threads];
+        std::fill(thread_contribs, thread_contribs + row_size * num_threads, 0);
+        parallel_for_rows(data.num_X, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+            ExplanationDataset<T> slice;
+            data.get_x_slice(slice, start, end);
+            dense_tree_interactions_path_dependent(
+                interaction_trees, slice, thread_contribs + thread_index * row_size, transform, reduce
+            );
+        });
+        for (unsigned i = 0; i < num_threads; ++i) {
+            for (unsigned j = 0; j < row_size; ++j) out_contribs[j] += thread_contribs[i * row_size + j];
+        }
+        delete[] thread_contribs;
+    } else {
+        parallel_for_rows(data.num_X, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+            ExplanationDataset<T> slice;
+            data.get_x_slice(slice, start, end);
+            tfloat *slice_out_contribs = out_contribs + start * row_size;
+
+            if (interactions) dense_tree_interactions_path_dependent(interaction_trees, slice, slice_out_contribs, transform);
+            else if (path_tables != NULL) dense_tree_path_table_shap(trees, *path_tables, slice, slice_out_contribs);
+            else dense_tree_path_dependent(trees, slice, slice_out_contribs, transform);
+        });
+    }
+
+    if (interaction_trees.unique_features != trees.unique_features) delete[] interaction_trees.unique_features;
+}
+
+/**
+ * The rows of a CSR matrix to explain. Entries that are not stored are zero, and stored NaNs are missing.
+ */
+template <typename T = tfloat>
+struct SparseDataset {
+    const T *data;
+    const int *indices;
+    const long long *indptr;
+    unsigned num_X;
+    unsigned M;
+
+    SparseDataset(const T *data, const int *indices, const long long *indptr, unsigned num_X, unsigned M) :
+        data(data), indices(indices), indptr(indptr), num_X(num_X), M(M) {}
+};
+
+/**
+ * SHAP values as a CSR matrix with num_outputs * M columns, where the value of feature j for output k
+ * is stored in column k * M + j. The bias term is not stored.
+ */
+struct SparseContribs {
+    std::vector<long long> indptr;
+    std::vector<int> indices;
+    std::vector<tfloat> values;
+};
+
+/**
+ * This runs path dependent Tree SHAP (or Saabas when approximate is true) on the rows of a CSR matrix,
+ * so the rows never need to be densified as a whole matrix. Each thread scatters one row at a time into
+ * a dense buffer (where NaNs are found inline as missing values), explains it, and keeps only the non-zero SHAP values of the features the trees split
+ * on. With top_k > 0 only the top_k values of each row and output with the largest magnitude are kept.
+ * The bias term of the first row is written to out_bias.
+ */
+template <typename T>
+void sparse_tree_shap(const TreeEnsemble<T>& trees, const SparseDataset<T> &data, SparseContribs &out,
+                      tfloat *out_bias, bool approximate, unsigned top_k = 0, unsigned num_threads = 1,
+                      const PathTables *path_tables = NULL) {
+    const unsigned M = data.M;
+    const unsigned num_outputs = trees.num_outputs;
+
+    // only the features the trees split on can get a non-zero SHAP value
+    std::vector<unsigned> split_features;
+    for (unsigned j = 0; j < trees.tree_limit; ++j) {
+        const TreeNode<T> *nodes = trees.nodes + trees.tree_offset(j);
+        for (unsigned k = 0; k < trees.tree_num_nodes(j); ++k) {
+            if (nodes[k].children_left >= 0) split_features.push_back(nodes[k].split_feature());
+        }
+    }
+    std::sort(split_features.begin(), split_features.end());
+    split_features.erase(std::unique(split_features.begin(), split_features.end()), split_features.end());
+
+    // each thread writes the rows of its own block, which are then joined in order
+    if (num_threads > data.num_X) num_threads = data.num_X > 0 ? data.num_X : 1;
+    std::vector<SparseContribs> parts(num_threads);
+    parallel_for_rows(data.num_X, num_threads, [&](unsigned start, unsigned end, unsigned thread_index) {
+        SparseContribs &part = parts[thread_index];
+        T *x = new T[M]();
+        std::vector<tfloat> phi((M + 1) * num_outputs, 0);
+        std::vector<std::pair<int, tfloat> > row;
+        ExplanationDataset<T> instance = ExplanationDataset<T>(x, NULL, NULL, NULL, NULL, 1, M, 0);
+
+        for (unsigned i = start; i < end; ++i) {
+            for (long long p = data.indptr[i]; p < data.indptr[i + 1]; ++p) x[data.indices[p]] = data.data[p];
+
+            if (approximate) dense_tree_saabas(phi.data(), trees, instance);
+            else if (path_tables != NULL) dense_tree_path_table_shap(trees, *path_tables, instance, phi.data());
+            else dense_tree_path_dependent(trees, instance, phi.data(), NULL);
+
+            if (i == 0) std::copy(phi.begin() + M * num_outputs, phi.end(), out_bias);
+            std::fill(phi.begin() + M * num_outputs, phi.end(), 0);
+
+            // move the non-zero values into the row of the output and clear the buffers for the next row
+            long long row_size = 0;
+            for (unsigned k = 0; k < num_outputs; ++k) {
+                row.clear();
+                for (unsigned f = 0; f < split_features.size(); ++f) {
+                    tfloat &v = phi[split_features[f] * num_outputs + k];
+                    if (v != 0) row.push_back(std::make_pair((int)(k * M + split_features[f]), v));
+                    v = 0;
+                }
+                if (top_k > 0 && row.size() > top_k) {
+                    std::nth_element(row.begin(), row.begin() + top_k, row.end(),
+                        [](const std::pair<int, tfloat> &a, const std::pair<int, tfloat> &b) {
+                            return std::abs(a.second) > std::abs(b.second);
+                        }
+                    );
+                    row.resize(top_k);
+                    std::sort(row.begin(), row.end());
+                }
+                for (unsigned j = 0; j < row.size(); ++j) {
+                    part.indices.push_back(row[j].first);
+                    part.values.push_back(row[j].second);
+                }
+                row_size += row.size();
+            }
+            part.indptr.push_back(row_size);
+
+            for (long long p = data.indptr[i]; p < data.indptr[i + 1]; ++p) x[data.indices[p]] = 0;
+        }
+
+        delete[] x;
+    });
+
+    // join the blocks of rows
+    size_t num_values = 0;
+    for (unsigned t = 0; t < parts.size(); ++t) num_values += parts[t].values.size();
+    out.indptr.assign(1, 0);
+    out.indptr.reserve(data.num_X + 1);
+    out.indices.reserve(num_values);
+    out.values.reserve(num_values);
+    for (unsigned t = 0; t < parts.size(); ++t) {
+        for (unsigned i = 0; i < parts[t].indptr.size(); ++i) {
+            out.indptr.push_back(out.indptr.back() + parts[t].indptr[i]);
+        }
+        out.indices.insert(out.indices.end(), parts[t].indices.begin(), parts[t].indices.end());
+        out.values.insert(out.values.end(), parts[t].values.begin(), parts[t].values.end());
+        std::vector<int>().swap(parts[t].indices);
+        std::vector<tfloat>().swap(parts[t].values);
+    }
 }
@@ -723,3 +723,714 @@ def test_skopt_rf_et():
 
     assert np.allclose(shap_values_et.sum(1) + explainer_et.expected_value, result_et.models[-1].predict(et_df))
     assert np.allclose(shap_values_rf.sum(1) + explainer_rf.expected_value, result_rf.models[-1].predict(rf_df))
+
+def test_random_forest_n_jobs():
+    import shap
+    import numpy as np
+    from sklearn.model_selection import train_test_split
+    from sklearn.ensemble import RandomForestRegressor
+
+    X_train,X_test,Y_train,Y_test = train_test_split(*shap.datasets.adult(), test_size=0.2, random_state=0)
+    clf = RandomForestRegressor(random_state=202, n_estimators=10, max_depth=10)
+    clf.fit(X_train, Y_train)
+    ex = shap.TreeExplainer(clf)
+    shap_values = ex.shap_values(X_test[:100])
+    assert np.allclose(ex.shap_values(X_test[:100], n_jobs=4), shap_values), \
+        "Multi-threaded SHAP values don't match the single threaded ones!"
+    interaction_values = ex.shap_interaction_values(X_test[:10])
+    assert np.allclose(ex.shap_interaction_values(X_test[:10], n_jobs=-1), interaction_values), \
+        "Multi-threaded SHAP interaction values don't match the single threaded ones!"
+
+def test_random_forest_float32_input():
+    import shap
+    import numpy as np
+    from sklearn.model_selection import train_test_split
+    from sklearn.ensemble import RandomForestRegressor
+
+    X_train,X_test,Y_train,Y_test = train_test_split(*shap.datasets.adult(), test_size=0.2, random_state=0)
+    clf = RandomForestRegressor(random_state=202, n_estimators=10, max_depth=10)
+    clf.fit(X_train, Y_train)
+    ex = shap.TreeExplainer(clf)
+
+    # sklearn models are explained natively in float32, which should match the float64 inputs
+    shap_values = ex.shap_values(X_test.values.astype(np.float32))
+    assert np.allclose(shap_values, ex.shap_values(X_test.values.astype(np.float64)))
+    assert np.abs(shap_values.sum(1) + ex.expected_value - clf.predict(X_test)).max() < 1e-6, \
+        "SHAP values don't sum to model output!"
+
+def test_compiled_ensemble_reuse():
+    import shap
+    import pickle
+    import numpy as np
+    from sklearn.model_selection import train_test_split
+    from sklearn.ensemble import RandomForestRegressor
+
+    X_train,X_test,Y_train,Y_test = train_test_split(*shap.datasets.adult(), test_size=0.2, random_state=0)
+    clf = RandomForestRegressor(random_state=202, n_estimators=10, max_depth=10)
+    clf.fit(X_train, Y_train)
+    ex = shap.TreeExplainer(clf)
+    shap_values = ex.shap_values(X_test[:20])
+
+    # the native handle is built once and reused for every row
+    compiled = ex.model.compiled
+    assert ex.model.compiled is compiled
+    X = X_test.values[:20].astype(np.float32)
+    for i in range(X.shape[0]):
+        phi = np.zeros((1, X.shape[1]+1, 1))
+        compiled.shap_values(X[i:i+1], np.isnan(X[i:i+1]), None, None, None, -1, phi, 1, 0, False, 1)
+        assert np.allclose(phi[0, :-1, 0], shap_values[i])
+    pred = np.zeros((X.shape[0], 1))
+    compiled.predict(X, np.isnan(X), None, -1, 0, pred)
+    assert np.allclose(pred[:,0], clf.predict(X))
+
+    # the handle is dropped when pickling and rebuilt on demand
+    ex2 = pickle.loads(pickle.dumps(ex))
+    assert np.allclose(ex2.shap_values(X_test[:20]), shap_values)
+
+def test_missing_value_directions():
+    import shap
+    import numpy as np
+    from shap.explainers.tree import Tree
+
+    # the packed nodes encode whether missing values go left or right, so check both directions
+    tree = Tree({
+        "children_left": np.array([1, 3, -1, -1, -1]),
+        "children_right": np.array([2, 4, -1, -1, -1]),
+        "children_default": np.array([2, 3, -1, -1, -1]),
+        "feature": np.array([0, 1, -1, -1, -1]),
+        "threshold": np.array([0.0, 0.5, 0, 0, 0]),
+        "value": np.array([[0.], [0.], [3.], [1.], [2.]]),
+        "node_sample_weight": np.array([10., 6., 4., 3., 3.]),
+    })
+    ex = shap.TreeExplainer([tree])
+    X = np.array([[-1, 0], [-1, 1], [1, 0], [np.nan, 0], [-1, np.nan], [np.nan, np.nan]])
+    pred = ex.model.predict(X)
+    assert np.allclose(pred, [1, 2, 3, 3, 1, 3])
+    shap_values = ex.shap_values(X)
+    expected_value = ex.expected_value
+    assert np.allclose(shap_values.sum(1) + expected_value, pred), \
+        "SHAP values don't sum to model output!"
+    saabas_values = ex.shap_values(X, approximate=True)
+    assert np.allclose(saabas_values.sum(1) + expected_value, pred), \
+        "Saabas values don't sum to model output!"
+
+def test_ragged_tree_storage():
+    import shap
+    import numpy as np
+    from sklearn.model_selection import train_test_split
+    from sklearn.tree import DecisionTreeRegressor
+    from shap.explainers.tree import Tree
+
+    X_train,X_test,Y_train,Y_test = train_test_split(*shap.datasets.adult(), test_size=0.2, random_state=0)
+    deep = DecisionTreeRegressor(random_state=202).fit(X_train, Y_train)
+    stump = DecisionTreeRegressor(random_state=202, max_depth=1).fit(X_train, Y_train)
+    ex = shap.TreeExplainer([Tree(deep.tree_), Tree(stump.tree_)])
+
+    # the trees are stored back to back instead of being padded to the size of the largest tree
+    assert ex.model.values.shape[0] == deep.tree_.node_count + 3
+    assert np.all(ex.model.tree_offsets == [0, deep.tree_.node_count, deep.tree_.node_count + 3])
+
+    X = X_test.values[:100]
+    pred = deep.predict(X) + stump.predict(X)
+    assert np.allclose(ex.model.predict(X), pred)
+    shap_values = ex.shap_values(X)
+    assert np.allclose(shap_values.sum(1) + ex.expected_value, pred), \
+        "SHAP values don't sum to model output!"
+
+def test_lightgbm_model_string():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_lightgbm_model_string!")
+        return
+    import shap
+    import numpy as np
+    from shap.explainers.tree import Tree, get_lightgbm_trees
+
+    X, y = shap.datasets.boston()
+    X = X.values.copy()
+    X[::7,5] = np.nan
+    model = lightgbm.sklearn.LGBMRegressor(n_estimators=20)
+    model.fit(X, y)
+
+    # the trees parsed from the text model should match the ones built from the JSON dump
+    booster = model.booster_
+    json_trees = [Tree(e) for e in booster.dump_model()["tree_info"]]
+    text_trees = [Tree(e) for e in get_lightgbm_trees(booster.model_to_string())]
+    assert len(json_trees) == len(text_trees)
+    for t1, t2 in zip(json_trees, text_trees):
+        assert np.all(t1.children_left == t2.children_left)
+        assert np.all(t1.children_right == t2.children_right)
+        assert np.all(t1.children_default == t2.children_default)
+        assert np.all(t1.features == t2.features)
+        assert np.all(t1.thresholds == t2.thresholds)
+        assert np.allclose(t1.values, t2.values)
+
+    ex = shap.TreeExplainer(model)
+    assert np.allclose(ex.model.predict(X), model.predict(X))
+
+def test_save_load():
+    import shap
+    import numpy as np
+    import tempfile
+    import sklearn.ensemble
+    from sklearn.model_selection import train_test_split
+
+    X, y = shap.datasets.boston()
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=7)
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=6, random_state=0)
+    model.fit(X_train, y_train)
+    other_model = sklearn.ensemble.RandomForestRegressor(n_estimators=5, max_depth=6, random_state=0)
+    other_model.fit(X_train, y_train)
+
+    X = X_test.values[:100]
+    for kwargs in [{}, {"data": X_train.values[:50], "feature_dependence": "independent"}]:
+        ex = shap.TreeExplainer(model, **kwargs)
+        path = tempfile.mkdtemp()
+        ex.save(path)
+
+        ex2 = shap.TreeExplainer.load(path, model=model)
+        assert isinstance(ex2.model.values, np.memmap)
+        assert np.allclose(ex2.model.predict(X), ex.model.predict(X))
+        assert np.allclose(ex2.shap_values(X), ex.shap_values(X))
+        assert np.allclose(ex2.expected_value, ex.expected_value)
+
+        try:
+            shap.TreeExplainer.load(path, model=other_model)
+            assert False, "Loading with the wrong model should fail!"
+        except ValueError:
+            pass
+
+    # explaining the loss of a loaded explainer reads the margins of its memory mapped background
+    ex = shap.TreeExplainer(model, X_train.values[:50], feature_dependence="independent")
+    ex.model.objective = "squared_error"
+    ex.model_output = "logloss"
+    path = tempfile.mkdtemp()
+    ex.save(path)
+    ex2 = shap.TreeExplainer.load(path, model=model)
+    assert isinstance(ex2.data, np.memmap)
+    y = y_test[:100]
+    assert np.allclose(ex2.shap_values(X, y), ex.shap_values(X, y))
+
+def test_multiclass_independent():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    y = np.digitize(y, np.percentile(y, [20, 40, 60, 80])) # five classes
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, max_depth=6, random_state=0)
+    model.fit(X, y)
+
+    ex = shap.TreeExplainer(model, X[:30], feature_dependence="independent")
+    shap_values = ex.shap_values(X[:20])
+    assert len(shap_values) == 5
+    pred = model.predict_proba(X[:20])
+    for i in range(5):
+        assert np.allclose(shap_values[i].sum(1) + ex.expected_value[i], pred[:,i], atol=1e-6), \
+            "SHAP values don't sum to model output!"
+
+def test_independent_threads_and_chunks():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=6, random_state=0)
+    model.fit(X, y)
+
+    ex = shap.TreeExplainer(model, X[:50], feature_dependence="independent")
+    shap_values = ex.shap_values(X[:10])
+    assert np.allclose(ex.shap_values(X[:10], n_jobs=3, chunk_size=7), shap_values)
+
+    # with fewer rows than threads the background samples are split across the threads
+    assert np.allclose(ex.shap_values(X[:1], n_jobs=4), shap_values[:1])
+    assert np.allclose(ex.shap_values(X[:1], n_jobs=4, chunk_size=5), shap_values[:1])
+
+def test_interactions_and_tree():
+    import shap
+    import numpy as np
+    from shap.explainers.tree import Tree
+
+    # f(x) = x0 and x1, where feature 1 is only split on below a leaf in node order
+    tree = {
+        "children_left": np.array([1, -1, 3, -1, -1]),
+        "children_right": np.array([2, -1, 4, -1, -1]),
+        "children_default": np.array([1, -1, 3, -1, -1]),
+        "feature": np.array([0, -2, 1, -2, -2]),
+        "threshold": np.array([0.5, 0, 0.5, 0, 0]),
+        "value": np.array([[0.], [0.], [0.], [0.], [1.]]),
+        "node_sample_weight": np.array([4., 2., 2., 1., 1.])
+    }
+    ex = shap.TreeExplainer([Tree(tree), Tree(tree)])
+    X = np.array([[1., 1.], [0., 1.]])
+    for n_jobs in [1, 2]:
+        interaction_values = ex.shap_interaction_values(X, n_jobs=n_jobs)
+        assert np.allclose(interaction_values[0], [[0.5, 0.25], [0.25, 0.5]])
+        assert np.allclose(interaction_values[1], [[-0.5, -0.25], [-0.25, 0.5]])
+
+    interaction_values = ex.shap_interaction_values(X, tree_limit=1)
+    assert np.allclose(interaction_values[0], [[0.25, 0.125], [0.125, 0.25]])
+
+def test_multioutput_interactions():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    rs = np.random.RandomState(0)
+    X = rs.randn(500, 5)
+    y = (X[:,0] > 0) + 2 * (X[:,1] * X[:,2] > 0)
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, max_depth=5, random_state=0)
+    model.fit(X, y)
+
+    # each class output gets its own main effects on the diagonal
+    ex = shap.TreeExplainer(model)
+    interaction_values = ex.shap_interaction_values(X[:20])
+    shap_values = ex.shap_values(X[:20])
+    probs = model.predict_proba(X[:20])
+    assert len(interaction_values) == 4
+    for i in range(4):
+        assert np.allclose(interaction_values[i].sum(2), shap_values[i])
+        assert np.allclose(interaction_values[i].sum((1, 2)) + ex.expected_value[i], probs[:,i]), \
+            "SHAP interaction values don't sum to model output!"
+
+def test_lightgbm_categorical_interactions():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_lightgbm_categorical_interactions!")
+        return
+    import shap
+    import numpy as np
+
+    rs = np.random.RandomState(0)
+    X = rs.randn(2000, 4)
+    X[:,0] = rs.randint(0, 30, 2000)
+    X[:,2] = rs.randint(0, 6, 2000)
+    X[::11,0] = np.nan
+    y = np.isin(X[:,0], [1, 3, 4, 7, 20, 21, 22]) * 2.0 + X[:,1] + (X[:,2] == 3) * X[:,3]
+    model = lightgbm.train(
+        {"verbose": -1, "num_leaves": 16, "min_data_per_group": 5, "cat_smooth": 1, "max_cat_to_onehot": 2},
+        lightgbm.Dataset(X, y, categorical_feature=[0, 2]), 20
+    )
+
+    # the categorical splits are rewritten as threshold splits that give the same predictions
+    ex = shap.TreeExplainer(model)
+    X_test = X[:50].copy()
+    X_test[0,0] = -0.5
+    X_test[1,0] = 100
+    X_test[2,0] = 2.5
+    assert np.allclose(ex.model.predict(X_test), model.predict(X_test, raw_score=True))
+
+    interaction_values = ex.shap_interaction_values(X_test[:10])
+    assert np.allclose(interaction_values.sum((1, 2)) + ex.expected_value, model.predict(X_test[:10])), \
+        "SHAP interaction values don't sum to model output!"
+
+    ex = shap.TreeExplainer(model, X[:50], feature_dependence="independent")
+    shap_values = ex.shap_values(X_test[:10])
+    assert np.allclose(shap_values.sum(1) + ex.expected_value, model.predict(X_test[:10])), \
+        "SHAP values don't sum to model output!"
+
+def test_lightgbm_multiclass_interactions():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_lightgbm_multiclass_interactions!")
+        return
+    import shap
+    import numpy as np
+
+    rs = np.random.RandomState(0)
+    X = rs.randn(1000, 4)
+    X[:,0] = rs.randint(0, 10, 1000)
+    y = np.minimum((X[:,0] % 4 == 1) + 2 * (X[:,1] > 0) + (X[:,2] * X[:,3] > 0), 3)
+    model = lightgbm.train(
+        {"objective": "multiclass", "num_class": 4, "verbose": -1, "num_leaves": 8, "max_cat_to_onehot": 2},
+        lightgbm.Dataset(X, y, categorical_feature=[0]), 10
+    )
+    assert "cat_threshold" in model.model_to_string()
+
+    # the trees of each class are explained as their own output
+    ex = shap.TreeExplainer(model)
+    assert ex.model.n_outputs == 4
+    raw = model.predict(X[:20], raw_score=True)
+    assert np.allclose(ex.model.predict(X[:20]), raw)
+
+    interaction_values = ex.shap_interaction_values(X[:20])
+    shap_values = ex.shap_values(X[:20])
+    assert len(interaction_values) == 4
+    for i in range(4):
+        assert np.allclose(interaction_values[i].sum(2), shap_values[i])
+        assert np.allclose(interaction_values[i].sum((1, 2)) + ex.expected_value[i], raw[:,i]), \
+            "SHAP interaction values don't sum to model output!"
+
+def test_catboost_interactions():
+    try:
+        import catboost
+    except:
+        print("Skipping test_catboost_interactions!")
+        return
+    import shap
+    import numpy as np
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = catboost.CatBoostRegressor(iterations=50, depth=4, verbose=False, random_seed=0)
+    model.fit(X, y)
+
+    ex = shap.TreeExplainer(model)
+    assert np.allclose(ex.model.predict(X[:50]), model.predict(X[:50]), atol=1e-4)
+    interaction_values = ex.shap_interaction_values(X[:10])
+    assert np.allclose(interaction_values.sum((1, 2)) + ex.expected_value, model.predict(X[:10]), atol=1e-4), \
+        "SHAP interaction values don't sum to model output!"
+
+    # leaves no training sample reached must match CatBoost's own interaction values
+    native = model.get_feature_importance(data=catboost.Pool(X[:10]), fstr_type="ShapInteractionValues")
+    assert np.allclose(interaction_values, native[:,:-1,:-1], atol=1e-4)
+
+    # a multi-class model explains each class
+    yc = (X[:,0] > 3).astype(int) + (X[:,5] > 5) + (X[:,12] > 6)
+    model = catboost.CatBoostClassifier(iterations=30, depth=4, loss_function="MultiClass", verbose=False, random_seed=0)
+    model.fit(X, yc)
+    ex = shap.TreeExplainer(model)
+    interaction_values = ex.shap_interaction_values(X[:10])
+    raw = model.predict(X[:10], prediction_type="RawFormulaVal")
+    for i in range(4):
+        assert np.allclose(interaction_values[i].sum((1, 2)) + ex.expected_value[i], raw[:,i], atol=1e-4)
+
+def test_streaming_interactions():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=6, random_state=0)
+    model.fit(X, y)
+    ex = shap.TreeExplainer(model)
+    interaction_values = ex.shap_interaction_values(X.values[:50])
+
+    # writing float32 blocks into a preallocated array
+    out = np.zeros((50, X.shape[1], X.shape[1]), dtype=np.float32)
+    assert ex.shap_interaction_values(X[:50], out=out, block_size=7) is out
+    assert np.allclose(out, interaction_values, atol=1e-5)
+
+    # reducing over blocks at constant memory
+    blocks = list(ex.iter_shap_interaction_values(X[:50], block_size=16))
+    assert [len(b) for b in blocks] == [16, 16, 16, 2]
+    assert np.allclose(sum(np.abs(b).sum(0) for b in blocks), np.abs(interaction_values).sum(0))
+
+    # only keeping the strongest interaction partners
+    inds, values = next(ex.iter_shap_interaction_values(X[:50], block_size=50, top_k=3))
+    assert inds.shape == (50, X.shape[1], 3)
+    assert not np.any(inds == np.arange(X.shape[1])[None,:,None])
+    partners = np.abs(interaction_values) - 2 * np.eye(X.shape[1]) * np.abs(interaction_values).max()
+    assert np.allclose(np.abs(values), -np.sort(-partners, axis=2)[:,:,:3])
+    assert np.allclose(values, np.take_along_axis(interaction_values, inds, axis=2))
+
+def test_global_interaction_values():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    X, y = shap.datasets.adult()
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, max_depth=6, random_state=0)
+    model.fit(X, y)
+    ex = shap.TreeExplainer(model)
+    interaction_values = ex.shap_interaction_values(X[:40])
+    expected_value = ex.expected_value
+
+    for n_jobs in [1, 3]:
+        mean_abs = ex.global_interaction_values(X[:40], n_jobs=n_jobs)
+        assert np.allclose(ex.expected_value, expected_value)
+        for i in range(2):
+            assert np.allclose(mean_abs[i], np.abs(interaction_values[i]).mean(0))
+        sums = ex.global_interaction_values(X[:40], reduce="sum", n_jobs=n_jobs)
+        for i in range(2):
+            assert np.allclose(sums[i], interaction_values[i].sum(0))
+
+def test_block_predict():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    # enough rows for several blocks, with missing values, and unbalanced trees of several outputs
+    rs = np.random.RandomState(0)
+    X = rs.randn(1000, 5)
+    y = rs.randint(3, size=1000) + (X[:,0] > 1)
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=7, random_state=0).fit(X, y)
+    ex = shap.TreeExplainer(model)
+    X_test = rs.randn(201, 5)
+    assert np.allclose(ex.model.predict(X_test), model.predict_proba(X_test))
+
+    # missing values follow children_default in both directions
+    tree = {
+        "children_left": np.array([1, -1, 3, -1, -1]),
+        "children_right": np.array([2, -1, 4, -1, -1]),
+        "children_default": np.array([1, -1, 4, -1, -1]),
+        "feature": np.array([0, -2, 1, -2, -2]),
+        "threshold": np.array([0.5, 0, 0.5, 0, 0]),
+        "value": np.array([[1.], [2.], [0.], [3.], [4.]]),
+        "node_sample_weight": np.array([4., 2., 2., 1., 1.])
+    }
+    ex = shap.TreeExplainer([shap.explainers.tree.Tree(tree)])
+    X_missing = np.array([[np.nan, 0], [1, np.nan], [1, 0], [1, 1], [0, 1]] * 30)
+    assert np.allclose(ex.model.predict(X_missing), [2, 4, 3, 4, 2] * 30)
+
+def test_path_tables():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    rs = np.random.RandomState(0)
+    X = rs.randn(500, 6)
+    y = rs.randint(3, size=500) + (X[:,0] * X[:,1] > 0)
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, max_depth=5, random_state=0).fit(X, y)
+    X_test = rs.randn(50, 6)
+    X_test[::3,1] = np.nan
+
+    # shallow trees are explained from precomputed per leaf tables
+    ex = shap.TreeExplainer(model)
+    shap_values = ex.shap_values(X_test)
+    assert ex.model.compiled.build_path_tables(ex.path_table_max_entries)
+    ex_recursive = shap.TreeExplainer(model)
+    ex_recursive.path_table_max_entries = 0
+    assert np.allclose(shap_values, ex_recursive.shap_values(X_test))
+    assert not ex_recursive.model.compiled.build_path_tables(0)
+    assert np.allclose(ex.shap_values(X_test, tree_limit=3), ex_recursive.shap_values(X_test, tree_limit=3))
+
+def test_saabas_threads_and_lightgbm():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_saabas_threads_and_lightgbm!")
+        return
+    import shap
+    import numpy as np
+
+    X, y = shap.datasets.adult()
+    model = lightgbm.train({"verbose": -1, "num_leaves": 15}, lightgbm.Dataset(X, y.astype(np.float64)), 20)
+    ex = shap.TreeExplainer(model)
+    saabas_values = ex.shap_values(X[:100], approximate=True)
+    assert np.allclose(saabas_values.sum(1) + ex.expected_value, model.predict(X[:100], raw_score=True), atol=1e-6), \
+        "Saabas values don't sum to model output!"
+    assert np.allclose(ex.shap_values(X[:100], approximate=True, n_jobs=3), saabas_values)
+    assert np.allclose(ex.model.predict(X[:100], n_jobs=3), model.predict(X[:100], raw_score=True))
+
+    # multi-class models get Saabas values for each class
+    yc = (X.values[:,0] > np.median(X.values[:,0])) + (X.values[:,10] > np.median(X.values[:,10])) + y
+    model = lightgbm.train(
+        {"objective": "multiclass", "num_class": 4, "verbose": -1, "num_leaves": 15}, lightgbm.Dataset(X, yc), 10
+    )
+    ex = shap.TreeExplainer(model)
+    saabas_values = ex.shap_values(X[:100], approximate=True)
+    raw = model.predict(X[:100], raw_score=True)
+    assert len(saabas_values) == 4
+    for i in range(4):
+        assert np.allclose(saabas_values[i].sum(1) + ex.expected_value[i], raw[:,i], atol=1e-6), \
+            "Saabas values don't sum to model output!"
+
+def test_update_background():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=6, random_state=0)
+    model.fit(X, y)
+
+    ex = shap.TreeExplainer(model, X[:100], feature_dependence="independent")
+    ex.update_background(add=X[100:150], remove=np.arange(20), n_jobs=2)
+    ex_new = shap.TreeExplainer(model, np.concatenate([X[20:100], X[100:150]]), feature_dependence="independent")
+
+    assert np.allclose(ex.model.node_sample_weight, ex_new.model.node_sample_weight)
+    assert np.allclose(ex.model.values, ex_new.model.values, atol=1e-5, equal_nan=True)
+    assert np.allclose(ex.expected_value, ex_new.expected_value, atol=1e-5)
+    assert np.allclose(ex.shap_values(X[:10]), ex_new.shap_values(X[:10]), atol=1e-5)
+
+    # multi-output models keep one expected value per output, even after shap_values made it a list
+    yc = (X[:,0] > 3).astype(int) + (X[:,5] > 6)
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, max_depth=6, random_state=0)
+    model.fit(X, yc)
+    ex = shap.TreeExplainer(model, X[:100], feature_dependence="independent")
+    ex.shap_values(X[:10])
+    ex.update_background(add=X[100:150], remove=np.arange(20))
+    ex_new = shap.TreeExplainer(model, np.concatenate([X[20:100], X[100:150]]), feature_dependence="independent")
+    assert np.allclose(ex.expected_value, ex_new.expected_value, atol=1e-5)
+    assert np.allclose(ex.shap_values(X[:10]), ex_new.shap_values(X[:10]), atol=1e-5)
+
+def test_sparse_shap_values():
+    import shap
+    import numpy as np
+    import scipy.sparse
+    import sklearn.ensemble
+
+    X = scipy.sparse.random(500, 2000, density=0.01, format="csr", random_state=0)
+    y = np.asarray(X[:, :20].sum(1)).ravel() > 0.1
+    model = sklearn.ensemble.RandomForestClassifier(n_estimators=10, max_depth=5, random_state=0)
+    model.fit(X, y)
+    X.data[::40] = np.nan # stored NaNs are missing values
+
+    ex = shap.TreeExplainer(model)
+    for approximate in [False, True]:
+        dense_values = ex.shap_values(X[:100].toarray(), approximate=approximate)
+        sparse_values = ex.shap_values(X[:100], approximate=approximate, n_jobs=2)
+        for i in range(2):
+            assert scipy.sparse.isspmatrix_csr(sparse_values[i])
+            assert np.allclose(sparse_values[i].toarray(), dense_values[i])
+
+        top_values = ex.shap_values(X[:100], approximate=approximate, top_k=3)
+        for i in range(2):
+            assert top_values[i].getnnz(1).max() <= 3
+            assert np.allclose(np.sort(np.abs(top_values[i].toarray()), 1)[:, -3:], np.sort(np.abs(dense_values[i]), 1)[:, -3:])
+
+def test_inline_missing_values():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    # float32 models convert float64 rows a block at a time, so use enough features for several blocks
+    rs = np.random.RandomState(0)
+    X = rs.randn(800, 3000)
+    y = X[:, 0] + X[:, 1] * X[:, 2]
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=6, max_features=0.01, random_state=0)
+    model.fit(X, y)
+    X[rs.rand(*X.shape) < 0.1] = np.nan
+
+    ex = shap.TreeExplainer(model)
+    X_missing = np.isnan(X)
+    predictions = ex.model.predict(X)
+    assert np.allclose(predictions, ex.model.predict(X.astype(np.float32)))
+    assert np.allclose(predictions, ex.model.predict(np.nan_to_num(X), X_missing=X_missing))
+
+    shap_values = ex.shap_values(X[:100])
+    assert np.allclose(shap_values, ex.shap_values(X[:100].astype(np.float32)))
+    assert np.allclose(shap_values, ex.shap_values(np.nan_to_num(X[:100]), X_missing=X_missing[:100]))
+    assert np.allclose(shap_values.sum(1) + ex.expected_value, predictions[:100], atol=1e-5)
+
+def test_global_path_dependent():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=4, random_state=0)
+    model.fit(X, y)
+
+    ex = shap.TreeExplainer(model, X[:50], feature_dependence="global_path_dependent")
+    shap_values = ex.shap_values(X[100:160], n_jobs=2)
+    assert np.allclose(shap_values.sum(1) + ex.expected_value, model.predict(X[100:160]))
+    assert np.allclose(ex.expected_value, model.predict(X[:50]).mean())
+
+    # each row is explained on its own, so how the rows are merged with the background doesn't matter
+    assert np.allclose(shap_values, ex.shap_values(X[100:160], chunk_size=7))
+    assert np.allclose(shap_values[:1], ex.shap_values(X[100:101]))
+
+def test_logloss_background_cache():
+    try:
+        import lightgbm
+    except:
+        print("Skipping test_logloss_background_cache!")
+        return
+    import shap
+    import numpy as np
+
+    X, y = shap.datasets.adult()
+    X = X.values.astype(np.float64)
+    y = y.astype(np.float64)
+    model = lightgbm.train({"num_leaves": 8, "objective": "binary", "verbose": -1}, lightgbm.Dataset(X, y), 20)
+
+    ex = shap.TreeExplainer(model, X[:100], feature_dependence="independent", model_output="logloss")
+    margins = model.predict(X[:100], raw_score=True)
+    assert np.allclose(ex.expected_value(1), np.mean(np.log(1 + np.exp(margins)) - margins))
+
+    margins = model.predict(X[200:220], raw_score=True)
+    shap_values = ex.shap_values(X[200:220], y[200:220])
+    expected_values = np.array([ex.expected_value(label) for label in y[200:220]])
+    assert np.allclose(shap_values.sum(1) + expected_values, np.log(1 + np.exp(margins)) - y[200:220] * margins, atol=1e-6)
+
+    # the cached background margins follow update_background
+    ex.update_background(add=X[100:150], remove=np.arange(20))
+    ex_new = shap.TreeExplainer(model, X[20:150], feature_dependence="independent", model_output="logloss")
+    assert np.allclose(ex.expected_value(0), ex_new.expected_value(0))
+    assert np.allclose(ex.shap_values(X[200:220], y[200:220]), ex_new.shap_values(X[200:220], y[200:220]))
+
+    ex.invalidate_background_cache()
+    assert np.allclose(ex.shap_values(X[200:220], y[200:220], tree_limit=5), ex_new.shap_values(X[200:220], y[200:220], tree_limit=5))
+
+def test_shap_values_by_stage():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=30, max_depth=5, random_state=0)
+    model.fit(X, y)
+
+    stages = [30, 5, 12, -1]
+    for ex in [shap.TreeExplainer(model), shap.TreeExplainer(model, X[:30], feature_dependence="independent")]:
+        stage_values = ex.shap_values_by_stage(X[:40], stages, n_jobs=2)
+        for stage, shap_values in zip(stages, stage_values):
+            assert np.allclose(shap_values, ex.shap_values(X[:40], tree_limit=stage))
+
+def test_per_tree_shap_values():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=5, random_state=0)
+    model.fit(X, y)
+
+    ex = shap.TreeExplainer(model)
+    per_tree = ex.per_tree_shap_values(X[:50], n_jobs=2)
+    assert per_tree.shape == (10, X.shape[1])
+    for i, estimator in enumerate(model.estimators_):
+        tree_ex = shap.TreeExplainer([shap.explainers.tree.Tree(estimator.tree_, scaling=0.1)])
+        assert np.allclose(per_tree[i], np.abs(tree_ex.shap_values(X[:50])).mean(0))
+
+    # the per tree means add up to the mean SHAP values of the ensemble
+    assert np.allclose(ex.per_tree_shap_values(X[:50], reduce="mean").sum(0), ex.shap_values(X[:50]).mean(0))
+
+def test_apply_leaves():
+    import shap
+    import numpy as np
+    import sklearn.ensemble
+
+    X, y = shap.datasets.boston()
+    X = X.values
+    model = sklearn.ensemble.RandomForestRegressor(n_estimators=10, max_depth=5, random_state=0)
+    model.fit(X, y)
+
+    ex = shap.TreeExplainer(model, X[:50], feature_dependence="independent")
+    leaves = ex.model.apply(X, n_jobs=2)
+    assert leaves.dtype == np.int32 and leaves.shape == (X.shape[0], 10)
+    assert np.array_equal(leaves, np.stack([e.apply(X.astype(np.float32)) for e in model.estimators_], 1))
+    assert np.allclose(ex.model.predict(X, leaves=leaves), ex.model.predict(X))
+
+    # leaves that are out of range or not leaves of their tree are rejected
+    for bad_leaf in [10**6, -1, 0]:
+        bad_leaves = leaves.copy()
+        bad_leaves[3, 4] = bad_leaf
+        try:
+            ex.model.predict(X, leaves=bad_leaves)
+            assert False, "A leaf matrix with an invalid leaf should fail!"
+        except ValueError:
+            pass
+
+    # explaining the loss needs the margins of X, which come from the leaves
+    ex.model.objective = "squared_error"
+    ex.model_output = "logloss"
+    assert np.allclose(ex.shap_values(X[:20], y[:20], leaves=leaves[:20]), ex.shap_values(X[:20], y[:20]))
+    bad_leaves = leaves[:20].copy()
+    bad_leaves[0, 0] = 10**6
+    try:
+        ex.shap_values(X[:20], y[:20], leaves=bad_leaves)
+        assert False, "A leaf matrix with an invalid leaf should fail!"
+    except ValueError:
+        pass